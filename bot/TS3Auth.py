@@ -1,4 +1,9 @@
 import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from typing import Optional
+
+import time
 
 import bot.gwapi as gw2api
 
@@ -9,20 +14,33 @@ h_hdr = '#~ GW2 Handler:'  # Header
 h_acct = '[AccountGet]'  # Account loading
 h_char = '[CharacterGet]'  # Character loading
 h_auth = '[AuthCheck]'
+h_token = '[TokenCheck]'
 h_char_chk = '[CharacterCheck]'
 
+# Time (seconds) a whole request may take, including all parallel lookups, before it is considered not possible
+AUTH_DEADLINE = 60
+
+# shared between all requests, so the number of concurrent requests against the gw2 api stays bounded
+_auth_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="AuthRequest")
+_character_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="CharacterCheck")
+
 
 #############################
 
 class AuthorizationNotPossibleError(RuntimeError):
-    pass
+    @property
+    def circuit_open(self) -> bool:
+        """True if the gw2 api was not asked at all, because the circuit breaker rejected the request"""
+        return isinstance(self.__cause__, gw2api.CircuitOpenError)
 
 
 # Class for an authentication request from user
 
 class AuthRequest:
     def __init__(self, api_key, required_servers, required_level,
-                 user_id=''):  # User ID left at None for queries that don't require authentication. If left at None the 'success' will always fail due to self.authCheck().
+                 user_id='',  # User ID left at None for queries that don't require authentication. If left at None the 'success' will always fail due to self.authCheck().
+                 guild_cache=None,  # optional GuildCache, guild details are loaded from the gw2 api directly if missing
+                 deadline=AUTH_DEADLINE):
         self.key = api_key
         self.user = user_id
         self.success = False  # Used to verify if user is on our server
@@ -40,18 +58,68 @@ class AuthRequest:
         self.guild_tags = []
         self.guild_names = []
 
-        self.pushCharacterAuth()
-        self.pushAccountAuth()
+        self._guild_get = guild_cache.guild_get if guild_cache is not None else gw2api.guild_get
+        self._deadline = time.monotonic() + deadline
+        self._done = threading.Event()  # stops the character check early, once its result is not needed anymore
+        self._character_auth: Optional[Future] = None  # started by getAccountDetails once the world check passed
+
+        if self.pushTokenCheck():
+            try:
+                if self.pushAccountAuth():
+                    if self._character_auth is not None:
+                        self._await(self._character_auth)
+                    self.authCheck()
+            finally:
+                self._done.set()
+                if self._character_auth is not None:
+                    self._character_auth.cancel()
+
+    def _remaining(self):
+        return max(self._deadline - time.monotonic(), 0)
+
+    def _await(self, future: Future):
+        try:
+            return future.result(timeout=self._remaining())
+        except FutureTimeoutError as ex:
+            raise AuthorizationNotPossibleError("GW2 API did not answer within the deadline") from ex
+
+    def requiredPermissions(self):
+        if self.required_level == 0:
+            return {'account'}
+        return {'account', 'characters'}
+
+    def pushTokenCheck(self):
+        if gw2api.is_api_key_known_invalid(self.key):
+            LOG.info("%s %s API key of %s was recently rejected by the API. Not asking again.", h_hdr, h_token, self.user)
+            return False
+
+        try:
+            token_info = gw2api.tokeninfo_get(self.key)
+        except gw2api.ApiUnavailableError as ex:
+            raise AuthorizationNotPossibleError from ex
+        except gw2api.ApiKeyInvalidError:
+            LOG.info("%s %s API key of %s is invalid or was revoked.", h_hdr, h_token, self.user)
+            gw2api.mark_api_key_invalid(self.key)
+            return False
+        except gw2api.ApiError:
+            LOG.info("%s %s API key of %s was rejected by the API.", h_hdr, h_token, self.user)
+            return False
+
+        missing_permissions = self.requiredPermissions() - set(token_info.get('permissions', []))
+        if missing_permissions:
+            LOG.info("%s %s API key of %s is missing the permissions %s.", h_hdr, h_token, self.user, ", ".join(sorted(missing_permissions)))
+            return False
+        return True
 
     def pushCharacterAuth(self):
         if self.required_level == 0:  # if level is set to 0 bypass character API request (in case GW2 Character API breaks again like in April 2016.)
             self.char_check = True
             return
         try:
-            LOG.info("%s %s Attempting to load character data for %s.", h_hdr, h_char, self.user)
-            self.char_dump = gw2api.characters_get(self.key)
-            LOG.info("%s %s Character data loaded for %s.", h_hdr, h_char, self.user)
-            self.charCheck()
+            LOG.info("%s %s Attempting to load character list for %s.", h_hdr, h_char, self.user)
+            character_names = gw2api.characters_get_names(self.key)
+            LOG.info("%s %s Character list loaded for %s.", h_hdr, h_char, self.user)
+            self.charCheck(character_names)
         except gw2api.ApiUnavailableError as ex:
             raise AuthorizationNotPossibleError from ex
         except gw2api.ApiError:
@@ -61,20 +129,33 @@ class AuthRequest:
         try:
             self.getAccountDetails()
             LOG.info("%s %s Account loaded for %s", h_hdr, h_acct, self.user)
-            self.authCheck()
+            return True
         except gw2api.ApiUnavailableError as ex:
             raise AuthorizationNotPossibleError from ex
+        except gw2api.ApiKeyInvalidError:
+            LOG.info("%s %s API key of %s was revoked.", h_hdr, h_acct, self.user)
+            gw2api.mark_api_key_invalid(self.key)
+            return False
         except gw2api.ApiError:
             LOG.error("%s %s Possibly bad API Key. Error obtaining account details for %s. (Does the API key allow 'account' queries?)", h_hdr, h_acct, self.user)
+            return False
 
     def getAccountDetails(self):
         # All account details
-        self.account_details = gw2api.account_get(self.key)
+        self.account_details = self._await(_auth_executor.submit(gw2api.account_get, self.key))
+
+        # World and guild details are independent of each other, so they are looked up concurrently
+        world_lookup = _auth_executor.submit(gw2api.worlds_get_one, self.account_details.get('world'))
+        guild_lookups = [(guild_id, _auth_executor.submit(self._guild_get, guild_id)) for guild_id in self.account_details.get('guilds')]
 
         # Players World [id,name,population]
-        self.world = gw2api.worlds_get_one(self.account_details.get('world'))
+        self.world = self._await(world_lookup)
         self.users_server = self.world.get('name')
 
+        # characters are only loaded for accounts on a required world, concurrently with the guild lookups
+        if self.serverCheck():
+            self._character_auth = _auth_executor.submit(self.pushCharacterAuth)
+
         # Player Created Date -- May be useful to flag accounts created within past 30 days
         # self.created = self.details_dump.get('created')
 
@@ -90,20 +171,23 @@ class AuthRequest:
 
         # Players Guild Tags (Seems to order it by oldest guild first)
 
-        for guild_id in self.guilds:
+        for guild_id, guild_lookup in guild_lookups:
             try:
-                ginfo = gw2api.guild_get(guild_id)
+                ginfo = self._await(guild_lookup)
                 self.guild_tags.append(ginfo.get('tag'))
                 self.guild_names.append(ginfo.get('name'))
             except gw2api.ApiError as ex:
                 LOG.error("Exception while trying to obtain details for guild '%s': %s", guild_id, str(ex))
                 self.guilds_error = True
 
+    def serverCheck(self):
+        return self.required_servers == [] or self.users_server in self.required_servers
+
     def authCheck(self):
         LOG.info("%s %s Running auth check for %s", h_hdr, h_auth, self.name)
 
         # Check if they are on the required server
-        if self.required_servers == [] or self.users_server in self.required_servers:
+        if self.serverCheck():
             # Check if player has met character requirements
             if self.char_check:
                 self.success = True
@@ -115,10 +199,27 @@ class AuthRequest:
                      h_auth, self.user, self.users_server, self.name, self.required_servers)
         return self.success
 
-    def charCheck(self):
+    def charCheck(self, character_names):
         # Require at least 1 level 80 character (helps prevent spies)
-        for char in self.char_dump:
-            if char.get('level') >= self.required_level:
-                self.char_check = True
-                LOG.info("%s %s User %s has at least 1 level %s character.", h_hdr, h_char_chk, self.user, self.required_level)
-                return
+        # Only the small core endpoint is requested per character. As soon as one character qualifies, the remaining requests are cancelled.
+        pending = {_character_executor.submit(gw2api.character_get_core, self.key, name) for name in character_names}
+        try:
+            while pending and not self._done.is_set():
+                if self._remaining() == 0:
+                    raise AuthorizationNotPossibleError("GW2 API did not answer within the deadline")
+                done, pending = wait(pending, timeout=min(self._remaining(), 1), return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        character = future.result()
+                    except (gw2api.ApiUnavailableError, gw2api.ApiKeyInvalidError):
+                        raise
+                    except gw2api.ApiError as ex:  # e.g. a character renamed or deleted meanwhile, the others may still qualify
+                        LOG.warning("%s %s Unable to load a character of %s: %s", h_hdr, h_char_chk, self.user, str(ex))
+                        continue
+                    if character.get('level') >= self.required_level:
+                        self.char_check = True
+                        LOG.info("%s %s User %s has at least 1 level %s character.", h_hdr, h_char_chk, self.user, self.required_level)
+                        return
+        finally:
+            for future in pending:
+                future.cancel()
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 import logging
+import threading
 
 from bot.config import Config
 from bot.db import ThreadSafeDBConnection
@@ -8,6 +9,9 @@ from .audit_service import AuditService
 from .commander_service import CommanderService
 from .connection_pool import ConnectionPool
 from .event_looper import EventLooper
+from .group_reconciler import GroupReconciler
+from .guild_cache import GuildCache
+from .guild_registry import GuildRegistry
 from .guild_service import GuildService
 from .reset_roster_service import ResetRosterService
 from .user_service import UserService
@@ -24,14 +28,24 @@ class Bot:
         self._config = config
         self._database_connection = database
 
-        self.user_service = UserService(self._database_connection, self._ts_connection_pool, config)
-        self.audit_service = AuditService(self._database_connection, self._ts_connection_pool, config, self.user_service)
-        self.guild_service = GuildService(self._database_connection, self._ts_connection_pool, config)
-        self.guild_audit_service = GuildAuditService(self._database_connection, self._ts_connection_pool, config, self.guild_service)
+        # audits of users and guilds together may only use this many ts connections, the rest stays free for the event loop and commands
+        self._ts_audit_budget = threading.BoundedSemaphore(config.audit_ts_connections)
+
+        self.guild_cache = GuildCache(self._database_connection, config.guild_cache_ttl)
+        self.guild_registry = GuildRegistry(self._database_connection)
+        self.user_service = UserService(self._database_connection, self._ts_connection_pool, config, self.guild_registry)
+        self.audit_service = AuditService(self._database_connection, self._ts_connection_pool, config, self.user_service, self.guild_cache,
+                                          self._ts_audit_budget)
+        self.guild_service = GuildService(self._database_connection, self._ts_connection_pool, config, self.guild_cache, self.guild_registry)
+        self.guild_audit_service = GuildAuditService(self._database_connection, self._ts_connection_pool, config, self.guild_service,
+                                                     self._ts_audit_budget)
+        self.group_reconciler = GroupReconciler(self._database_connection, self._ts_connection_pool, config, self.guild_cache,
+                                                self._ts_audit_budget)
         self.commander_service = CommanderService(self._ts_connection_pool, self.user_service, config)
         self.reset_roster_service = ResetRosterService(self._ts_connection_pool, config)
 
-        self.active_loop = EventLooper(self._database_connection, self._ts_connection_pool, self._config, self.user_service, self.audit_service)
+        self.active_loop = EventLooper(self._database_connection, self._ts_connection_pool, self._config, self.user_service, self.audit_service, self.guild_cache,
+                                       self.guild_registry)
 
     def listen_for_events(self):
         self.active_loop.start()
@@ -42,7 +56,13 @@ class Bot:
     def trigger_guild_audit(self):
         self.guild_audit_service.trigger_guild_audit()
 
+    def trigger_group_reconcile(self):
+        self.group_reconciler.trigger_reconcile()
+
     def close(self):
         self.active_loop.close()
         self.audit_service.close()
-        pass
+        self.guild_audit_service.close()
+        self.group_reconciler.close()
+        self.user_service.close()
+        self.guild_cache.close()
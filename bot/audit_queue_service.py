@@ -0,0 +1,92 @@
+import logging
+import threading
+from typing import Callable, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+
+import bot.gwapi as gw2api
+from bot.db import DurableQueue, Lateness
+from .audit_run import AuditRun
+from .util import WorkerMetrics, WorkerPool
+
+LOG = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+AUDIT_RETRY_DELAY = 60  # seconds before an audit that was not possible is retried, doubled with every further attempt
+
+
+class AuditQueueService(Generic[T]):
+    """
+    Common part of the user and the guild audit: an audit queue kept in the database, so it survives reconnects, worked off by a pool of workers,
+    and at most one full audit run at a time, whose progress is counted as the queued audits finish.
+    """
+
+    def __init__(self, kind: str, audit_queue: DurableQueue[T]):
+        self._kind = kind
+        self._audit_queue = audit_queue
+        # the full audit triggered by hand or on schedule, at most one at a time
+        self._audit_run: Optional[AuditRun] = None
+        self._audit_run_lock = threading.Lock()
+        self._worker_pool: Optional[WorkerPool] = None
+
+    def pending_audits(self) -> int:
+        return self._audit_queue.qsize()
+
+    def oldest_pending_audit_age(self) -> float:
+        """Seconds the longest waiting audit is queued"""
+        return self._audit_queue.oldest_age()
+
+    def audit_lateness(self) -> Dict[int, Lateness]:
+        """How late audits started compared to their deadline, by priority. Audits without a deadline are only counted as started."""
+        return self._audit_queue.lateness()
+
+    def worker_metrics(self) -> List[WorkerMetrics]:
+        return self._worker_pool.metrics()
+
+    def audit_run(self) -> Optional[AuditRun]:
+        """The running or last full audit"""
+        return self._audit_run
+
+    def _start_workers(self, name: str, work: Callable[[T], bool], size: int):
+        # the workers share the request budget of the gw2 api and the ts connection budget, so they can not overload either
+        self._worker_pool = WorkerPool(name, self._audit_queue, work, size=size, paused=gw2api.circuit_breaker.is_open)
+        self._worker_pool.start()
+
+    def _requeue_rejected(self, key: Hashable) -> bool:
+        """Puts back an audit the circuit breaker rejected. The gw2 api was not asked, so it does not count as an attempt."""
+        LOG.info("GW2 API is considered unavailable. Requeueing %s audit of %s.", self._kind, key)
+        self._audit_queue.skip_attempt()
+        return False
+
+    def _record_audit_run(self, key: Hashable, success: bool):
+        audit_run = self._audit_run
+        if audit_run is not None:
+            # a follow up audit queued meanwhile is still part of the run
+            self._audit_queue.when_done(lambda: audit_run.record(key, success))
+
+    def _trigger_audit_run(self, queue_audits: Callable[[AuditRun], None]) -> Tuple[AuditRun, bool]:
+        """
+        Starts a full audit queueing its audits with queue_audits, unless one is still running.
+        returns: the running audit and whether it was started by this call
+        """
+        with self._audit_run_lock:
+            if self._audit_run is not None and self._audit_run.running:
+                LOG.info("Full %s audit is already running, not starting another one", self._kind)
+                return self._audit_run, False
+            self._audit_run = AuditRun(self._kind)
+            audit_run = self._audit_run
+        threading.Thread(name=f"Full{self._kind.capitalize()}Audit", target=self._run_audit, args=(audit_run, queue_audits), daemon=True).start()
+        return audit_run, True
+
+    @staticmethod
+    def _run_audit(audit_run: AuditRun, queue_audits: Callable[[AuditRun], None]):
+        try:
+            queue_audits(audit_run)
+        finally:
+            audit_run.queueing_finished()
+
+    def close(self):
+        if self._worker_pool is not None:
+            self._worker_pool.close()
+        self._audit_queue.close()  # wakes waiting workers, claims nothing new
+        if self._worker_pool is not None:
+            self._worker_pool.join()
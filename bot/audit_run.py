@@ -0,0 +1,85 @@
+import logging
+import threading
+from typing import Hashable, Optional
+
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class AuditRun:
+    """
+    Progress of one full audit.
+    The run knows the keys it queued and counts them once their audit finished or failed.
+    It is finished once all keys are queued and counted.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.started_at = time.time()
+        self._finished_at: Optional[float] = None
+
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._queued = 0
+        self._done = 0
+        self._failed = 0
+        self._queueing = True
+
+    def add(self, key: Hashable):
+        with self._lock:
+            if key not in self._pending:
+                self._pending.add(key)
+                self._queued += 1
+
+    def queueing_finished(self):
+        with self._lock:
+            self._queueing = False
+            self._check_finished()
+        LOG.info("All %s audits of the %s audit run are queued.", self._queued, self.kind)
+
+    def record(self, key: Hashable, success: bool):
+        with self._lock:
+            if key not in self._pending:
+                return  # not part of this run, e.g. an audit on join
+            self._pending.discard(key)
+            if success:
+                self._done += 1
+            else:
+                self._failed += 1
+            self._check_finished()
+
+    @property
+    def running(self) -> bool:
+        with self._lock:
+            return self._finished_at is None
+
+    def progress(self) -> dict:
+        with self._lock:
+            end = self._finished_at or time.time()
+            processed = self._done + self._failed
+            throughput = processed / max(end - self.started_at, 1) * 60  # per minute
+            remaining = len(self._pending)
+            if self._finished_at is not None:
+                eta = 0
+            elif throughput > 0 and not self._queueing:
+                eta = round(remaining / throughput * 60)
+            else:
+                eta = None  # unknown, until something was processed and the run size is known
+            return {
+                "kind": self.kind,
+                "running": self._finished_at is None,
+                "started_at": self.started_at,
+                "finished_at": self._finished_at,
+                "queued": self._queued,
+                "done": self._done,
+                "failed": self._failed,
+                "throughput_per_minute": round(throughput, 2),
+                "eta_seconds": eta,
+            }
+
+    def _check_finished(self):
+        if not self._queueing and len(self._pending) == 0 and self._finished_at is None:
+            self._finished_at = time.time()
+            LOG.info("%s audit run finished: %s done, %s failed in %.0f seconds.",
+                     self.kind, self._done, self._failed, self._finished_at - self.started_at)
@@ -2,18 +2,25 @@ from __future__ import annotations
 
 import datetime
 import logging
+import math
+import random
 import threading
-import time
+from collections import defaultdict
 from dataclasses import dataclass, field
 from datetime import date
-from queue import Empty, PriorityQueue
+from typing import Dict, Optional, Tuple
+
+import time
 
 from bot.TS3Auth import AuthRequest, AuthorizationNotPossibleError
 from bot.config import Config
 from bot.connection_pool import ConnectionPool
-from bot.db import ThreadSafeDBConnection
+from bot.db import DurableQueue, ThreadSafeDBConnection
 from bot.ts import TS3Facade, User
-from .user_service import UserService
+from .audit_queue_service import AUDIT_RETRY_DELAY, AuditQueueService
+from .audit_run import AuditRun
+from .guild_cache import GuildCache
+from .user_service import UserService, next_audit_at
 from .util import ClosableLoopingThread
 
 LOG = logging.getLogger(__name__)
@@ -24,137 +31,287 @@ QUEUE_PRIORITY_AUDIT = 100
 QUEUE_PRIORITY_JOIN = 20
 QUEUE_PRIORITY_HIDE_UNHIDE_GUILD = 15
 
+# Seconds after queueing by which an audit of each priority should have started. Periodic audits are due at the next_audit_at of the account instead.
+QUEUE_DEADLINES = {
+    QUEUE_PRIORITY_JOIN: 5 * 60,
+    QUEUE_PRIORITY_HIDE_UNHIDE_GUILD: 60,
+}
+# Share of the audits each priority gets at least, even if more urgent audits are waiting
+QUEUE_MIN_SHARES = {
+    QUEUE_PRIORITY_AUDIT: 0.2,
+    QUEUE_PRIORITY_JOIN: 0.2,
+    QUEUE_PRIORITY_HIDE_UNHIDE_GUILD: 0.1,
+}
+QUEUE_AGING = 1 / 60  # priority gained per second of waiting, a periodic audit overtakes new join audits after 80 minutes
+
+AUDIT_SCHEDULER_TICK = 60  # seconds between two runs of the audit scheduler
+AUDIT_LEASE = 60 * 60  # seconds after which a queued, but unfinished audit is due again
+AUDIT_CATCH_UP_FACTOR = 2  # how much faster than the steady rate overdue audits may be queued
+AUDIT_MAX_ATTEMPTS = 5  # attempts after which an audit that is not possible is postponed
+AUDIT_POSTPONE = 24 * 60 * 60  # seconds an audit is postponed after its last attempt
+
 
 @dataclass(order=True)
 class AuditQueueEntry:
     priority: int
     account_name: str = field(compare=False)
-    api_key: str = field(compare=False)
-    client_unique_id: str = field(compare=False)
 
 
-class AuditService:
+class AuditService(AuditQueueService[AuditQueueEntry]):
     def __init__(self, database_connection_pool: ThreadSafeDBConnection, ts_connection_pool: ConnectionPool[TS3Facade],
-                 config: Config, user_service: UserService):
+                 config: Config, user_service: UserService, guild_cache: GuildCache, ts_budget: threading.Semaphore):
         self._user_service = user_service
+        self._guild_cache = guild_cache
         self._database_connection = database_connection_pool
         self._ts_connection_pool = ts_connection_pool
         self._config = config
+        self._ts_budget = ts_budget  # limits the ts connections used by audits, shared with the guild audit
+        # time of the last successful audit by account name, joins within the cooldown are not audited again
+        self._last_audits: Dict[str, float] = {}
+        self._last_audits_lock = threading.Lock()
+        self._load_last_audits()
+
+        # one entry per account, queueing again only raises the priority of the pending audit.
+        super().__init__("user", DurableQueue(database_connection_pool, "account", AuditQueueEntry, key=lambda entry: entry.account_name,
+                                              aging=QUEUE_AGING, min_shares=QUEUE_MIN_SHARES, retry_delay=AUDIT_RETRY_DELAY))
 
-        self._audit_queue: PriorityQueue[AuditQueueEntry] = PriorityQueue()  # pylint: disable=unsubscriptable-object
         self._start_audit_queue_worker()
+        self._start_audit_scheduler()
 
-    def queue_user_audit(self, priority: int, account_name: str, api_key: str, client_unique_id: str):
-        queue_entry = AuditQueueEntry(priority, account_name=account_name, api_key=api_key,
-                                      client_unique_id=client_unique_id)
-        LOG.debug("Adding entry to audit queue for : %s", account_name)
-        self._audit_queue.put(queue_entry)
+    def queue_account_audit(self, priority: int, account_name: str, deadline: Optional[float] = None):
+        """deadline: unix timestamp the audit should have started by, by default the due date of the account or the deadline of the priority"""
+        if deadline is None:
+            deadline = time.time() + QUEUE_DEADLINES[priority] if priority in QUEUE_DEADLINES else self._due_date(account_name)
+        queue_entry = AuditQueueEntry(priority, account_name=account_name)
+        if self._audit_queue.put(queue_entry, deadline=deadline):
+            LOG.debug("Adding entry to audit queue for : %s", account_name)
+        else:
+            LOG.debug("Audit of %s is already queued or running, not queueing it again.", account_name)
 
-    def _start_audit_queue_worker(self):
-        queue = self._audit_queue
+    def _due_date(self, account_name: str) -> Optional[float]:
+        with self._database_connection.lock:
+            return self._database_connection.cursor.execute("SELECT min(next_audit_at) FROM users WHERE account_name = ?", (account_name,)).fetchone()[0]
 
-        def worker():
-            item = None
-            try:
-                item = queue.get(timeout=5)
-                LOG.debug('Working on %s (%s):', item.account_name, item.client_unique_id)
-                self.audit_user(item.account_name, item.api_key, item.client_unique_id)
-            except Empty:
-                return  # empty
-            except BaseException as ex:  # any error that occurs
-                LOG.error("Exception during Audit Queue processing of item: %s.", item, exc_info=ex)
-                queue.task_done()  # finish job anyways
-                LOG.info("Remaining Queue Size: %s", queue.qsize())
-            else:
-                LOG.debug('Finished %s', item.account_name)
-                queue.task_done()
-                LOG.info("Remaining Queue Size: %s", queue.qsize())
+    def _load_last_audits(self):
+        with self._database_connection.lock:
+            rows = self._database_connection.cursor.execute(
+                "SELECT account_name, max(last_audit_date) FROM users WHERE last_audit_date IS NOT NULL GROUP BY account_name").fetchall()
+        with self._last_audits_lock:
+            for account_name, last_audit_date in rows:
+                if isinstance(last_audit_date, str):
+                    last_audit_date = date.fromisoformat(last_audit_date)
+                # only the day is known, assume the start of it
+                self._last_audits[account_name] = datetime.datetime.combine(last_audit_date, datetime.time()).timestamp()
 
-        # start worker - in theory there could be more than one thread, but this will cause stress on the gw2-api, database and teamspeak
-        self.audit_thread = ClosableLoopingThread(name="AuditQueueWorker", work=worker)
-        self.audit_thread.start()
-        LOG.info("Audit Worker is started and pulling audit jobs")
+    def _recently_audited(self, account_name: str) -> bool:
+        cooldown = self._config.join_audit_cooldown * 60 * 60
+        with self._last_audits_lock:
+            last_audit = self._last_audits.get(account_name)
+        return last_audit is not None and last_audit + cooldown > time.time()
 
-    def audit_user(self, account_name, api_key, client_unique_id):
+    def _start_audit_queue_worker(self):
+        self._start_workers("AuditQueueWorker", self._audit_queue_entry, self._config.audit_workers)
+
+    def _audit_queue_entry(self, item: AuditQueueEntry) -> bool:
+        LOG.debug('Working on %s:', item.account_name)
         try:
-            auth = AuthRequest(api_key, self._config.required_servers, int(self._config.required_level))
+            if not self.audit_account(item.account_name):
+                if self._audit_queue.attempts() >= AUDIT_MAX_ATTEMPTS:
+                    self._postpone_audit(item.account_name)
+                    self._record_audit_run(item.account_name, False)
+                    return True
+                LOG.info("Requeueing audit of %s, it will be retried later.", item.account_name)
+                return False
+        except AuthorizationNotPossibleError:  # only raised if the circuit breaker rejected the requests
+            return self._requeue_rejected(item.account_name)
+        except BaseException:
+            self._record_audit_run(item.account_name, False)
+            raise
+        self._record_audit_run(item.account_name, True)
+        LOG.debug('Finished %s', item.account_name)
+        return True
+
+    def _postpone_audit(self, account_name: str):
+        LOG.warning("Audit of %s was not possible %s times, postponing it.", account_name, self._audit_queue.attempts())
+        with self._database_connection.lock:
+            self._database_connection.cursor.execute("UPDATE users SET next_audit_at = ? WHERE account_name = ?", (time.time() + AUDIT_POSTPONE, account_name))
+            self._database_connection.conn.commit()
+
+    def audit_account(self, account_name: str) -> bool:
+        """
+        Audits all teamspeak identities linked to an account.
+        Identities registered with the same api key share one request to the gw2 api.
+        returns: False if the audit was not possible, because the gw2 api is currently unavailable
+        raises: AuthorizationNotPossibleError if the circuit breaker rejected the requests to the gw2 api
+        """
+        with self._database_connection.lock:
+            identities = self._database_connection.cursor.execute("SELECT ts_db_id, api_key FROM users WHERE account_name = ?", (account_name,)).fetchall()
+
+        identities_by_api_key = defaultdict(list)
+        for client_unique_id, api_key in identities:
+            identities_by_api_key[api_key].append(client_unique_id)
+
+        next_audit = next_audit_at(self._config.audit_period)  # identities of an account stay audited together
+        for api_key, client_unique_ids in identities_by_api_key.items():
+            try:
+                auth = AuthRequest(api_key, self._config.required_servers, int(self._config.required_level), guild_cache=self._guild_cache)
+            except AuthorizationNotPossibleError as ex:
+                if ex.circuit_open:
+                    raise
+                LOG.warning("Audit of user %s is currently not possible.", account_name, exc_info=ex)
+                return False
+
+            for client_unique_id in client_unique_ids:
+                self._apply_audit(account_name, client_unique_id, auth, next_audit)
             if auth.success:
-                LOG.info("User %s is still on %s. Successful audit!", auth.name, auth.world.get("name"))
-                with self._ts_connection_pool.item() as ts_facade:
-                    self._user_service.update_guild_tags(ts_facade, User(ts_facade, unique_id=client_unique_id), auth)
-                with self._database_connection.lock:
-                    self._database_connection.cursor.execute(
-                        "UPDATE users SET last_audit_date = ?, account_name = ? WHERE ts_db_id= ?",
-                        (date.today(), auth.name, client_unique_id))
-                    self._database_connection.conn.commit()
+                self.record_audit(account_name)
+        return True
+
+    def record_audit(self, account_name: str):
+        """Remembers a successful audit or verification of the account, joins within the cooldown are not audited again"""
+        with self._last_audits_lock:
+            self._last_audits[account_name] = time.time()
+
+    def _apply_audit(self, account_name: str, client_unique_id: str, auth: AuthRequest, next_audit: float):
+        if auth.success:
+            LOG.info("User %s is still on %s. Successful audit!", auth.name, auth.world.get("name"))
+            if self._user_service.guild_tags_up_to_date(client_unique_id, auth):
+                LOG.debug("Guilds of %s (%s) did not change, no group changes needed.", account_name, client_unique_id)
             else:
-                LOG.info("User %s verification was not successful. Removing access....", account_name)
+                self._update_guild_tags(account_name, client_unique_id, auth)
+            self._user_service.record_audit(client_unique_id, auth.name, date.today(), next_audit)
+        else:
+            LOG.info("User %s verification was not successful. Removing access....", account_name)
+            with self._ts_budget:
                 self._user_service.remove_permissions(client_unique_id)
-                self._user_service.remove_user_from_db(client_unique_id)
-        except AuthorizationNotPossibleError as ex:
-            LOG.warning("Audit of user %s is currently not possible. Skipping.", account_name, exc_info=ex)
+            self._user_service.remove_user_from_db(client_unique_id)
 
-    def trigger_user_audit(self):
-        LOG.info("Auditing users")
-        threading.Thread(name="FullAudit", target=self._audit_users, daemon=True).start()
+    def _update_guild_tags(self, account_name: str, client_unique_id: str, auth: AuthRequest):
+        with self._ts_budget, self._ts_connection_pool.item() as ts_facade:
+            if ts_facade.client_db_id_from_uid(client_unique_id) is None:
+                LOG.info("User %s (%s) is not found in TS DB and could be deleted.", account_name, client_unique_id)
+            else:
+                self._user_service.update_guild_tags(ts_facade, User(ts_facade, unique_id=client_unique_id), auth)
+
+    def _start_audit_scheduler(self):
+        self._schedule_unscheduled_users()
+        self.scheduler_thread = ClosableLoopingThread(name="AuditScheduler", work=self._audit_scheduler_tick)
+        self.scheduler_thread.start()
+        LOG.info("Audit Scheduler is started")
 
-    def _audit_users(self):
+    def _schedule_unscheduled_users(self):
+        """Spreads the audits of users without a due date (e.g. after the upgrade) evenly over one audit period"""
+        now = time.time()
+        period = self._config.audit_period * 24 * 60 * 60
+        with self._database_connection.lock:
+            unscheduled = self._database_connection.cursor.execute("SELECT ts_db_id FROM users WHERE next_audit_at IS NULL").fetchall()
+            if len(unscheduled) > 0:
+                LOG.info("Scheduling audits for %s users without a due date.", len(unscheduled))
+                self._database_connection.cursor.executemany("UPDATE users SET next_audit_at = ? WHERE ts_db_id = ?",
+                                                             [(now + random.uniform(0, period), ts_db_id) for (ts_db_id,) in unscheduled])
+                self._database_connection.conn.commit()
+
+    def _audit_scheduler_tick(self):
+        try:
+            if self._config.enable_verification:
+                self._queue_due_users()
+        except BaseException as ex:  # keep scheduling, the next tick may succeed
+            LOG.error("Exception during audit scheduling.", exc_info=ex)
+        time.sleep(AUDIT_SCHEDULER_TICK)
+
+    def _queue_due_users(self):
+        """
+        Queues the users whose audit is due, but not more than the steady rate of all users per audit period allows (plus some catch up).
+        This keeps the load on the gw2 api and teamspeak as well as the queue depth flat.
+        """
+        now = time.time()
+        period = self._config.audit_period * 24 * 60 * 60
+        with self._database_connection.lock:
+            account_count = self._database_connection.cursor.execute("SELECT count(DISTINCT account_name) FROM users").fetchone()[0]
+        steady_rate = account_count * AUDIT_SCHEDULER_TICK / period
+        # only periodic audits count, a burst of joins must not hold them back
+        limit = math.ceil(steady_rate * AUDIT_CATCH_UP_FACTOR) - self._audit_queue.qsize(priority=QUEUE_PRIORITY_AUDIT)
+        if limit <= 0:
+            return
+
+        with self._database_connection.lock:
+            due_accounts = self._database_connection.cursor.execute(
+                "SELECT account_name, min(next_audit_at) AS due FROM users WHERE next_audit_at <= ? GROUP BY account_name ORDER BY due LIMIT ?",
+                (now, limit)).fetchall()
+            # the audit sets the actual next date, this only keeps them from being queued twice
+            self._database_connection.cursor.executemany("UPDATE users SET next_audit_at = ? WHERE account_name = ?",
+                                                         [(now + AUDIT_LEASE, account_name) for account_name, _ in due_accounts])
+            self._database_connection.conn.commit()
+
+        if len(due_accounts) > 0:
+            LOG.info("Queueing Audit for %s due Accounts.", len(due_accounts))
+        for account_name, due in due_accounts:
+            LOG.info("Account %s is due for auditing! Queueing", account_name)
+            self.queue_account_audit(QUEUE_PRIORITY_AUDIT, account_name, deadline=due)
+
+    def trigger_user_audit(self) -> Tuple[AuditRun, bool]:
+        """
+        Starts a full audit, unless one is still running.
+        returns: the running audit and whether it was started by this call
+        """
+        return self._trigger_audit_run(self._queue_overdue_accounts)
+
+    def _queue_overdue_accounts(self, audit_run: Optional[AuditRun] = None):
         if not self._config.enable_verification:
             LOG.debug("Verification is disabled, skipping audit.")
             return
+        LOG.info("Auditing users")
 
         current_audit_date = datetime.date.today()  # Update current date everytime run
         last_acceptable_audit_date = datetime.date.today() - datetime.timedelta(days=self._config.audit_period)
 
         with self._database_connection.lock:
             db_audit_list = self._database_connection.cursor.execute(
-                'SELECT * FROM users where last_audit_date == null or last_audit_date <= ?',
+                'SELECT ts_db_id, account_name, last_audit_date FROM users where last_audit_date is null or last_audit_date <= ?',
                 (last_acceptable_audit_date,)).fetchall()
 
-        LOG.info("Queueing Audit for %s Users.", len(db_audit_list))
-        for audit_user in db_audit_list:
-            # Convert to single variables
-            audit_ts_id = audit_user[0]
-            audit_account_name = audit_user[1]
-            audit_api_key = audit_user[2]
-            # audit_created_date = audit_user[3]
-            audit_last_audit_date = audit_user[4]
-
-            LOG.debug("Queueing Audit: User: %s | TS Id: %s | Last Audit: %s", audit_account_name, audit_ts_id,
-                      audit_last_audit_date)
-
-            with self._ts_connection_pool.item() as ts_connection:
-                ts_uuid = ts_connection.client_db_id_from_uid(audit_ts_id)
-            if ts_uuid is None:
-                LOG.info("User %s is not found in TS DB and could be deleted.", audit_account_name)
-                with self._database_connection.lock:
-                    self._database_connection.cursor.execute("UPDATE users SET last_audit_date = ? WHERE ts_db_id= ?",
-                                                             ((datetime.date.today()), audit_ts_id,))
-                # self.removeUserFromDB(audit_ts_id)
-            else:
-                LOG.info("User %s is due for auditing! Queueing", audit_account_name)
-                self.queue_user_audit(QUEUE_PRIORITY_AUDIT, audit_account_name, audit_api_key, audit_ts_id)
-                time.sleep(2)  # sleep 2s due to api rate limiting, so we delay queueing
+        # resolve all identities at once, instead of asking teamspeak for each one
+        with self._ts_budget, self._ts_connection_pool.item() as ts_connection:
+            known_client_db_ids = ts_connection.client_db_ids_by_uid()
+
+        missing = [(audit_ts_id, audit_account_name) for audit_ts_id, audit_account_name, _ in db_audit_list if audit_ts_id not in known_client_db_ids]
+        if len(missing) > 0:
+            LOG.info("%s Users are not found in TS DB and could be deleted: %s", len(missing), ", ".join(account_name for _, account_name in missing))
+            with self._database_connection.lock:
+                self._database_connection.cursor.executemany("UPDATE users SET last_audit_date = ?, next_audit_at = ? WHERE ts_db_id= ?",
+                                                             [(current_audit_date, next_audit_at(self._config.audit_period), audit_ts_id) for audit_ts_id, _ in missing])
+                self._database_connection.conn.commit()
+
+        due_accounts = {}
+        for audit_ts_id, audit_account_name, audit_last_audit_date in db_audit_list:
+            if audit_ts_id in known_client_db_ids:
+                due_accounts.setdefault(audit_account_name, audit_last_audit_date)
+
+        LOG.info("Queueing Audit for %s Accounts.", len(due_accounts))
+        for audit_account_name, audit_last_audit_date in due_accounts.items():
+            LOG.debug("Queueing Audit: Account: %s | Last Audit: %s", audit_account_name, audit_last_audit_date)
+            if audit_run is not None:
+                audit_run.add(audit_account_name)
+            self.queue_account_audit(QUEUE_PRIORITY_AUDIT, audit_account_name)
 
         with self._database_connection.lock:
             self._database_connection.cursor.execute('INSERT INTO bot_info (last_succesful_audit) VALUES (?)',
                                                      (current_audit_date,))
+            self._database_connection.conn.commit()
 
     def audit_user_on_join(self, client_unique_id):
         db_entry = self._user_service.get_user_database_entry(client_unique_id)
         if db_entry is not None:
-            account_name = db_entry["account_name"]
-            api_key = db_entry["api_key"]
-            self.queue_user_audit(QUEUE_PRIORITY_JOIN, account_name=account_name, api_key=api_key,
-                                  client_unique_id=client_unique_id)
+            if self._recently_audited(db_entry["account_name"]):
+                LOG.debug("Account %s was audited recently, skipping audit on join.", db_entry["account_name"])
+                return
+            self.queue_account_audit(QUEUE_PRIORITY_JOIN, account_name=db_entry["account_name"])
 
     def audit_user_on_hide_unhide_guild(self, client_unique_id):
         db_entry = self._user_service.get_user_database_entry(client_unique_id)
         if db_entry is not None:
-            account_name = db_entry["account_name"]
-            api_key = db_entry["api_key"]
-            self.queue_user_audit(QUEUE_PRIORITY_HIDE_UNHIDE_GUILD, account_name=account_name, api_key=api_key,
-                                  client_unique_id=client_unique_id)
+            self.queue_account_audit(QUEUE_PRIORITY_HIDE_UNHIDE_GUILD, account_name=db_entry["account_name"])
 
     def close(self):
-        self.audit_thread.close()
+        self.scheduler_thread.close()
+        super().close()
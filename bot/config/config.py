@@ -51,8 +51,16 @@ class Config:
         self.db_file_name = configs.get("bot settings", "db_file_name")
         self.audit_period = int(
             configs.get("bot settings", "audit_period"))  # How long a single user can go without being audited
-        self.audit_interval = int(configs.get("bot settings", "audit_interval"))  # how often the BOT audits all users
         self.client_restriction_limit = int(configs.get("bot settings", "client_restriction_limit"))
+        # How long guild details from the gw2 api are considered fresh (seconds). Older entries are refreshed in the background.
+        self.guild_cache_ttl = int(self._try_get(configs, "bot settings", "guild_cache_ttl", 60 * 60 * 24))
+        self.join_audit_cooldown = float(self._try_get(configs, "bot settings", "join_audit_cooldown", 12))
+        self.audit_workers = int(self._try_get(configs, "bot settings", "audit_workers", 4))
+        self.guild_audit_workers = int(self._try_get(configs, "bot settings", "guild_audit_workers", 1))
+        self.guild_audit_full_every = int(self._try_get(configs, "bot settings", "guild_audit_full_every", 4))
+        self.audit_ts_connections = int(self._try_get(configs, "bot settings", "audit_ts_connections", 2))
+        self.gw2_api_rate_limit = float(self._try_get(configs, "bot settings", "gw2_api_rate_limit", 5))
+        self.servergroup_cache_ttl = int(self._try_get(configs, "bot settings", "servergroup_cache_ttl", 300))
 
         # tryGet(config, section, key, default = None, lit_eval = False):
         self.purge_completely = self._try_get(configs, "bot settings", "purge_completely", False, True)
@@ -83,6 +91,7 @@ class Config:
         self.guilds_minimum_talk_power = int(configs.get("guilds", "minimum_talk_power"))
         self.guilds_maximum_talk_power = int(configs.get("guilds", "maximum_talk_power"))
         self.guilds_sort_id = int(configs.get("guilds", "guild_sort_id"))
+        self.guilds_sort_id_range = int(self._try_get(configs, "guilds", "guild_sort_id_range", 100))
         self.guild_contact_channel_group = configs.get("guilds", "guild_contact_channel_group")
 
         # Constants
@@ -1,3 +1,5 @@
 from .database import ThreadSafeDBConnection, get_or_create_database
+from .durable_queue import DurableQueue, Lateness
+from .write_buffer import WriteBuffer
 
-__all__ = ["ThreadSafeDBConnection", "get_or_create_database"]
+__all__ = ["ThreadSafeDBConnection", "get_or_create_database", "DurableQueue", "Lateness", "WriteBuffer"]
@@ -15,6 +15,7 @@ def get_or_create_database(db_file_path: str, version: str):
         dbc = ThreadSafeDBConnection(db_file_path)
         LOG.info("No User Database found...created new database!")
         _initialize_database(dbc, version)
+    _migrate_database(dbc)
     return dbc
 
 
@@ -49,6 +50,64 @@ def _initialize_database(dbc, version):
         dbc.conn.commit()
 
 
+def _migrate_database(dbc):
+    """
+    Adds tables that were introduced after the initial schema.
+    Every statement has to be idempotent, as this runs on each start.
+    """
+    with dbc.lock:
+        # GUILD CACHE (gw2 api guild details)
+        dbc.cursor.execute('''CREATE TABLE IF NOT EXISTS guild_cache(
+                            gw2_guild_id text primary key,
+                            name text,
+                            tag text,
+                            emblem text,
+                            fetched_at real)''')
+        dbc.cursor.execute("CREATE INDEX IF NOT EXISTS guild_cache_name ON guild_cache(lower(name))")
+
+        # USERS: point in time (unix timestamp) when the next audit of a user is due, NULL until scheduled
+        _add_column_if_missing(dbc, "users", "next_audit_at", "real")
+        dbc.cursor.execute("CREATE INDEX IF NOT EXISTS users_next_audit_at ON users(next_audit_at)")
+
+        # AUDIT QUEUE (pending user and guild audits, see DurableQueue)
+        # not_before: retried items wait until then. followup_*: put while the item was being processed, queued again once it is done
+        dbc.cursor.execute('''CREATE TABLE IF NOT EXISTS audit_queue(
+                            kind text,
+                            key text,
+                            priority integer,
+                            payload text,
+                            enqueued_at real,
+                            lease_until real,
+                            attempts integer,
+                            deadline real,
+                            not_before real,
+                            followup_priority integer,
+                            followup_payload text,
+                            followup_deadline real,
+                            PRIMARY KEY(kind, key))''')
+        dbc.cursor.execute("CREATE INDEX IF NOT EXISTS audit_queue_order ON audit_queue(kind, priority, enqueued_at)")
+
+        # GUILDS: position of the guild group in the sorted guild groups, see GuildService
+        _add_column_if_missing(dbc, "guilds", "sort_key", "integer")
+        # GUILDS: fingerprint of everything the last successful audit of the guild was based on
+        _add_column_if_missing(dbc, "guilds", "audit_fingerprint", "text")
+
+        # USER GUILDS (gw2 guilds of each identity at the last audit and the guild groups the bot applied for them)
+        dbc.cursor.execute('''CREATE TABLE IF NOT EXISTS user_guilds(
+                            ts_db_id text primary key,
+                            guild_ids text,
+                            ts_groups text,
+                            updated_at real)''')
+        dbc.conn.commit()
+
+
+def _add_column_if_missing(dbc, table: str, column: str, column_type: str):
+    columns = [row[1] for row in dbc.cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+    if column not in columns:
+        LOG.info("Adding column %s to table %s", column, table)
+        dbc.cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
 class ThreadSafeDBConnection:
     def __init__(self, db_name):
         self.db_name = db_name
@@ -0,0 +1,327 @@
+import dataclasses
+from dataclasses import dataclass
+import json
+import logging
+import threading
+from collections import deque
+from queue import Empty
+from typing import Callable, Deque, Dict, Generic, Hashable, List, Optional, Tuple, Type, TypeVar
+
+import time
+
+from .database import ThreadSafeDBConnection
+
+LOG = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@dataclass
+class Lateness:
+    """How late items of one priority were started compared to their deadline"""
+    started: int = 0
+    late: int = 0
+    total_seconds: float = 0.0  # sum of the lateness of all late items
+    max_seconds: float = 0.0
+
+
+class DurableQueue(Generic[T]):
+    """
+    Priority queue stored in the audit_queue table, so pending work survives reconnects and restarts.
+    Items are dataclasses with a `priority` field, lower priorities are handled first.
+
+    There is at most one row per key. Putting a key that is already pending only raises its priority, unless a `merge` function
+    is given, which combines the pending item with the new one (the result should keep the more urgent priority).
+    Workers claim a batch of rows at once by leasing them, the lease is renewed once a worker starts on a row. A put for a claimed row
+    no worker started on, or one more urgent than the claimed rows, releases the batch, so the put is applied and sorted in. Claimed rows whose
+    lease expired and that were handed out again meanwhile are dropped. A row is deleted on task_done; if the process dies before,
+    the lease expires and the row is handed out again. Puts by others for a leased row are kept as a follow up, which is
+    queued once the worker is done, so changes during the processing are not lost. Only the worker processing a row may put it back.
+
+    Waiting items age: every second waited lowers their effective priority by `aging`, so a steady stream of urgent items
+    can not starve the others. In addition, each priority in `min_shares` is guaranteed that share of every claimed batch.
+    Items may have a deadline, how late they are started is recorded per priority.
+    An item put back by its worker is handed out again after `retry_delay` seconds, doubled with every further attempt,
+    unless the worker skipped the attempt.
+
+    Supports the parts of queue.Queue used by the WorkerPool.
+    """
+
+    def __init__(self, database: ThreadSafeDBConnection, kind: str, item_type: Type[T], key: Callable[[T], Hashable],
+                 batch_size: int = 10, lease: float = 5 * 60, aging: float = 0.0, min_shares: Optional[Dict[int, float]] = None,
+                 retry_delay: float = 0.0, max_retry_delay: float = 60 * 60, merge: Optional[Callable[[T, T], T]] = None):
+        self._database = database
+        self._kind = kind
+        self._item_type = item_type
+        self._key = key
+        self._batch_size = batch_size
+        self._lease = lease
+        self._aging = aging
+        self._min_shares = min_shares or {}
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._merge = merge
+
+        self._claimed: Deque[Tuple[T, Optional[float], int, float]] = deque()  # leased, but not yet taken by a worker, with their deadline, attempts and lease
+        self._lateness: Dict[int, Lateness] = {}
+        # guards the claimed items. Whoever needs both locks takes the database lock first, callers of put() may already hold it.
+        self._not_empty = threading.Condition()
+        self._signals = 0  # counts notifications, so a put between a failed claim and waiting is not missed
+        self._local = threading.local()  # key and attempts of the item the current thread works on, and whether it put it back
+        self._closed = False
+
+    def put(self, item: T, deadline: Optional[float] = None) -> bool:
+        """
+        deadline: unix timestamp the item should be started by. Of several puts for the same key, the earliest deadline counts.
+        returns: True if the item was queued or made an already queued item more urgent (or changed it, when merging)
+        """
+        key = str(self._key(item))
+        merging = self._merge is not None  # then a put that is not more urgent still counts if it changes the pending item
+        with self._database.lock:
+            if getattr(self._local, "key", None) == key:
+                # put back by the worker processing it
+                self._local.requeued = True
+                skipped = getattr(self._local, "skipped", False)  # not an attempt, handed out again right away
+                item = self._merged(key, item, "followup_payload")
+                payload = json.dumps(dataclasses.asdict(item))
+                # a follow up put in the meantime is merged in
+                cursor = self._database.cursor.execute(
+                    "UPDATE audit_queue SET priority = min(?, coalesce(followup_priority, ?)), "
+                    "payload = CASE WHEN followup_priority < ? THEN followup_payload ELSE ? END, "
+                    "deadline = coalesce(min(followup_deadline, deadline), followup_deadline, deadline), "
+                    "followup_priority = NULL, followup_payload = NULL, followup_deadline = NULL, lease_until = NULL, not_before = ?, attempts = attempts - ? "
+                    "WHERE kind = ? AND key = ?",
+                    (item.priority, item.priority, item.priority, payload, None if skipped else time.time() + self._next_retry_delay(), skipped, self._kind, key))
+            else:
+                self._release_claimed_before(key, item.priority)
+                item = self._merged(key, item, "CASE WHEN lease_until IS NULL THEN payload ELSE followup_payload END")
+                payload = json.dumps(dataclasses.asdict(item))
+                cursor = self._database.cursor.execute(
+                    "INSERT INTO audit_queue(kind, key, priority, payload, enqueued_at, lease_until, attempts, deadline) VALUES(?,?,?,?,?,NULL,0,?) "
+                    "ON CONFLICT(kind, key) DO UPDATE SET priority = excluded.priority, payload = excluded.payload, "
+                    "deadline = coalesce(min(excluded.deadline, audit_queue.deadline), excluded.deadline, audit_queue.deadline) "
+                    "WHERE (excluded.priority < audit_queue.priority OR (? AND excluded.payload != audit_queue.payload)) AND audit_queue.lease_until IS NULL",
+                    (self._kind, key, item.priority, payload, time.time(), deadline, merging))
+                if cursor.rowcount == 0:
+                    # being processed, queued again by task_done
+                    cursor = self._database.cursor.execute(
+                        "UPDATE audit_queue SET followup_priority = ?, followup_payload = ?, "
+                        "followup_deadline = coalesce(min(?, followup_deadline), ?, followup_deadline) "
+                        "WHERE kind = ? AND key = ? AND lease_until IS NOT NULL AND "
+                        "(followup_priority IS NULL OR ? < followup_priority OR (? AND ? != followup_payload))",
+                        (item.priority, payload, deadline, deadline, self._kind, key, item.priority, merging, payload))
+            queued = cursor.rowcount > 0
+            self._database.conn.commit()
+
+        if queued:
+            self._notify()
+        return queued
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> T:
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._database.lock, self._not_empty:
+                if self._closed:
+                    raise Empty
+                item = self._take()
+                if item is not None:
+                    return item
+                signals = self._signals
+
+            # claimed without holding the condition, it needs the database lock
+            if self._claim_batch():
+                continue
+
+            with self._not_empty:
+                if self._closed or not block:
+                    raise Empty
+                if self._claimed or self._signals != signals:
+                    continue
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise Empty
+                self._not_empty.wait(remaining)
+
+    def _merged(self, key: str, item: T, column: str) -> T:
+        if self._merge is None:
+            return item
+        row = self._database.cursor.execute(f"SELECT {column} FROM audit_queue WHERE kind = ? AND key = ?", (self._kind, key)).fetchone()
+        if row is None or row[0] is None:
+            return item
+        return self._merge(self._item_type(**json.loads(row[0])), item)
+
+    def _take(self) -> Optional[T]:
+        """Starts on the first claimed item that is still leased by this queue and renews its lease for the worker"""
+        while self._claimed:
+            item, deadline, attempts, lease_until = self._claimed.popleft()
+            key = str(self._key(item))
+            renewed = self._database.cursor.execute("UPDATE audit_queue SET lease_until = ? WHERE kind = ? AND key = ? AND lease_until = ?",
+                                                    (time.time() + self._lease, self._kind, key, lease_until)).rowcount > 0
+            self._database.conn.commit()
+            if renewed:
+                break
+            LOG.debug("Lease of %s queue entry %s expired and it was handed out again, dropping it", self._kind, key)
+        else:
+            return None
+        self._record_lateness(item, deadline)
+        self._local.key = key
+        self._local.attempts = attempts
+        self._local.requeued = False
+        self._local.skipped = False
+        self._local.when_done = None
+        return item
+
+    def get_nowait(self) -> T:
+        return self.get(block=False)
+
+    def attempts(self) -> int:
+        """How often the item the current thread works on was handed out, including this time"""
+        return getattr(self._local, "attempts", 0)
+
+    def skip_attempt(self):
+        """
+        Marks the item the current thread works on as not attempted, e.g. because its work could not even be started.
+        Putting it back then neither counts the attempt nor delays the item.
+        """
+        self._local.skipped = True
+
+    def when_done(self, callback: Callable[[], None]):
+        """Calls back once the item the current thread works on is removed from the queue, not if it is put back or a follow up is queued"""
+        self._local.when_done = callback
+
+    def task_done(self):
+        key = getattr(self._local, "key", None)
+        requeued = getattr(self._local, "requeued", False)
+        when_done = getattr(self._local, "when_done", None)
+        self._local.key = None
+        self._local.when_done = None
+        if key is None or requeued:
+            return
+        with self._database.lock:
+            followup = self._database.cursor.execute(
+                "UPDATE audit_queue SET priority = followup_priority, payload = followup_payload, deadline = followup_deadline, enqueued_at = ?, "
+                "lease_until = NULL, attempts = 0, not_before = NULL, followup_priority = NULL, followup_payload = NULL, followup_deadline = NULL "
+                "WHERE kind = ? AND key = ? AND followup_priority IS NOT NULL", (time.time(), self._kind, key)).rowcount > 0
+            if not followup:
+                self._database.cursor.execute("DELETE FROM audit_queue WHERE kind = ? AND key = ?", (self._kind, key))
+            self._database.conn.commit()
+        if followup:
+            self._notify()
+        elif when_done is not None:
+            when_done()
+
+    def qsize(self, priority: Optional[int] = None) -> int:
+        """
+        Number of pending items, items being processed are only counted if they have a follow up.
+        priority: only count the items of this priority
+        """
+        now = time.time()
+        with self._database.lock:
+            pending = self._database.cursor.execute(
+                "SELECT count(*) FROM audit_queue WHERE kind = ? AND ("
+                "(lease_until IS NULL OR lease_until < ?) AND (? IS NULL OR priority = ?) OR "
+                "followup_priority IS NOT NULL AND (? IS NULL OR followup_priority = ?))",
+                (self._kind, now, priority, priority, priority, priority)).fetchone()[0]
+            with self._not_empty:
+                # claimed items with an expired lease are already counted as pending
+                claimed = sum(1 for item, _, _, lease_until in self._claimed if lease_until >= now and (priority is None or item.priority == priority))
+        return pending + claimed
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def oldest_age(self) -> float:
+        """Seconds the longest waiting item is queued, 0 if the queue is empty"""
+        with self._database.lock:
+            oldest = self._database.cursor.execute("SELECT min(enqueued_at) FROM audit_queue WHERE kind = ?", (self._kind,)).fetchone()[0]
+        return 0.0 if oldest is None else max(time.time() - oldest, 0.0)
+
+    def lateness(self) -> Dict[int, Lateness]:
+        """Lateness of the items started so far, by priority"""
+        with self._not_empty:
+            return {priority: dataclasses.replace(lateness) for priority, lateness in self._lateness.items()}
+
+    def close(self):
+        """
+        Stops handing out items and releases the leases of claimed items no worker started on, so they are handed out right away next time.
+        Workers may still finish the items they are processing.
+        """
+        with self._database.lock:
+            with self._not_empty:
+                self._closed = True
+                self._not_empty.notify_all()
+            self._release_claimed()
+            self._database.conn.commit()
+
+    def _release_claimed_before(self, key: str, priority: int):
+        """
+        Puts the claimed items back, if one of them has the key or the priority is more urgent than theirs.
+        Claimed items no worker started on yet are still pending: a put for them changes the row instead of queueing a follow up
+        and the next claim sorts them in again.
+        """
+        with self._not_empty:
+            if not any(str(self._key(item)) == key or priority < item.priority for item, _, _, _ in self._claimed):
+                return
+        self._release_claimed()
+
+    def _release_claimed(self):
+        """Releases the leases of the claimed items, they were not attempted. The caller holds the database lock and commits."""
+        with self._not_empty:
+            keys = [(self._kind, str(self._key(item)), lease_until) for item, _, _, lease_until in self._claimed]
+            self._claimed.clear()
+        self._database.cursor.executemany("UPDATE audit_queue SET lease_until = NULL, attempts = attempts - 1 WHERE kind = ? AND key = ? AND lease_until = ?",
+                                          keys)
+
+    def _notify(self):
+        with self._not_empty:
+            self._signals += 1
+            self._not_empty.notify()
+
+    def _claim_batch(self) -> bool:
+        now = time.time()
+        claimable = "kind = ? AND (lease_until IS NULL OR lease_until < ?) AND (not_before IS NULL OR not_before <= ?)"
+        effective_priority = "priority - (? - enqueued_at) * ?"
+        with self._database.lock, self._not_empty:
+            if self._closed:
+                return False
+            if self._claimed:
+                return True  # claimed by another worker in the meantime
+            rows: Dict[str, Tuple[float, str, Optional[float], int]] = {}
+            # the guaranteed share of each priority first, oldest items of the priority before newer ones
+            for priority, share in self._min_shares.items():
+                for key, payload, deadline, attempts, effective in self._database.cursor.execute(
+                        f"SELECT key, payload, deadline, attempts, {effective_priority} FROM audit_queue WHERE {claimable} AND priority = ? ORDER BY enqueued_at LIMIT ?",
+                        (now, self._aging, self._kind, now, now, priority, max(1, round(self._batch_size * share)))).fetchall():
+                    rows[key] = (effective, payload, deadline, attempts + 1)
+            # fill up the batch by aged priority
+            for key, payload, deadline, attempts, effective in self._database.cursor.execute(
+                    f"SELECT key, payload, deadline, attempts, {effective_priority} AS effective FROM audit_queue WHERE {claimable} ORDER BY effective, enqueued_at LIMIT ?",
+                    (now, self._aging, self._kind, now, now, self._batch_size)).fetchall():
+                if len(rows) >= self._batch_size:
+                    break
+                rows.setdefault(key, (effective, payload, deadline, attempts + 1))
+
+            self._database.cursor.executemany("UPDATE audit_queue SET lease_until = ?, attempts = attempts + 1 WHERE kind = ? AND key = ?",
+                                              [(now + self._lease, self._kind, key) for key in rows])
+            self._database.conn.commit()
+
+            batch: List[Tuple[float, str, Optional[float], int]] = sorted(rows.values(), key=lambda row: row[0])
+            self._claimed.extend((self._item_type(**json.loads(payload)), deadline, attempts, now + self._lease) for _, payload, deadline, attempts in batch)
+        if rows:
+            LOG.debug("Claimed %s %s queue entries", len(rows), self._kind)
+        return len(rows) > 0
+
+    def _next_retry_delay(self) -> float:
+        if self._retry_delay <= 0:
+            return 0.0
+        return min(self._retry_delay * 2 ** max(self.attempts() - 1, 0), self._max_retry_delay)
+
+    def _record_lateness(self, item: T, deadline: Optional[float]):
+        lateness = self._lateness.setdefault(item.priority, Lateness())
+        lateness.started += 1
+        if deadline is not None and deadline < time.time():
+            late_by = time.time() - deadline
+            lateness.late += 1
+            lateness.total_seconds += late_by
+            lateness.max_seconds = max(lateness.max_seconds, late_by)
+            LOG.debug("%s queue entry %s started %.0f seconds after its deadline", self._kind, self._key(item), late_by)
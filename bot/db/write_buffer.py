@@ -0,0 +1,102 @@
+import logging
+import threading
+from typing import Callable, Hashable, List, Optional, Sequence, Tuple
+
+from bot.util import RepeatTimer
+from .database import ThreadSafeDBConnection
+
+LOG = logging.getLogger(__name__)
+
+MAX_WRITE_ATTEMPTS = 3  # flushes a row may fail before it is dropped, so a broken row can not hold back the others forever
+
+
+class WriteBuffer:
+    """
+    Collects parameter rows for one statement and writes them with executemany in a single transaction,
+    once batch_size rows are collected or every flush_interval seconds.
+    The database lock is only held while writing a whole batch, instead of once per row.
+    If the batch fails, its rows are written one by one and the failing ones are retried with the next flush, up to MAX_WRITE_ATTEMPTS times.
+    Rows with a `key` can be discarded before a newer direct write to the same record, so the buffer does not overwrite it later.
+    """
+
+    def __init__(self, database: ThreadSafeDBConnection, statement: str, batch_size: int = 50, flush_interval: float = 5,
+                 key: Optional[Callable[[Sequence], Hashable]] = None):
+        self._database = database
+        self._statement = statement
+        self._batch_size = batch_size
+        self._key = key
+
+        self._rows: List[Tuple[Sequence, int]] = []  # with the number of failed writes
+        self._rows_lock = threading.Lock()
+
+        self._timer = RepeatTimer(flush_interval, self.flush)
+        self._timer.daemon = True
+        self._timer.name = "WriteBufferFlush"
+        self._timer.start()
+
+    def add(self, row: Sequence):
+        with self._rows_lock:
+            self._rows.append((row, 0))
+            full = len(self._rows) >= self._batch_size
+        if full:
+            self.flush()
+
+    def discard(self, key: Hashable):
+        """
+        Drops the buffered rows with the key. Call it while holding the database lock for the direct write,
+        a flush can not write the rows in between then.
+        """
+        with self._rows_lock:
+            self._rows = [(row, failures) for row, failures in self._rows if self._key(row) != key]
+
+    def flush(self):
+        # the rows are taken while holding the database lock, so a discard() before a direct write can not miss them
+        with self._database.lock:
+            with self._rows_lock:
+                rows, self._rows = self._rows, []
+            if len(rows) == 0:
+                return
+
+            try:
+                self._write([row for row, _ in rows])
+            except Exception as ex:
+                LOG.warning("Writing %s buffered rows at once failed, writing them one by one.", len(rows), exc_info=ex)
+                kept = self._write_one_by_one(rows)
+                with self._rows_lock:
+                    self._rows[:0] = kept
+            else:
+                LOG.debug("Wrote %s buffered rows", len(rows))
+
+    def _write(self, rows: List[Sequence]):
+        # the savepoint limits a rollback to the buffered rows, other pending statements on the shared connection stay untouched
+        self._database.cursor.execute("SAVEPOINT write_buffer")
+        try:
+            self._database.cursor.executemany(self._statement, rows)
+        except BaseException:
+            self._database.cursor.execute("ROLLBACK TO write_buffer")
+            raise
+        finally:
+            self._database.cursor.execute("RELEASE write_buffer")
+        self._database.conn.commit()
+
+    def _write_one_by_one(self, rows: List[Tuple[Sequence, int]]) -> List[Tuple[Sequence, int]]:
+        """
+        Writes each row on its own, so a broken row does not hold back the others.
+        returns: the failed rows to retry with the next flush
+        """
+        kept = []
+        for row, failures in rows:
+            try:
+                self._write([row])
+            except Exception as ex:
+                if failures + 1 >= MAX_WRITE_ATTEMPTS:
+                    LOG.error("Writing buffered row %s failed %s times, dropping it.", row, failures + 1, exc_info=ex)
+                else:
+                    kept.append((row, failures + 1))
+        if kept:
+            LOG.error("Writing %s buffered rows failed, retrying with the next flush.", len(kept))
+        return kept
+
+    def close(self):
+        self._timer.cancel()
+        self.flush()
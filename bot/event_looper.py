@@ -14,6 +14,8 @@ from .TS3Auth import AuthRequest, AuthorizationNotPossibleError
 from .audit_service import AuditService
 from .config import Config
 from .connection_pool import ConnectionPool
+from .guild_cache import GuildCache
+from .guild_registry import GuildRegistry
 from .user_service import UserService
 
 REGISTER_EVENTS = ["textchannel", "textprivate", "server"]
@@ -28,12 +30,16 @@ class EventLooper:
                  ts_connection_pool: ConnectionPool[TS3Facade],
                  config: Config,
                  user_service: UserService,
-                 audit_service: AuditService):
+                 audit_service: AuditService,
+                 guild_cache: GuildCache,
+                 guild_registry: GuildRegistry):
         self._database_connection = database_connection
         self._ts_connection_pool = ts_connection_pool
         self._config = config
         self._user_service = user_service
         self._audit_service = audit_service
+        self._guild_cache = guild_cache
+        self._guild_registry = guild_registry
 
         self._lock = threading.RLock()
 
@@ -183,24 +189,25 @@ class EventLooper:
             if cmd == "hideguild":
                 if len(args) == 1:
                     LOG.info("User '%s' wants to hide guild '%s'.", rec_from_name, args[0])
+                    hidden = False
                     with self._database_connection.lock:
                         try:
                             tag_to_hide = args[0]
-                            result = self._database_connection.cursor.execute(
-                                "SELECT guild_id FROM guilds WHERE ts_group = ?", (tag_to_hide,)).fetchone()
-                            if result is None:
+                            guild = self._guild_registry.by_ts_group(tag_to_hide)
+                            if guild is None:
                                 LOG.debug("Failed. " +
                                           "The group probably doesn't exist or the user is already hiding that group.")
                                 self._ts_facade.send_text_message_to_client(rec_from_id,
                                                                             self._config.locale.get(
                                                                                 "bot_hide_guild_unknown"))
                             else:
-                                guild_db_id = result[0]
+                                guild_db_id = guild.guild_id
                                 self._database_connection.cursor.execute(
                                     "INSERT INTO guild_ignores(guild_id, ts_db_id, ts_name) VALUES(?, ?, ?)",
                                     (guild_db_id, rec_from_uid, rec_from_name))
                                 self._database_connection.conn.commit()
-                                self._audit_service.audit_user_on_hide_unhide_guild(rec_from_uid)
+                                self._user_service.invalidate_hidden_groups(rec_from_uid)
+                                hidden = True
                                 LOG.debug("Success!")
                                 self._ts_facade.send_text_message_to_client(rec_from_id,
                                                                             self._config.locale.get(
@@ -210,21 +217,24 @@ class EventLooper:
                             LOG.error("Database error during hideguild", exc_info=ex)
                             self._ts_facade.send_text_message_to_client(rec_from_id, self._config.locale.get(
                                 "bot_hide_guild_unknown"))
+                    if hidden:
+                        self._audit_service.audit_user_on_hide_unhide_guild(rec_from_uid)
                 else:
                     self._ts_facade.send_text_message_to_client(rec_from_id,
                                                                 self._config.locale.get("bot_hide_guild_help"))
             elif cmd == "unhideguild":
                 if len(args) == 1:
                     LOG.info("User '%s' wants to unhide guild '%s'.", rec_from_name, args[0])
+                    guild = self._guild_registry.by_ts_group(args[0])
                     with self._database_connection.lock:
                         self._database_connection.cursor.execute(
-                            "DELETE FROM guild_ignores WHERE guild_id = (SELECT guild_id FROM guilds WHERE ts_group = ? AND ts_db_id = ?)",
-                            (args[0], rec_from_uid))
+                            "DELETE FROM guild_ignores WHERE guild_id = ? AND ts_db_id = ?",
+                            (guild.guild_id if guild is not None else None, rec_from_uid))
                         changes = self._database_connection.cursor.execute("SELECT changes()").fetchone()[0]
                         self._database_connection.conn.commit()
                         if changes > 0:
                             LOG.debug("Success!")
-                            self._audit_service.audit_user_on_hide_unhide_guild(rec_from_uid)
+                            self._user_service.invalidate_hidden_groups(rec_from_uid)
                             self._ts_facade.send_text_message_to_client(rec_from_id, self._config.locale.get(
                                 "bot_unhide_guild_success"))
                         else:
@@ -232,6 +242,8 @@ class EventLooper:
                                 "Failed. Either the guild is unknown or the user had not hidden the guild anyway.")
                             self._ts_facade.send_text_message_to_client(rec_from_id, self._config.locale.get(
                                 "bot_unhide_guild_unknown"))
+                    if changes > 0:
+                        self._audit_service.audit_user_on_hide_unhide_guild(rec_from_uid)
                 else:
                     self._ts_facade.send_text_message_to_client(rec_from_id, self._config.locale.get(
                         "bot_unhide_guild_help"))
@@ -249,7 +261,7 @@ class EventLooper:
                 if self._user_service.check_client_needs_verify(rec_from_uid):
                     LOG.info("Received verify request from %s", rec_from_name)
                     try:
-                        auth = AuthRequest(uapi, self._config.required_servers, int(self._config.required_level))
+                        auth = AuthRequest(uapi, self._config.required_servers, int(self._config.required_level), guild_cache=self._guild_cache)
 
                         LOG.debug('Name: |%s| API: |%s|', auth.name, uapi)
 
@@ -269,6 +281,7 @@ class EventLooper:
                                 # Add user to database so we can query their API key over time to ensure they are still on our server
                                 self._user_service.add_user_to_database(rec_from_uid, auth.name, uapi, today_date,
                                                                         today_date)
+                                self._audit_service.record_audit(auth.name)  # just checked, the next join needs no audit
                                 self._user_service.update_guild_tags(self._ts_facade,
                                                                      User(self._ts_facade, unique_id=rec_from_uid),
                                                                      auth)
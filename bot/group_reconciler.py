@@ -0,0 +1,206 @@
+import logging
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+import bot.gwapi as gw2api
+from bot.config import Config
+from bot.connection_pool import ConnectionPool
+from bot.db import ThreadSafeDBConnection
+from bot.ts import TS3Facade
+from .guild_cache import GuildCache
+
+LOG = logging.getLogger(__name__)
+
+
+@dataclass
+class ReconcileResult:
+    accounts: int = 0
+    accounts_skipped: int = 0  # guilds could not be loaded, their guild groups were left untouched
+    added: int = 0
+    removed: int = 0
+    failed: int = 0  # memberships whose change was rejected by teamspeak
+
+
+class GroupReconciler:
+    """
+    Brings the verified group and all guild groups in line with the registered users, for the whole server at once.
+
+    The desired membership is computed from the database and the guild list of each account (one gw2 api request per account,
+    not per identity). The actual membership is read once per group and only the difference is applied, in bulk.
+    Users are only ever added to the verified group, removing access stays with the audit.
+    Guild groups are only removed from registered users whose guilds could be loaded.
+    """
+
+    def __init__(self, database: ThreadSafeDBConnection, ts_connection_pool: ConnectionPool[TS3Facade], config: Config, guild_cache: GuildCache,
+                 ts_budget: threading.Semaphore):
+        self._database = database
+        self._ts_connection_pool = ts_connection_pool
+        self._config = config
+        self._guild_cache = guild_cache
+        self._ts_budget = ts_budget  # limits the ts connections, shared with the audits
+
+        self._running_lock = threading.Lock()
+        self._running = False  # at most one reconcile at a time
+        self._closed = threading.Event()  # stops a running reconcile between two steps
+        self._thread: Optional[threading.Thread] = None
+
+    def trigger_reconcile(self):
+        if self._closed.is_set():
+            return
+        self._thread = threading.Thread(name="GroupReconcile", target=self.reconcile, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._closed.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join()
+
+    def reconcile(self) -> Optional[ReconcileResult]:
+        if not self._config.enable_verification:
+            LOG.debug("Verification is disabled, skipping group reconcile.")
+            return None
+        with self._running_lock:
+            if self._running:
+                LOG.info("Group reconcile is already running.")
+                return None
+            self._running = True
+        try:
+            return self._reconcile()
+        finally:
+            with self._running_lock:
+                self._running = False
+
+    def _reconcile(self) -> ReconcileResult:
+        LOG.info("Reconciling server groups")
+        result = ReconcileResult()
+        with self._database.lock:
+            users = self._database.cursor.execute("SELECT ts_db_id, account_name, api_key FROM users").fetchall()
+            ts_group_by_guild_name = dict(self._database.cursor.execute("SELECT guild_name, ts_group FROM guilds").fetchall())
+            hidden = set(self._database.cursor.execute("SELECT gi.ts_db_id, g.ts_group FROM guild_ignores AS gi JOIN guilds AS g ON gi.guild_id = g.guild_id").fetchall())
+
+        uids_by_account, api_key_by_account = self._accounts(users)
+        result.accounts = len(uids_by_account)
+
+        ts_groups_by_account = self._desired_ts_groups(api_key_by_account, ts_group_by_guild_name, result)
+        if ts_groups_by_account is None:
+            return result
+
+        # connections are taken from the audit budget one step at a time, so the audits are not starved during a sweep
+        with self._ts_budget, self._ts_connection_pool.item() as ts_facade:
+            client_db_ids = ts_facade.client_db_ids_by_uid()
+            sgid_by_name = {group.get("name"): group.get("sgid") for group in ts_facade.servergroup_list()}
+            self._reconcile_verified(ts_facade, sgid_by_name.get(self._config.verified_group), {client_db_ids[uid] for uid, _, _ in users if uid in client_db_ids}, result)
+
+        managed, desired_members = self._desired_members(ts_groups_by_account, uids_by_account, client_db_ids, hidden)
+        for ts_group in {ts_group for ts_group in ts_group_by_guild_name.values() if ts_group}:  # guilds without a group have nothing to reconcile
+            if self._stopped():
+                return result
+            self._reconcile_guild_group(ts_group, sgid_by_name.get(ts_group), desired_members.get(ts_group, set()), managed, result)
+
+        LOG.info("Reconciled server groups of %s accounts (%s skipped): %s memberships added, %s removed, %s failed.",
+                 result.accounts, result.accounts_skipped, result.added, result.removed, result.failed)
+        return result
+
+    @staticmethod
+    def _accounts(users: List[Tuple[str, str, str]]) -> Tuple[Dict[str, List[str]], Dict[str, str]]:
+        """
+        returns: the identities and the api key of each account
+        """
+        uids_by_account: Dict[str, List[str]] = defaultdict(list)
+        api_key_by_account: Dict[str, str] = {}
+        for uid, account_name, api_key in users:
+            uids_by_account[account_name].append(uid)
+            api_key_by_account.setdefault(account_name, api_key)
+        return uids_by_account, api_key_by_account
+
+    def _desired_ts_groups(self, api_key_by_account: Dict[str, str], ts_group_by_guild_name: Dict[str, Optional[str]],
+                           result: ReconcileResult) -> Optional[Dict[str, Optional[Set[str]]]]:
+        """
+        The guild groups each account should wear, None for accounts whose guilds could not be loaded.
+        returns: None if the reconcile was stopped
+        """
+        ts_groups_by_account: Dict[str, Optional[Set[str]]] = {}
+        for account_name, api_key in api_key_by_account.items():
+            if self._stopped():
+                return None
+            guild_names = self._guild_names(account_name, api_key)
+            if guild_names is None:
+                result.accounts_skipped += 1
+                ts_groups_by_account[account_name] = None
+            else:
+                ts_groups_by_account[account_name] = {ts_group_by_guild_name[name] for name in guild_names if name in ts_group_by_guild_name}
+        return ts_groups_by_account
+
+    @staticmethod
+    def _desired_members(ts_groups_by_account: Dict[str, Optional[Set[str]]], uids_by_account: Dict[str, List[str]], client_db_ids: Dict[str, str],
+                         hidden: Set[Tuple[str, str]]) -> Tuple[Set[str], Dict[str, Set[str]]]:
+        """
+        returns: the clients whose guild groups are known and the desired members of each guild group
+        """
+        managed: Set[str] = set()
+        desired_members: Dict[str, Set[str]] = defaultdict(set)
+        for account_name, ts_groups in ts_groups_by_account.items():
+            if ts_groups is None:
+                continue
+            for uid in uids_by_account[account_name]:
+                if uid not in client_db_ids:
+                    continue
+                managed.add(client_db_ids[uid])
+                for ts_group in ts_groups:
+                    if (uid, ts_group) not in hidden:
+                        desired_members[ts_group].add(client_db_ids[uid])
+        return managed, desired_members
+
+    def _reconcile_verified(self, ts_facade: TS3Facade, verified_sgid: Optional[str], desired: Set[str], result: ReconcileResult):
+        """Only adds to the verified group, removing access stays with the audit"""
+        if verified_sgid is None:
+            LOG.warning("Verified group '%s' does not exist. Skipping it.", self._config.verified_group)
+            return
+        missing = desired - set(ts_facade.servergroup_client_list(verified_sgid))
+        result.added += self._apply(ts_facade.servergroup_clients_add, verified_sgid, missing, "Adding %s users to the verified group", result)
+
+    def _reconcile_guild_group(self, ts_group: str, sgid: Optional[str], desired: Set[str], managed: Set[str], result: ReconcileResult):
+        if sgid is None:
+            LOG.warning("Guild group '%s' does not exist. You should remove the guild from the db or create the group. Skipping.", ts_group)
+            return
+        with self._ts_budget, self._ts_connection_pool.item() as ts_facade:
+            actual = set(ts_facade.servergroup_client_list(sgid))
+            result.added += self._apply(ts_facade.servergroup_clients_add, sgid, desired - actual, f"Adding %s users to guild group '{ts_group}'", result)
+            result.removed += self._apply(ts_facade.servergroup_clients_del, sgid, (actual & managed) - desired, f"Removing %s users from guild group '{ts_group}'", result)
+
+    def _stopped(self) -> bool:
+        if self._closed.is_set():
+            LOG.info("Stopping group reconcile, the bot is closing.")
+            return True
+        return False
+
+    def _guild_names(self, account_name: str, api_key: str) -> Optional[List[str]]:
+        try:
+            account = gw2api.account_get(api_key)
+            guild_names = []
+            for guild_id in account.get("guilds", []):
+                guild = self._guild_cache.guild_get(guild_id)
+                if guild is not None:
+                    guild_names.append(guild.get("name"))
+            return guild_names
+        except gw2api.ApiError as ex:
+            LOG.info("Could not load the guilds of %s, leaving their guild groups untouched: %s", account_name, ex)
+            return None
+
+    @staticmethod
+    def _apply(modify, sgid: str, client_db_ids: Set[str], message: str, result: ReconcileResult) -> int:
+        """
+        returns: the number of clients that were changed, the clients of failed requests are counted as failed in the result
+        """
+        if len(client_db_ids) == 0:
+            return 0
+        LOG.info(message, len(client_db_ids))
+        failed = 0
+        for chunk, ex in modify(sgid, sorted(client_db_ids)):
+            LOG.error("Changing %s members of server group %s failed.", len(chunk), sgid, exc_info=ex)
+            failed += len(chunk)
+        result.failed += failed
+        return len(client_db_ids) - failed
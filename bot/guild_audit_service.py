@@ -3,14 +3,16 @@ from __future__ import annotations
 import logging
 import threading
 from dataclasses import dataclass, field
-from queue import Empty, PriorityQueue
+from typing import Optional, Tuple
 
+import bot.gwapi as gw2api
 from bot.config import Config
 from bot.connection_pool import ConnectionPool
-from bot.db import ThreadSafeDBConnection
+from bot.db import DurableQueue, ThreadSafeDBConnection
 from bot.ts import TS3Facade
+from .audit_queue_service import AUDIT_RETRY_DELAY, AuditQueueService
+from .audit_run import AuditRun
 from .guild_service import GuildService
-from .util import ClosableLoopingThread
 
 LOG = logging.getLogger(__name__)
 
@@ -19,60 +21,77 @@ LOG = logging.getLogger(__name__)
 QUEUE_PRIORITY_AUDIT = 100
 QUEUE_PRIORITY_JOIN = 20
 
+AUDIT_MAX_ATTEMPTS = 5  # attempts after which an audit that is not possible is dropped until the next full audit
+
 
 @dataclass(order=True)
 class GuildAuditQueueEntry:
     priority: int
     db_id: int = field(compare=False)
+    full: bool = field(default=False, compare=False)  # audit even if the guild did not change
+
+    @staticmethod
+    def merge(queued: GuildAuditQueueEntry, new: GuildAuditQueueEntry) -> GuildAuditQueueEntry:
+        return GuildAuditQueueEntry(min(queued.priority, new.priority), db_id=new.db_id, full=queued.full or new.full)
 
 
-class GuildAuditService:
+class GuildAuditService(AuditQueueService[GuildAuditQueueEntry]):
     def __init__(self, database_connection_pool: ThreadSafeDBConnection, ts_connection_pool: ConnectionPool[TS3Facade],
-                 config: Config, guild_service: GuildService):
+                 config: Config, guild_service: GuildService, ts_budget: threading.Semaphore):
         self._guild_service = guild_service
         self._database_connection = database_connection_pool
         self._ts_connection_pool = ts_connection_pool
         self._config = config
+        self._ts_budget = ts_budget  # limits the ts connections used by audits, shared with the user audit
+
+        # one entry per guild, queueing again raises the priority of the pending audit or makes it a full one.
+        super().__init__("guild", DurableQueue(database_connection_pool, "guild", GuildAuditQueueEntry, key=lambda entry: entry.db_id,
+                                               retry_delay=AUDIT_RETRY_DELAY, merge=GuildAuditQueueEntry.merge))
+        self._audit_runs = 0  # full guild audits since the start, every guild_audit_full_every-th checks unchanged guilds too
 
-        self._audit_queue: PriorityQueue[
-            GuildAuditQueueEntry] = PriorityQueue()  # pylint: disable=unsubscriptable-object
         self._start_audit_queue_worker()
 
-    def queue_guild_audit(self, priority: int, db_id: int):
-        queue_entry = GuildAuditQueueEntry(priority, db_id=db_id)
-        LOG.debug("Adding entry to guild audit queue for : %s", db_id)
-        self._audit_queue.put(queue_entry)
+    def queue_guild_audit(self, priority: int, db_id: int, full: bool = False):
+        queue_entry = GuildAuditQueueEntry(priority, db_id=db_id, full=full)
+        if self._audit_queue.put(queue_entry):
+            LOG.debug("Adding entry to guild audit queue for : %s", db_id)
+        else:
+            LOG.debug("Audit of guild %s is already queued or running, not queueing it again.", db_id)
 
     def _start_audit_queue_worker(self):
-        queue = self._audit_queue
-
-        def worker():
-            item = None
-            try:
-                item = queue.get(timeout=5)
-                LOG.debug('Working on %s:', item.db_id)
-                self._guild_service.audit_guild(item.db_id)
-            except Empty:
-                return  # empty
-            except BaseException as ex:  # any error that occurs
-                LOG.error("Exception during Audit Queue processing of item: %s.", item, exc_info=ex)
-                queue.task_done()  # finish job anyways
-                LOG.info("Remaining Queue Size: %s", queue.qsize())
-            else:
-                LOG.debug('Finished %s', item.db_id)
-                queue.task_done()
-                LOG.info("Remaining Queue Size: %s", queue.qsize())
-
-        # start worker - in theory there could be more than one thread, but this will cause stress on the gw2-api, database and teamspeak
-        self.audit_thread = ClosableLoopingThread(name="AuditQueueWorker", work=worker)
-        self.audit_thread.start()
-        LOG.info("Audit Worker is started and pulling audit jobs")
-
-    def trigger_guild_audit(self):
-        LOG.info("Auditing guilds")
-        threading.Thread(name="FullGuildAudit", target=self._audit_guilds, daemon=True).start()
-
-    def _audit_guilds(self):
+        self._start_workers("GuildAuditQueueWorker", self._audit_queue_entry, self._config.guild_audit_workers)
+
+    def _audit_queue_entry(self, item: GuildAuditQueueEntry) -> bool:
+        LOG.debug('Working on %s:', item.db_id)
+        try:
+            with self._ts_budget:
+                self._guild_service.audit_guild(item.db_id, full=item.full)
+        except gw2api.CircuitOpenError:
+            return self._requeue_rejected(item.db_id)
+        except gw2api.ApiUnavailableError as ex:
+            if self._audit_queue.attempts() >= AUDIT_MAX_ATTEMPTS:
+                LOG.warning("Audit of guild %s was not possible %s times, dropping it.", item.db_id, self._audit_queue.attempts(), exc_info=ex)
+                self._record_audit_run(item.db_id, False)
+                return True
+            LOG.warning("Audit of guild %s is currently not possible. Requeueing.", item.db_id, exc_info=ex)
+            return False
+        except BaseException:
+            self._record_audit_run(item.db_id, False)
+            raise
+        self._record_audit_run(item.db_id, True)
+        LOG.debug('Finished %s', item.db_id)
+        return True
+
+    def trigger_guild_audit(self) -> Tuple[AuditRun, bool]:
+        """
+        Starts a full guild audit, unless one is still running.
+        returns: the running audit and whether it was started by this call
+        """
+        return self._trigger_audit_run(self._queue_guilds)
+
+    def _queue_guilds(self, audit_run: Optional[AuditRun] = None):
+        full = self._config.guild_audit_full_every <= 1 or self._audit_runs % self._config.guild_audit_full_every == 0
+        self._audit_runs += 1  # only one full guild audit runs at a time
         if not self._config.enable_guild_audit:
             LOG.debug("Guild Audit is disabled, skipping audit.")
             return
@@ -82,14 +101,13 @@ class GuildAuditService:
                 'SELECT guild_id FROM guilds',
                 ()).fetchall()
 
-        LOG.info("Queueing Audit for %s Guilds.", len(db_audit_list))
+        LOG.info("Queueing Audit for %s Guilds%s.", len(db_audit_list), "" if full else ", skipping unchanged ones")
         for audit_guild in db_audit_list:
             # Convert to single variables
             audit_guild_id = audit_guild[0]
 
             LOG.debug("Queueing Audit: Guild: %s", audit_guild_id)
 
-            self.queue_guild_audit(QUEUE_PRIORITY_AUDIT, audit_guild_id)
-
-    def close(self):
-        self.audit_thread.close()
+            if audit_run is not None:
+                audit_run.add(audit_guild_id)
+            self.queue_guild_audit(QUEUE_PRIORITY_AUDIT, audit_guild_id, full=full)
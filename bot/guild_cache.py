@@ -0,0 +1,100 @@
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import time
+
+import bot.gwapi as gw2api
+from bot.db import ThreadSafeDBConnection
+from .gwapi.guild import AnonymousGuild
+
+LOG = logging.getLogger(__name__)
+
+REFRESH_WORKERS = 2
+
+
+class GuildCache:
+    """
+    Keeps guild details from the gw2 api in the bot database, so they survive restarts.
+    Entries older than the ttl are still returned immediately, but are refreshed in the background (stale-while-revalidate).
+    Only lookups for guilds that were never seen before have to wait for the gw2 api.
+    """
+
+    def __init__(self, database: ThreadSafeDBConnection, ttl: int = 60 * 60 * 24):
+        self._database = database
+        self._ttl = ttl
+
+        self._refreshing = set()  # guild ids with a background refresh in flight
+        self._refreshing_lock = threading.Lock()
+        self._refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix="GuildCacheRefresh")
+        self._closed = False
+
+    def guild_get(self, guild_id: str) -> Optional[AnonymousGuild]:
+        guild, fetched_at = self._load("SELECT gw2_guild_id, name, tag, emblem, fetched_at FROM guild_cache WHERE gw2_guild_id = ?", guild_id)
+        if guild is None:
+            return self._fetch(guild_id)
+
+        if self._is_stale(fetched_at):
+            self._refresh_in_background(guild_id)
+        return guild
+
+    def guild_search(self, guild_name: str) -> Optional[str]:
+        guild, fetched_at = self._load("SELECT gw2_guild_id, name, tag, emblem, fetched_at FROM guild_cache WHERE lower(name) = lower(?)", guild_name)
+        if guild is None:
+            guild_id = gw2api.guild_search(guild_name)
+            if guild_id is not None:
+                self._fetch(guild_id)
+            return guild_id
+
+        if self._is_stale(fetched_at):
+            self._refresh_in_background(guild["id"])
+        return guild["id"]
+
+    def put(self, guild: AnonymousGuild):
+        with self._database.lock:
+            self._database.cursor.execute("INSERT OR REPLACE INTO guild_cache(gw2_guild_id, name, tag, emblem, fetched_at) VALUES(?,?,?,?,?)",
+                                          (guild.get("id"), guild.get("name"), guild.get("tag"), json.dumps(guild.get("emblem")), time.time()))
+            self._database.conn.commit()
+
+    def close(self):
+        with self._refreshing_lock:
+            self._closed = True
+        self._refresh_executor.shutdown(wait=True)
+
+    def _load(self, query: str, param: str) -> Tuple[Optional[AnonymousGuild], Optional[float]]:
+        with self._database.lock:
+            row = self._database.cursor.execute(query, (param,)).fetchone()
+        if row is None:
+            return None, None
+        guild_id, name, tag, emblem, fetched_at = row
+        guild: AnonymousGuild = {"id": guild_id, "name": name, "tag": tag, "emblem": json.loads(emblem) if emblem is not None else None}
+        return guild, fetched_at
+
+    def _is_stale(self, fetched_at: Optional[float]) -> bool:
+        return fetched_at is None or fetched_at + self._ttl < time.time()
+
+    def _fetch(self, guild_id: str) -> Optional[AnonymousGuild]:
+        guild = gw2api.guild_get_uncached(guild_id)  # the in-process memo of guild_get would hand back the stale details
+        if guild is not None:
+            self.put(guild)
+        return guild
+
+    def _refresh_in_background(self, guild_id: str):
+        with self._refreshing_lock:
+            if self._closed or guild_id in self._refreshing:
+                return  # already on its way
+            self._refreshing.add(guild_id)
+            self._refresh_executor.submit(self._refresh, guild_id)
+
+    def _refresh(self, guild_id: str):
+        try:
+            if not self._closed:  # refreshes still queued on close are dropped
+                self._fetch(guild_id)
+                LOG.debug("Refreshed cached guild details for %s", guild_id)
+        except gw2api.ApiError as ex:
+            LOG.warning("Could not refresh cached guild details for %s. Keeping the stale entry.", guild_id, exc_info=ex)
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(guild_id)
@@ -0,0 +1,98 @@
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+from bot.db import ThreadSafeDBConnection
+
+LOG = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class RegisteredGuild:
+    guild_id: int  # id of the row in the guilds table
+    gw2_guild_id: Optional[str]
+    guild_name: Optional[str]
+    ts_group: Optional[str]
+    icon_id: Optional[int]
+    channel_id: Optional[int]
+    group_id: Optional[int]
+    sort_key: Optional[int]
+
+
+class _Index:
+    def __init__(self, guilds: List[RegisteredGuild]):
+        self.guilds = guilds
+        self.by_id = {g.guild_id: g for g in guilds}
+        self.by_name = {g.guild_name: g for g in guilds if g.guild_name is not None}
+        self.by_lower_name = {g.guild_name.lower(): g for g in guilds if g.guild_name is not None}
+        self.by_gw2_id = {g.gw2_guild_id: g for g in guilds if g.gw2_guild_id is not None}
+        self.by_ts_group = {g.ts_group: g for g in guilds if g.ts_group is not None}
+        self.by_group_id = {int(g.group_id): g for g in guilds if g.group_id is not None}
+
+
+class GuildRegistry:
+    """
+    In memory copy of the guilds table, so lookups of guild groups do not need a database round trip per guild.
+    The table is loaded on first use and reloaded after invalidate(), which everything writing to the guilds table has to call.
+    """
+
+    def __init__(self, database: ThreadSafeDBConnection):
+        self._database = database
+        self._lock = threading.Lock()
+        self._index: Optional[_Index] = None
+        self._generation = 0  # bumped by invalidate(), so a load racing with a write is not kept
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+            self._generation += 1
+
+    def all(self) -> List[RegisteredGuild]:
+        return list(self._get_index().guilds)
+
+    def by_id(self, guild_id: int) -> Optional[RegisteredGuild]:
+        return self._get_index().by_id.get(guild_id)
+
+    def by_name(self, guild_name: str, ignore_case: bool = False) -> Optional[RegisteredGuild]:
+        if guild_name is None:
+            return None
+        index = self._get_index()
+        if ignore_case:
+            return index.by_lower_name.get(guild_name.lower())
+        return index.by_name.get(guild_name)
+
+    def by_gw2_id(self, gw2_guild_id: str) -> Optional[RegisteredGuild]:
+        return self._get_index().by_gw2_id.get(gw2_guild_id)
+
+    def by_ts_group(self, ts_group: str) -> Optional[RegisteredGuild]:
+        return self._get_index().by_ts_group.get(ts_group)
+
+    def by_group_id(self, group_id) -> Optional[RegisteredGuild]:
+        if group_id is None:
+            return None
+        return self._get_index().by_group_id.get(int(group_id))
+
+    def ts_groups_of(self, guild_names: Iterable[str]) -> Dict[str, str]:
+        """guild name -> ts group for all given guilds that are registered"""
+        index = self._get_index()
+        return {name: index.by_name[name].ts_group for name in guild_names if name in index.by_name and index.by_name[name].ts_group is not None}
+
+    def _get_index(self) -> _Index:
+        with self._lock:
+            index, generation = self._index, self._generation
+        if index is not None:
+            return index
+
+        # loaded without holding the lock, callers may already hold the database lock
+        index = self._load()
+        with self._lock:
+            if self._generation == generation:
+                self._index = index
+        return index
+
+    def _load(self) -> _Index:
+        with self._database.lock:
+            rows = self._database.cursor.execute("SELECT guild_id, gw2_guild_id, guild_name, ts_group, icon_id, channel_id, group_id, sort_key FROM guilds").fetchall()
+        LOG.debug("Loaded %s guilds into the registry", len(rows))
+        return _Index([RegisteredGuild(*row) for row in rows])
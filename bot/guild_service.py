@@ -1,22 +1,33 @@
 import binascii
 import datetime
+import hashlib
 import json
 import logging
 import re
-from typing import Iterator, Optional
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import humanize
 
-import bot.gwapi as gw2api
 from bot.config import Config
 from bot.connection_pool import ConnectionPool
 from bot.db import ThreadSafeDBConnection
 from bot.ts import TS3Facade, User
 from .emblem_downloader import download_guild_emblem
+from .guild_cache import GuildCache
+from .guild_registry import GuildRegistry
 from .gwapi.guild import Emblem
 
 PERMISSION_ICON_ID = "i_icon_id"
 
+# guild groups are ordered alphabetically by sort keys in [0, SORT_KEY_SPACE). Keys are spread with gaps,
+# so a new guild usually fits between its neighbours and no other group has to be touched.
+SORT_KEY_SPACE = 10000
+
+CHANNEL_LIST_TTL = 60  # seconds the channel list is reused while auditing guilds
+
 LOG = logging.getLogger(__name__)
 
 
@@ -33,8 +44,15 @@ def none_if_empty(param):
 
 
 class GuildService:
-    def __init__(self, database: ThreadSafeDBConnection, ts_connection_pool: ConnectionPool[TS3Facade], config: Config):
+    def __init__(self, database: ThreadSafeDBConnection, ts_connection_pool: ConnectionPool[TS3Facade], config: Config, guild_cache: GuildCache,
+                 guild_registry: GuildRegistry):
         self._database = database
+        self._guild_cache = guild_cache
+        self._guild_registry = guild_registry
+
+        self._channel_list: Optional[List[dict]] = None
+        self._channel_list_loaded_at = 0.0
+        self._channel_list_lock = threading.Lock()
         self.ts_connection_pool = ts_connection_pool
         self._config = config
 
@@ -69,24 +87,21 @@ class GuildService:
         if group_name is not None and len(group_name) < 2:
             return INVALID_PARAMETERS
 
-        guild_info = gw2api.guild_get(gw2api.guild_search(name))
+        gw2_guild_id = self._guild_cache.guild_search(name)
+        guild_info = self._guild_cache.guild_get(gw2_guild_id) if gw2_guild_id is not None else None
         if guild_info is None:
             return INVALID_PARAMETERS
 
         guild_name = guild_info.get("name")
         guild_tag = guild_info.get("tag")
         guild_id = guild_info.get("id")
-        guild_emblem = guild_info.get("emblem")
 
         if group_name is None:
             group_name = guild_tag
 
-        with self._database.lock:
-            dbgroups = self._database.cursor.execute(
-                "SELECT guild_name FROM guilds WHERE gw2_guild_id = ?", (guild_id,)).fetchall()
-            if len(dbgroups) > 0:
-                LOG.debug("Can not create Guild '%s', as it already exists. Aborting guild creation.", guild_id)
-                return DUPLICATE_DB_ENTRY
+        if self._guild_registry.by_gw2_id(guild_id) is not None:
+            LOG.debug("Can not create Guild '%s', as it already exists. Aborting guild creation.", guild_id)
+            return DUPLICATE_DB_ENTRY
 
         channel_name = self._build_channel_name(guild_info.get("name"), group_name)
         channel_description = self._create_guild_channel_description(contacts, guild_id, guild_name, guild_tag)
@@ -110,13 +125,11 @@ class GuildService:
                     LOG.debug("Can not create a group '%s', because it already exists. Aborting guild creation.", group)
                     return DUPLICATE_TS_GROUP
 
-                    dbgroups = self._database.cursor.execute(
-                        "SELECT ts_group, guild_name FROM guilds WHERE ts_group = ?", (group_name,)).fetchall()
-                    if len(dbgroups) > 0:
-                        LOG.debug(
-                            "Can not create a DB entry for TS group '%s', as it already exists. Aborting guild creation.",
-                            group_name)
-                        return DUPLICATE_DB_ENTRY
+                if self._guild_registry.by_ts_group(group_name) is not None:
+                    LOG.debug(
+                        "Can not create a DB entry for TS group '%s', as it already exists. Aborting guild creation.",
+                        group_name)
+                    return DUPLICATE_DB_ENTRY
 
                 channel = ts_facade.channel_find_first(channel_name)
                 if channel is not None:
@@ -134,123 +147,153 @@ class GuildService:
 
                 LOG.debug("Checks complete.")
 
-                # Icon uploading
-                icon_content = download_guild_emblem(guild_id)  # Returns None if no icon
-                if icon_content is not None:
-                    icon_id = self.generate_guild_icon_id(guild_name, guild_emblem)
-                    LOG.info("Uploading icon as '%s' size:%s", icon_id, len(icon_content))
-                    ts_facade.upload_icon(icon_id, icon_content)
+                icon_id = self._upload_guild_icon(ts_facade, guild_id, guild_name, guild_info.get("emblem"))
 
                 ##################################
                 # CREATE CHANNEL AND SUBCHANNELS #
                 ##################################
-                LOG.debug("Creating guild channel ...")
-                all_guild_channels = self._find_guild_channels(parent, ts_facade.channel_list())
-
-                # Assuming the channels are already in order on the server,
-                # find the first channel whose name is alphabetically smaller than the new channel name.
-                # The sort_order of channels actually specifies after which channel they should be
-                # inserted. Giving 0 as sort_order puts them in first place after the parent.
-                found_place = False
-                sort_order = 0
-                i = 0
-                while i < len(all_guild_channels) and not found_place:
-                    if all_guild_channels[i].get("channel_name") > channel_name:
-                        i += 1
-                    else:
-                        sort_order = int(all_guild_channels[i].get("cid"))
-                        found_place = True
-
-                cinfo, ex = ts_facade.channel_create(channel_name=channel_name,
-                                                     channel_description=channel_description,
-                                                     channel_parent_id=parent.channel_id,
-                                                     channel_maxclients=0,
-                                                     channel_order=sort_order)
-                channel_id = cinfo.get("cid")
-                guild_channel_perms, perms = self._create_guild_channel_permissions(icon_id)
-                ts_facade.channel_add_permissions(channel_id, perms)
-
-                for c in self._config.guild_sub_channels:
-                    # FIXME: error check
-                    sub_channel_info, ex = ts_facade.channel_create(channel_name=c, channel_parent_id=channel_id)
-                    ts_facade.channel_add_permissions(sub_channel_info.get("cid"), guild_channel_perms)
+                channel_id = self._create_guild_channel(ts_facade, parent.channel_id, channel_name, channel_description, icon_id)
 
             #######################
             # CREATE SERVER GROUP #
             #######################
-            LOG.debug("Creating and configuring server group...")
-            resp, ex = ts_facade.servergroup_add(group_name)
-            if ex is not None and ex.resp.error["id"] == "1282":
-                LOG.warning("Duplication error while trying to create the group '%s' for the guild %s [%s].",
-                            group_name, guild_name, guild_tag)
-
-            group_id = resp.get("sgid")
-
-            LOG.debug("Creating entry in database for auto assignment of guild group...")
-            with self._database.lock:
-                self._database.cursor.execute("INSERT INTO guilds(ts_group, guild_name, icon_id,channel_id,group_id) VALUES(?,?,?,?,?)",
-                                              (group_name, guild_name, icon_id, channel_id, group_id))
-                self._database.conn.commit()
-
-            servergroup_permissions = self._create_guild_servergroup_permissions(icon_id)
-            ts_facade.servergroup_add_permissions(group_id, servergroup_permissions)
-
-            groups.append({"sgid": group_id,
-                           "name": group_name})  # the newly created group has to be added to properly iterate over the guild groups
-            self._sort_guild_groups_using_talk_power(groups, ts_facade)
+            group_id = self._create_guild_group(ts_facade, group_name, guild_name, guild_tag, icon_id, channel_id)
 
             ################
             # ADD CONTACTS #
             ################
-            LOG.debug("Adding contacts...")
-            contactgroup = self._find_contact_group(ts_facade)
-            if contactgroup is None:
-                LOG.debug("Can not find a group for guild contacts. Skipping.")
-            else:
-                for c in contacts:
-                    LOG.debug("Adding contact role to %s", c)
-                    with self._database.lock:
-                        accs = [row[0] for row in self._database.cursor.execute(
-                            "SELECT ts_db_id FROM users WHERE lower(account_name) = lower(?)", (c,)).fetchall()]
-                        for acc in accs:
-                            errored = False
-                            try:
-                                LOG.debug("Adding contact role to %s Identity: %s", c, acc)
-                                user = User(ts_facade, unique_id=acc)
-                                if user.ts_db_id is not None:
-                                    ex = ts_facade.set_client_channelgroup(channel_id=cinfo.get("cid"),
-                                                                           channelgroup_id=contactgroup.get("cgid"),
-                                                                           client_db_id=user.ts_db_id)
-                                    # while we are at it, add the contacts to the guild group as well
-                                    ts_facade.servergroup_client_add(servergroup_id=group_id,
-                                                                     client_db_id=user.ts_db_id)
-
-                                    errored = ex is not None
-                                else:
-                                    LOG.warning("Could not add Role to Identity %s, not found on server", acc)
-                            except Exception as ex:
-                                errored = ex
-                            if errored:
-                                LOG.error("Could not assign contact role '%s' to user '%s' with DB-unique-ID '%s' in "
-                                          "guild channel for %s. Maybe the uid is not valid anymore.",
-                                          self._config.guild_contact_channel_group, c, acc, guild_name, exc_info=ex)
+            self._add_guild_contacts(ts_facade, contacts, guild_name, channel_id, group_id)
             return SUCCESS
 
+    def _upload_guild_icon(self, ts_facade, guild_id, guild_name, guild_emblem) -> Optional[int]:
+        """returns: the id of the uploaded icon, None if the guild has no emblem"""
+        icon_content = download_guild_emblem(guild_id)  # Returns None if no icon
+        if icon_content is None:
+            return None
+        icon_id = self.generate_guild_icon_id(guild_name, guild_emblem)
+        LOG.info("Uploading icon as '%s' size:%s", icon_id, len(icon_content))
+        ts_facade.upload_icon(icon_id, icon_content)
+        return icon_id
+
+    def _create_guild_channel(self, ts_facade, parent_id, channel_name, channel_description, icon_id):
+        LOG.debug("Creating guild channel ...")
+        sort_order = self._guild_channel_order(self._find_guild_channels(parent_id, ts_facade.channel_list()), channel_name)
+        cinfo, _ = ts_facade.channel_create(channel_name=channel_name,
+                                            channel_description=channel_description,
+                                            channel_parent_id=parent_id,
+                                            channel_maxclients=0,
+                                            channel_order=sort_order)
+        channel_id = cinfo.get("cid")
+        sub_channel_perms, perms = self._create_guild_channel_permissions(icon_id)
+        self._add_guild_channel_permissions(ts_facade, channel_id, perms)
+
+        for c in self._config.guild_sub_channels:
+            # FIXME: error check
+            sub_channel_info, _ = ts_facade.channel_create(channel_name=c, channel_parent_id=channel_id)
+            self._add_guild_channel_permissions(ts_facade, sub_channel_info.get("cid"), sub_channel_perms)
+        return channel_id
+
+    @staticmethod
+    def _guild_channel_order(all_guild_channels, channel_name) -> int:
+        # Assuming the channels are already in order on the server,
+        # find the first channel whose name is alphabetically smaller than the new channel name.
+        # The sort_order of channels actually specifies after which channel they should be
+        # inserted. Giving 0 as sort_order puts them in first place after the parent.
+        found_place = False
+        sort_order = 0
+        i = 0
+        while i < len(all_guild_channels) and not found_place:
+            if all_guild_channels[i].get("channel_name") > channel_name:
+                i += 1
+            else:
+                sort_order = int(all_guild_channels[i].get("cid"))
+                found_place = True
+        return sort_order
+
+    @staticmethod
+    def _add_guild_channel_permissions(ts_facade, channel_id, permissions):
+        _, ex = ts_facade.channel_add_permissions(channel_id, permissions)
+        if ex is not None:
+            LOG.warning("Could not set the permissions of channel %s, the next guild audit sets them.", channel_id, exc_info=ex)
+
+    def _create_guild_group(self, ts_facade, group_name, guild_name, guild_tag, icon_id, channel_id):
+        LOG.debug("Creating and configuring server group...")
+        resp, ex = ts_facade.servergroup_add(group_name)
+        if ex is not None and ex.resp.error["id"] == "1282":
+            LOG.warning("Duplication error while trying to create the group '%s' for the guild %s [%s].",
+                        group_name, guild_name, guild_tag)
+
+        group_id = resp.get("sgid")
+
+        sort_key = self._free_sort_key(group_name, ts_facade)
+
+        LOG.debug("Creating entry in database for auto assignment of guild group...")
+        with self._database.lock:
+            self._database.cursor.execute("INSERT INTO guilds(ts_group, guild_name, icon_id,channel_id,group_id,sort_key) VALUES(?,?,?,?,?,?)",
+                                          (group_name, guild_name, icon_id, channel_id, group_id, sort_key))
+            self._database.conn.commit()
+        self._guild_registry.invalidate()
+
+        servergroup_permissions = self._create_guild_servergroup_permissions(icon_id, sort_key)
+        ts_facade.servergroup_add_permissions(group_id, servergroup_permissions)
+        return group_id
+
+    def _add_guild_contacts(self, ts_facade, contacts, guild_name, channel_id, group_id):
+        LOG.debug("Adding contacts...")
+        contactgroup = self._find_contact_group(ts_facade)
+        if contactgroup is None:
+            LOG.debug("Can not find a group for guild contacts. Skipping.")
+            return
+        for c in contacts:
+            LOG.debug("Adding contact role to %s", c)
+            with self._database.lock:
+                accs = [row[0] for row in self._database.cursor.execute(
+                    "SELECT ts_db_id FROM users WHERE lower(account_name) = lower(?)", (c,)).fetchall()]
+                for acc in accs:
+                    errored = False
+                    try:
+                        LOG.debug("Adding contact role to %s Identity: %s", c, acc)
+                        user = User(ts_facade, unique_id=acc)
+                        if user.ts_db_id is not None:
+                            ex = ts_facade.set_client_channelgroup(channel_id=channel_id,
+                                                                   channelgroup_id=contactgroup.get("cgid"),
+                                                                   client_db_id=user.ts_db_id)
+                            # while we are at it, add the contacts to the guild group as well
+                            ts_facade.servergroup_client_add(servergroup_id=group_id,
+                                                             client_db_id=user.ts_db_id)
+
+                            errored = ex is not None
+                        else:
+                            LOG.warning("Could not add Role to Identity %s, not found on server", acc)
+                    except Exception as ex:
+                        errored = ex
+                    if errored:
+                        LOG.error("Could not assign contact role '%s' to user '%s' with DB-unique-ID '%s' in "
+                                  "guild channel for %s. Maybe the uid is not valid anymore.",
+                                  self._config.guild_contact_channel_group, c, acc, guild_name, exc_info=ex)
+
     def _create_guild_channel_permissions(self, icon_id=None):
-        permissions = [
+        """Permissions of the sub channels and of the guild channel itself, which also shows the guild icon"""
+        sub_channel_permissions = [
             ("i_channel_needed_join_power", 25),
             ("i_channel_needed_subscribe_power", 25),
             ("i_channel_needed_modify_power", 45),
             ("i_channel_needed_delete_power", 75)
         ]
-        sub_channel_permissions = permissions.copy()
+        permissions = sub_channel_permissions.copy()
         if icon_id is not None:
-            sub_channel_permissions.append(("i_icon_id", icon_id))
-        return permissions, sub_channel_permissions
+            permissions.append((PERMISSION_ICON_ID, icon_id))
+        return sub_channel_permissions, permissions
+
+    @staticmethod
+    def _permission_changes(desired: List[Tuple[str, int]], current: Dict[str, int]) -> List[Tuple[str, int]]:
+        # teamspeak reports values as signed 32 bit, e.g. icon ids (crc32) above 2^31 as negative numbers
+        return [(permission_id, value) for permission_id, value in desired
+                if permission_id not in current or current[permission_id] & 0xFFFFFFFF != int(value) & 0xFFFFFFFF]
 
-    def _find_guild_channels(self, parent, channel_list):
+    def _find_guild_channels(self, parent_id, channel_list):
         # assert channel and group both exist and parent channel is available
-        all_guild_channels = [c for c in channel_list if c.get("pid") == parent.channel_id]
+        all_guild_channels = [c for c in channel_list if c.get("pid") == parent_id]
         all_guild_channels.sort(key=lambda c: c.get("channel_name"), reverse=True)
         return all_guild_channels
 
@@ -262,42 +305,74 @@ class GuildService:
                             None)
         return contactgroup
 
-    def _create_guild_servergroup_permissions(self, icon_id=None):
+    def _create_guild_servergroup_permissions(self, icon_id=None, sort_key=None):
         perms = [
             ("b_group_is_permanent", 1),
             ("i_group_show_name_in_tree", 1),
             ("i_group_needed_modify_power", 75),
             ("i_group_needed_member_add_power", 50),
             ("i_group_needed_member_remove_power", 50),
-            ("i_group_sort_id", self._config.guilds_sort_id),
         ]
+        if sort_key is not None:
+            perms.extend(self._create_guild_sort_permissions(sort_key))
         if icon_id is not None:
             perms.append((PERMISSION_ICON_ID, icon_id))
         return perms
 
-    def _sort_guild_groups_using_talk_power(self, groups, ts_facade):
+    def _create_guild_sort_permissions(self, sort_key: int):
+        # talk power sorts users grouped by their guild tag alphabetically in channels, the sort id sorts the group list.
+        # Both have to stay within their configured window, so with more guilds than values neighbours share one.
+        minimum, maximum = self._config.guilds_minimum_talk_power, self._config.guilds_maximum_talk_power
+        talk_power = maximum - sort_key * (maximum - minimum + 1) // SORT_KEY_SPACE
+        return [
+            ("i_client_talk_power", talk_power),
+            ("i_group_sort_id", self._config.guilds_sort_id + sort_key * self._config.guilds_sort_id_range // SORT_KEY_SPACE),
+        ]
+
+    def _free_sort_key(self, ts_group: str, ts_facade=None) -> Optional[int]:
+        """
+        Sort key in the gap between the alphabetical neighbours of the guild group.
+        ts_facade: if given and there is no gap left, the other guild groups are rebalanced to make room
+        returns: the sort key, None if there is no gap left
+        """
+        others = [g for g in self._guild_registry.all() if g.ts_group is not None and g.ts_group != ts_group]
+        lower = max((g.sort_key for g in others if g.ts_group < ts_group and g.sort_key is not None), default=-1)
+        upper = min((g.sort_key for g in others if g.ts_group > ts_group and g.sort_key is not None), default=SORT_KEY_SPACE)
+        # guilds from before sort keys existed have no place in the order yet
+        if any(g.sort_key is None for g in others) or upper - lower < 2:
+            if ts_facade is None:
+                return None
+            self._rebalance_guild_groups(ts_facade, exclude=ts_group)
+            return self._free_sort_key(ts_group)
+        return (lower + upper) // 2
+
+    def _spread_sort_keys(self, exclude: Optional[str] = None) -> Dict[int, int]:
+        """
+        Spreads the sort keys of all guild groups evenly again, without touching the groups.
+        exclude: guild group left out, e.g. one whose key is allocated after the others were spread
+        returns: guild id -> sort key
+        """
+        guilds = sorted((g for g in self._guild_registry.all() if g.ts_group is not None and g.ts_group != exclude), key=lambda g: g.ts_group)
+        LOG.info("Rebalancing the sort order of %s guild groups", len(guilds))
+        sort_keys = {g.guild_id: (i + 1) * SORT_KEY_SPACE // (len(guilds) + 1) for i, g in enumerate(guilds)}
         with self._database.lock:
-            guildgroups = [g[0] for g in
-                           self._database.cursor.execute("SELECT ts_group FROM guilds ORDER BY ts_group").fetchall()]
-        for i, guild_group in enumerate(guildgroups):
-            g = next((g for g in groups if g.get("name") == guild_group), None)
-            if g is None:
+            self._database.cursor.executemany("UPDATE guilds SET sort_key = ? WHERE guild_id = ?", [(k, guild_id) for guild_id, k in sort_keys.items()])
+            self._database.conn.commit()
+        self._guild_registry.invalidate()
+        return sort_keys
+
+    def _rebalance_guild_groups(self, ts_facade, exclude: Optional[str] = None):
+        """Spreads the sort keys of all guild groups evenly again and updates every group"""
+        for guild_id, sort_key in self._spread_sort_keys(exclude).items():
+            guild = self._guild_registry.by_id(guild_id)
+            group_id = guild.group_id or ts_facade.servergroup_id(guild.ts_group)
+            if group_id is None:
                 # error! Group deleted from TS, but not from DB!
                 LOG.warning(
                     "Found guild '%s' in the database, but no coresponding server group! Skipping this entry, but it should be fixed!",
-                    guildgroups[i])
+                    guild.ts_group)
             else:
-                tp = self._config.guilds_maximum_talk_power - i
-
-                if tp < 0:
-                    LOG.warning("Talk power for guild %s is below 0.", g.get("name"))
-
-                # sort guild groups to have users grouped by their guild tag alphabetically in channels
-                _, _ = ts_facade.servergroup_add_permission(g.get("sgid"), "i_client_talk_power", tp)
-
-                # sort guild groups in group list
-                sort_id = self._config.guilds_sort_id + i
-                _, _ = ts_facade.servergroup_add_permission(g.get("sgid"), "i_group_sort_id", sort_id)
+                ts_facade.servergroup_add_permissions(group_id, self._create_guild_sort_permissions(sort_key))
 
     @staticmethod
     def _build_channel_name(name: str, tag: str) -> str:
@@ -332,10 +407,9 @@ class GuildService:
         if name is None:
             return INVALID_PARAMETERS
 
-        with self._database.lock:
-            db_guild_entity = self._database.cursor.execute(
-                "SELECT guild_id,ts_group,guild_name,channel_id,group_id,icon_id FROM guilds WHERE lower(guild_name) = lower(?)", (name,)).fetchone()
-            guild_id, guild_group_name, guild_name, channel_id, group_id, current_icon_id = db_guild_entity if db_guild_entity is not None else [None, None, None, None, None, None]
+        guild = self._guild_registry.by_name(name, ignore_case=True)
+        guild_id, guild_group_name, guild_name, channel_id, group_id, current_icon_id = \
+            (guild.guild_id, guild.ts_group, guild.guild_name, guild.channel_id, guild.group_id, guild.icon_id) if guild is not None else [None, None, None, None, None, None]
 
         if guild_group_name is None or guild_name is None:
             return NO_DB_ENTRY
@@ -359,33 +433,33 @@ class GuildService:
         with self._database.lock:
             self._database.cursor.execute("DELETE FROM guilds WHERE guild_id = ?", (guild_id,))
             self._database.conn.commit()
+        self._guild_registry.invalidate()
 
         return SUCCESS
 
     def list_channels(self) -> Iterator[dict]:
+        """Guild channels with their sub channels, loaded with a single channellist"""
         with self.ts_connection_pool.item() as facade:
-            all_channels = facade.channel_list()
-            parent = facade.channel_find_first(self._config.guilds_parent_channel)
-
-            channels = self._find_guild_channels(parent, all_channels)
-
-        for channel in channels:
-            yield from self.grab_channel(all_channels, facade, channel)
-        pass
-
-    def grab_channel(self, all_channels, facade, sub1):
-        channel_id = int(sub1["cid"])
-        sub_info, ex = facade.channel_info(channel_id)
-        yield {
-            "name": sub1.get("channel_name"),
-            "empty_since": formatSeconds(sub_info.get("seconds_empty")),
-            "subChannels": none_if_empty(list(self.grab_sub_channels(all_channels, facade, sub1["cid"])))
-        }
+            all_channels = facade.channel_list(seconds_empty=True)
+
+        parent = next((c for c in all_channels if c.get("channel_name") == self._config.guilds_parent_channel), None)
+        if parent is None:
+            LOG.warning("Can not find the parent channel '%s' for guilds.", self._config.guilds_parent_channel)
+            return
+
+        children_by_parent_id = defaultdict(list)
+        for channel in all_channels:
+            children_by_parent_id[channel.get("pid")].append(channel)
 
-    def grab_sub_channels(self, all_channels, facade, parent_id):
-        sub_channels = [c for c in all_channels if c.get("pid") == parent_id]
-        for sub1 in sub_channels:
-            yield from self.grab_channel(all_channels, facade, sub1)
+        for channel in self._find_guild_channels(parent.get("cid"), all_channels):
+            yield self.grab_channel(children_by_parent_id, channel)
+
+    def grab_channel(self, children_by_parent_id, channel) -> dict:
+        return {
+            "name": channel.get("channel_name"),
+            "empty_since": formatSeconds(channel.get("seconds_empty")),
+            "subChannels": none_if_empty([self.grab_channel(children_by_parent_id, c) for c in children_by_parent_id[channel.get("cid")]])
+        }
 
     @staticmethod
     def generate_guild_icon_id(name: str, emblem: Optional[Emblem]) -> int:
@@ -409,6 +483,7 @@ class GuildService:
             with self._database.lock:
                 self._database.cursor.execute("UPDATE guilds SET icon_id = ? WHERE guild_id = ?", (icon_id, db_id,))
                 self._database.conn.commit()
+            self._guild_registry.invalidate()
 
     def _find_guild_channel_id_by_guild_name(self, ts3_facade, guild_name: str) -> Optional[int]:
         # CHANNEL
@@ -426,12 +501,10 @@ class GuildService:
 
     def _find_guild_group_id_by_guild_group_name(self, ts3_facade, group_name: str) -> Optional[int]:
         # GROUP
-        groups = ts3_facade.servergroup_list()
-        group = next((g for g in groups if g.get("name") == group_name), None)
-        if group is None:
+        group_id = ts3_facade.servergroup_id(group_name)
+        if group_id is None:
             LOG.debug("No group '%s' to delete.", group_name)
-        else:
-            return group.get("sgid")
+        return group_id
 
     def rename_group(self, group_id, desired_name):
         with self.ts_connection_pool.item() as ts3_facade:
@@ -442,6 +515,7 @@ class GuildService:
         with self._database.lock:
             self._database.cursor.execute("UPDATE guilds SET group_id = ? WHERE guild_id = ?", (group_id, db_id,))
             self._database.conn.commit()
+        self._guild_registry.invalidate()
         return group_id
 
     def detect_channel_id(self, ts3_facade, db_id, guild_name) -> int:
@@ -449,8 +523,32 @@ class GuildService:
         with self._database.lock:
             self._database.cursor.execute("UPDATE guilds SET channel_id = ? WHERE guild_id = ?", (channel_id, db_id,))
             self._database.conn.commit()
+        self._guild_registry.invalidate()
         return channel_id
 
+    def _audit_fingerprint(self, guild_info, ts_group, channel_id, group_id, sort_key) -> str:
+        """Hash of everything the audit of a guild depends on, a guild with an unchanged fingerprint needs no audit"""
+        inputs = {
+            "name": guild_info.get("name"),
+            "tag": guild_info.get("tag"),
+            "emblem": guild_info.get("emblem"),
+            "ts_group": ts_group,
+            "channel_id": channel_id,
+            "group_id": group_id,
+            "sort_key": sort_key,
+            "sub_channels": list(self._config.guild_sub_channels),
+            "talk_power": [self._config.guilds_minimum_talk_power, self._config.guilds_maximum_talk_power],
+            "sort_id": [self._config.guilds_sort_id, self._config.guilds_sort_id_range],
+            "channel_permissions": self._create_guild_channel_permissions(),
+            "servergroup_permissions": self._create_guild_servergroup_permissions(),
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _last_audit_fingerprint(self, db_id: int) -> Optional[str]:
+        with self._database.lock:
+            row = self._database.cursor.execute("SELECT audit_fingerprint FROM guilds WHERE guild_id = ?", (db_id,)).fetchone()
+        return None if row is None else row[0]
+
     def _audit_channel(self, ts3_facade, channel_id, guild_name, ts_group, icon_id):
         desired_name = self._build_channel_name(guild_name, ts_group)
         c, _ = ts3_facade.channel_info(channel_id)
@@ -462,58 +560,114 @@ class GuildService:
             LOG.info("Updating channel name from %s to %s", current_channel_name, desired_name)
             ts3_facade.channel_edit(channel_id, desired_name)
 
-        permissions, sub_channel_permissions = self._create_guild_channel_permissions(icon_id)
-        ts3_facade.channel_add_permissions(channel_id, permissions)
-        # TODO: Set subchannel permissions aswell
-
-    def _audit_group(self, ts3_facade, group_id, ts_group, icon_id):
-        self.rename_group(group_id, ts_group)
-        permissions = self._create_guild_servergroup_permissions(icon_id)
-        ts3_facade.servergroup_add_permissions(group_id, permissions)
-
-    def audit_guild(self, db_id: int):
+        sub_channel_permissions, permissions = self._create_guild_channel_permissions(icon_id)
+        self._audit_channel_permissions(ts3_facade, channel_id, permissions)
+        for sub_channel in self._guild_sub_channels(ts3_facade, channel_id):
+            self._audit_channel_permissions(ts3_facade, sub_channel.get("cid"), sub_channel_permissions)
+
+    def _audit_channel_permissions(self, ts3_facade, channel_id, permissions):
+        changes = self._permission_changes(permissions, ts3_facade.channel_permission_list(channel_id))
+        if len(changes) > 0:
+            LOG.info("Updating permissions %s of channel %s", ", ".join(p for p, _ in changes), channel_id)
+            _, ex = ts3_facade.channel_add_permissions(channel_id, changes)
+            if ex is not None:
+                LOG.warning("Could not update the permissions of channel %s", channel_id, exc_info=ex)
+
+    def _guild_sub_channels(self, ts3_facade, channel_id) -> List[dict]:
+        """The configured sub channels of the guild channel"""
+        return [c for c in self._cached_channel_list(ts3_facade)
+                if c.get("pid") == str(channel_id) and c.get("channel_name") in self._config.guild_sub_channels]
+
+    def _cached_channel_list(self, ts3_facade) -> List[dict]:
+        # shared by all guilds of an audit run, the channels do not have to be listed once per guild
+        with self._channel_list_lock:
+            if self._channel_list is None or self._channel_list_loaded_at + CHANNEL_LIST_TTL < time.monotonic():
+                self._channel_list = ts3_facade.channel_list()
+                self._channel_list_loaded_at = time.monotonic()
+            return self._channel_list
+
+    def _audit_group(self, ts3_facade, group_id, ts_group, icon_id, sort_key):
+        current_name = next((g.get("name") for g in ts3_facade.servergroup_list() if str(g.get("sgid")) == str(group_id)), None)
+        if current_name != ts_group:
+            LOG.info("Renaming group %s from %s to %s", group_id, current_name, ts_group)
+            ts3_facade.servergroup_rename(group_id, ts_group)
+
+        permissions = self._create_guild_servergroup_permissions(icon_id, sort_key)
+        changes = self._permission_changes(permissions, ts3_facade.servergroup_permission_list(group_id))
+        if len(changes) > 0:
+            LOG.info("Updating permissions %s of group %s", ", ".join(p for p, _ in changes), ts_group)
+            ts3_facade.servergroup_add_permissions(group_id, changes)
+
+    def _gw2_guild_id(self, db_id: int, guild) -> Optional[str]:
+        """The gw2 id of the guild, searched by name and stored for guilds from before it was kept"""
+        if guild is not None and guild.gw2_guild_id is not None:
+            return guild.gw2_guild_id
+        if guild is None or guild.guild_name is None:
+            LOG.error("Guild %s has no id or name", db_id)
+            return None
+        gw2_guild_id = self._guild_cache.guild_search(guild.guild_name)
+        if gw2_guild_id is None:
+            LOG.warning("Guild %s is not available form the gw2 api anymore", guild.guild_name)
+            return None
         with self._database.lock:
-            db_guild_entity = self._database.cursor.execute("SELECT guild_name,ts_group,icon_id,gw2_guild_id,channel_id,group_id FROM guilds WHERE guild_id = ?", (db_id,)).fetchone()
-            guild_name, ts_group, current_icon_id, gw2_guild_id, channel_id, group_id = db_guild_entity if db_guild_entity is not None else [None, None, None, None, None, None]
+            self._database.cursor.execute("UPDATE guilds SET gw2_guild_id = ? WHERE guild_id = ?", (gw2_guild_id, db_id,))
+            self._database.conn.commit()
+        self._guild_registry.invalidate()
+        return gw2_guild_id
+
+    def _unchanged_since_last_audit(self, db_id: int, guild_info, current_icon_id, icon_id, ts_group, channel_id, group_id, sort_key) -> bool:
+        last_fingerprint = self._last_audit_fingerprint(db_id)
+        return last_fingerprint is not None and current_icon_id == icon_id \
+            and last_fingerprint == self._audit_fingerprint(guild_info, ts_group, channel_id, group_id, sort_key)
 
+    def audit_guild(self, db_id: int, full: bool = False):
+        """
+        Brings icon, channel and group of the guild in line with the gw2 api and the config.
+        full: also check guilds whose fingerprint did not change since their last audit
+        """
+        guild = self._guild_registry.by_id(db_id)
+        gw2_guild_id = self._gw2_guild_id(db_id, guild)
         if gw2_guild_id is None:
-            if guild_name is not None:
-                gw2_guild_id = gw2api.guild_search(guild_name)
-                if gw2_guild_id is not None:
-                    with self._database.lock:
-                        self._database.cursor.execute("UPDATE guilds SET gw2_guild_id = ? WHERE guild_id = ?", (gw2_guild_id, db_id,))
-                        self._database.conn.commit()
-                else:
-                    LOG.warning("Guild %s is not available form the gw2 api anymore", guild_name)
-                    return
-            else:
-                LOG.error("Guild %s has no id or name", db_id)
-                return
+            return
 
-        guild_info = gw2api.guild_get(gw2_guild_id)
-        if guild_info is not None:
-            guild_name = guild_info.get("name")
-            # guild_tag = guild_info.get("tag")
-            guild_id = guild_info.get("id")
-            guild_emblem = guild_info.get("emblem")
+        guild_info = self._guild_cache.guild_get(gw2_guild_id)
+        if guild_info is None:
+            LOG.warning("Guild Details %s (%s) are not available form the gw2 api anymore", guild.guild_name, gw2_guild_id)
+            return
 
-            with self.ts_connection_pool.item() as ts3_facade:
-                # refresh Icon
-                LOG.info("Auditing Icon...")
-                icon_id = self.generate_guild_icon_id(guild_name, guild_emblem)
-                if current_icon_id != icon_id:
-                    LOG.info("Updating Icon !")
-                    self._audit_icon(db_id, guild_id, current_icon_id, icon_id)
-
-                LOG.info("Auditing Channel...")
-                channel_id = channel_id or self.detect_channel_id(ts3_facade, db_id, guild_name)
-                if channel_id is not None:
-                    self._audit_channel(ts3_facade, channel_id, guild_name, ts_group, icon_id)
-
-                LOG.info("Auditing Group...")
-                group_id = group_id or self.detect_group_id(ts3_facade, db_id, ts_group)
-                if group_id is not None:
-                    self._audit_group(ts3_facade, group_id, ts_group, icon_id)
-        else:
-            LOG.warning("Guild Details %s (%s) are not available form the gw2 api anymore", guild_name, gw2_guild_id)
+        guild_name = guild_info.get("name")
+        ts_group, current_icon_id, channel_id, group_id = guild.ts_group, guild.icon_id, guild.channel_id, guild.group_id
+        icon_id = self.generate_guild_icon_id(guild_name, guild_info.get("emblem"))
+
+        sort_key = guild.sort_key
+        if sort_key is None and ts_group is not None:
+            # guild from before sort keys existed, the audits of the other guilds pick up their new keys
+            sort_key = self._spread_sort_keys().get(db_id)
+
+        if not full and self._unchanged_since_last_audit(db_id, guild_info, current_icon_id, icon_id, ts_group, channel_id, group_id, sort_key):
+            LOG.debug("Guild %s did not change since its last audit. Skipping.", guild_name)
             return
+
+        with self.ts_connection_pool.item() as ts3_facade:
+            # refresh Icon
+            LOG.info("Auditing Icon...")
+            if current_icon_id != icon_id:
+                LOG.info("Updating Icon !")
+                self._audit_icon(db_id, guild_info.get("id"), current_icon_id, icon_id)
+
+            LOG.info("Auditing Channel...")
+            channel_id = channel_id or self.detect_channel_id(ts3_facade, db_id, guild_name)
+            if channel_id is not None:
+                self._audit_channel(ts3_facade, channel_id, guild_name, ts_group, icon_id)
+
+            LOG.info("Auditing Group...")
+            group_id = group_id or self.detect_group_id(ts3_facade, db_id, ts_group)
+            if group_id is not None:
+                self._audit_group(ts3_facade, group_id, ts_group, icon_id, sort_key)
+
+        if channel_id is not None and group_id is not None:
+            # not part of the registry, storing it must not reload the guilds for every audited guild
+            with self._database.lock:
+                self._database.cursor.execute("UPDATE guilds SET audit_fingerprint = ? WHERE guild_id = ?",
+                                              (self._audit_fingerprint(guild_info, ts_group, channel_id, group_id, sort_key), db_id))
+                self._database.conn.commit()
@@ -1,15 +1,19 @@
 from .account import Account
-from .character import Character
-from .facade import ApiError, ApiKeyInvalidError, ApiUnavailableError, \
-    account_get, characters_get, \
-    guild_get, guild_get_full, guild_search, worlds_get_by_ids, \
-    worlds_get_ids, worlds_get_one
+from .character import Character, CharacterCore
+from .circuit_breaker import CircuitBreaker
+from .facade import ApiError, ApiKeyInvalidError, ApiUnavailableError, CircuitOpenError, \
+    account_get, api_key_hash, character_get_core, characters_get_names, circuit_breaker, \
+    guild_get, guild_get_full, guild_get_uncached, guild_search, is_api_key_known_invalid, mark_api_key_invalid, worlds_get_by_ids, \
+    rate_limiter, tokeninfo_get, worlds_get_ids, worlds_get_one
 from .guild import AnonymousGuild, Guild
+from .rate_limiter import RateLimiter
+from .token_info import TokenInfo
 from .world import World
 
-__all__ = ["ApiError", "ApiUnavailableError", "ApiKeyInvalidError",
+__all__ = ["ApiError", "ApiUnavailableError", "ApiKeyInvalidError", "CircuitOpenError",
+           "CircuitBreaker", "circuit_breaker", "RateLimiter", "rate_limiter",
            "worlds_get_ids", "worlds_get_by_ids", "worlds_get_one",
-           "guild_get", "guild_search", "guild_get_full",
-           "account_get",
-           "characters_get",
-           "World", "Character", "Account", "AnonymousGuild", "Guild"]
+           "guild_get", "guild_get_uncached", "guild_search", "guild_get_full",
+           "account_get", "tokeninfo_get", "api_key_hash", "mark_api_key_invalid", "is_api_key_known_invalid",
+           "characters_get_names", "character_get_core",
+           "World", "Character", "CharacterCore", "Account", "AnonymousGuild", "Guild", "TokenInfo"]
@@ -0,0 +1,79 @@
+import logging
+import threading
+
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to the gw2 api once it failed several times in a row.
+
+    closed: requests are sent, consecutive failures are counted
+    open: requests are rejected right away until reset_timeout passed
+    half open: exactly one probe request is let through. Success closes the circuit again, failure opens it for another reset_timeout.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def is_open(self) -> bool:
+        """True while requests would be rejected"""
+        with self._lock:
+            state = self._current_state()
+            return state == CircuitBreaker.OPEN or (state == CircuitBreaker.HALF_OPEN and self._probe_in_flight)
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            state = self._current_state()
+            if state == CircuitBreaker.CLOSED:
+                return True
+            if state == CircuitBreaker.HALF_OPEN and not self._probe_in_flight:
+                LOG.info("Probing whether the GW2 API is available again.")
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CircuitBreaker.CLOSED:
+                LOG.info("GW2 API is available again. Closing circuit.")
+            self._state = CircuitBreaker.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probe_in_flight or self._failures >= self._failure_threshold:
+                if self._state == CircuitBreaker.CLOSED:
+                    LOG.warning("GW2 API failed %s times in a row. Pausing requests for %s seconds.", self._failures, self._reset_timeout)
+                self._state = CircuitBreaker.OPEN
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """Ends a request that neither proved the api available nor unavailable"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def _current_state(self) -> str:
+        if self._state == CircuitBreaker.OPEN and self._opened_at + self._reset_timeout <= time.monotonic():
+            self._state = CircuitBreaker.HALF_OPEN
+        return self._state
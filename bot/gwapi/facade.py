@@ -1,14 +1,21 @@
+import hashlib
 import logging
+import threading
 from functools import wraps
 from typing import List, Optional
+from urllib.parse import quote
 
 from cachetools import LRUCache, TTLCache, cached
+from cachetools.keys import hashkey
 from gw2api import GuildWars2Client
-from requests import HTTPError
+from requests import ConnectionError as RequestsConnectionError, HTTPError, Timeout
 
 from .account import Account
-from .character import Character
+from .character import CharacterCore
+from .circuit_breaker import CircuitBreaker
 from .guild import AnonymousGuild, Guild
+from .rate_limiter import RateLimiter
+from .token_info import TokenInfo
 from .world import World
 
 # Available api endpoints:
@@ -35,8 +42,17 @@ from .world import World
 #
 LOG = logging.getLogger(__name__)
 
+# shared by all requests, opens after consecutive unavailability of the api
+circuit_breaker = CircuitBreaker()
 
-@cached(cache=TTLCache(maxsize=32, ttl=300))  # cache user specific clients for 5 min - creation takes quite long
+# shared by all requests, keeps parallel audits within the request budget of the api
+rate_limiter = RateLimiter()
+
+# the caches are accessed from several threads concurrently (verification, audit workers, parallel lookups)
+_cache_lock = threading.RLock()
+
+
+@cached(cache=TTLCache(maxsize=32, ttl=300), lock=_cache_lock)  # cache user specific clients for 5 min - creation takes quite long
 def _create_client(api_key: str = None) -> GuildWars2Client:
     return GuildWars2Client(version='v2', api_key=api_key)
 
@@ -54,6 +70,10 @@ class ApiUnavailableError(ApiError):
     pass
 
 
+class CircuitOpenError(ApiUnavailableError):
+    """The request was not sent at all, the circuit breaker rejected it"""
+
+
 class ApiKeyInvalidError(ApiError):
     pass
 
@@ -61,44 +81,102 @@ class ApiKeyInvalidError(ApiError):
 def error_checked(decorator):
     @wraps(decorator)
     def wrapper(*args, **kw):
+        if not circuit_breaker.allow_request():
+            raise CircuitOpenError("Circuit open, GW2 API is considered unavailable")
+        rate_limiter.acquire()
         try:
-            if len(args) == 1 and not kw and callable(args[0]):
-                result = decorator()(args[0])
-            else:
-                result = decorator(*args, **kw)
-        except HTTPError as e:
-            status_code = e.response.status_code
-            json = e.response.json()
-            if json is not None and "text" in json:
-                error_text = json["text"]
-                if error_text == "Invalid access token":
-                    raise ApiKeyInvalidError(error_text) from e
-                if error_text == "too many requests":
-                    raise ApiUnavailableError("Rate Limited") from e
-                if error_text == "ErrTimeout":  # happens on login server down
-                    raise ApiUnavailableError(error_text) from e
-                if error_text == "ErrInternal":
-                    raise ApiUnavailableError(error_text) from e
-                if error_text in ("invalid key", "Invalid access token"):  # when key is invalid or not a key at all
-                    raise ApiKeyInvalidError(error_text) from e
-                LOG.warning("API Returned Error %s - %s", status_code, error_text)
-                raise ApiError(str(status_code) + ":" + error_text) from e
-            LOG.warning("API Returned %s - %s", status_code, e.response.text)
-            raise ApiError("Unknown API Error") from e
-        # if result:
-        #     _check_error(result)
+            result = _call_translating_errors(decorator, args, kw)
+        except ApiUnavailableError:
+            circuit_breaker.record_failure()
+            raise
+        except ApiError:
+            circuit_breaker.record_success()  # the api did answer, just not with the expected result
+            raise
+        except BaseException:
+            circuit_breaker.release_probe()  # says nothing about the api, but must not block the next probe
+            raise
+        circuit_breaker.record_success()
         return result
 
     return wrapper
 
 
-@cached(cache=TTLCache(maxsize=20, ttl=60 * 60))  # cache for 1h
+def _call_translating_errors(decorator, args, kw):
+    try:
+        if len(args) == 1 and not kw and callable(args[0]):
+            result = decorator()(args[0])
+        else:
+            result = decorator(*args, **kw)
+    except (RequestsConnectionError, Timeout) as e:
+        raise ApiUnavailableError(str(e)) from e
+    except HTTPError as e:
+        status_code = e.response.status_code
+        try:
+            json = e.response.json()
+        except ValueError:  # e.g. html error pages of a proxy in front of the api
+            json = None
+        if json is not None and "text" in json:
+            error_text = json["text"]
+            if error_text == "Invalid access token":
+                raise ApiKeyInvalidError(error_text) from e
+            if error_text == "too many requests":
+                raise ApiUnavailableError("Rate Limited") from e
+            if error_text == "ErrTimeout":  # happens on login server down
+                raise ApiUnavailableError(error_text) from e
+            if error_text == "ErrInternal":
+                raise ApiUnavailableError(error_text) from e
+            if error_text in ("invalid key", "Invalid access token"):  # when key is invalid or not a key at all
+                raise ApiKeyInvalidError(error_text) from e
+            LOG.warning("API Returned Error %s - %s", status_code, error_text)
+            raise ApiError(str(status_code) + ":" + error_text) from e
+        LOG.warning("API Returned %s - %s", status_code, e.response.text)
+        if status_code in (502, 503, 504):
+            raise ApiUnavailableError(f"HTTP {status_code}") from e
+        raise ApiError("Unknown API Error") from e
+    # if result:
+    #     _check_error(result)
+    return result
+
+
+def api_key_hash(api_key: str) -> str:
+    """Stable identifier for an api key, so keys do not have to be kept around in plain text as cache keys"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+# keys the api rejected recently. Repeated submissions of the same broken key are answered without asking the api again.
+# Kept short, as brand-new keys may be rejected for a moment.
+_invalid_api_keys = TTLCache(maxsize=1024, ttl=2 * 60)  # remember for 2 min
+
+
+def mark_api_key_invalid(api_key: str):
+    with _cache_lock:
+        _invalid_api_keys[api_key_hash(api_key)] = True
+
+
+def is_api_key_known_invalid(api_key: str) -> bool:
+    with _cache_lock:
+        return api_key_hash(api_key) in _invalid_api_keys
+
+
+@cached(cache=TTLCache(maxsize=128, ttl=300), key=lambda api_key: hashkey(api_key_hash(api_key)), lock=_cache_lock)  # cache for 5 min
 @error_checked
-def guild_get(guild_id: str) -> Optional[AnonymousGuild]:
+def tokeninfo_get(api_key: str) -> TokenInfo:
+    api = _create_client(api_key=api_key)
+    return api.tokeninfo.get()
+
+
+@error_checked
+def guild_get_uncached(guild_id: str) -> Optional[AnonymousGuild]:
+    """Always asks the gw2 api, e.g. to refresh the guild cache"""
     return _anonymousClient.guildid.get(guild_id)
 
 
-@cached(cache=TTLCache(maxsize=10, ttl=300))  # cache clients for 5 min - creation takes quite long
+@cached(cache=TTLCache(maxsize=20, ttl=60 * 60), lock=_cache_lock)  # cache for 1h
+def guild_get(guild_id: str) -> Optional[AnonymousGuild]:
+    return guild_get_uncached(guild_id)
+
+
+@cached(cache=TTLCache(maxsize=10, ttl=300), lock=_cache_lock)  # cache clients for 5 min - creation takes quite long
 @error_checked
 def guild_get_full(api_key: str, guild_id: str) -> Optional[Guild]:
     api = _create_client(api_key=api_key)
@@ -110,7 +188,7 @@ def guild_search_internal(guild_name: str) -> Optional[str]:
     return _anonymousClient.guildsearch.get(name=guild_name)
 
 
-@cached(cache=TTLCache(maxsize=32, ttl=600))  # cache for 10 min
+@cached(cache=TTLCache(maxsize=32, ttl=600), lock=_cache_lock)  # cache for 10 min
 def guild_search(guild_name: str) -> Optional[str]:
     search_result = guild_search_internal(guild_name)
     if len(search_result) == 0:
@@ -120,21 +198,27 @@ def guild_search(guild_name: str) -> Optional[str]:
     return search_result[0]
 
 
-@cached(cache=TTLCache(maxsize=32, ttl=300))  # cache clients for 5 min - creation takes quite long
+@cached(cache=TTLCache(maxsize=32, ttl=300), lock=_cache_lock)  # cache clients for 5 min - creation takes quite long
 @error_checked
 def account_get(api_key: str) -> Account:
     api = _create_client(api_key=api_key)
     return api.account.get()
 
 
-@cached(cache=TTLCache(maxsize=32, ttl=300))  # cache clients for 5 min - creation takes quite long
+@cached(cache=TTLCache(maxsize=32, ttl=300), lock=_cache_lock)  # cache clients for 5 min - creation takes quite long
 @error_checked
-def characters_get(api_key: str) -> List[Character]:
+def characters_get_names(api_key: str) -> List[str]:
     api = _create_client(api_key=api_key)
-    return api.characters.get(page="0", page_size=200)
+    return api.characters.get()
 
 
-@cached(cache=LRUCache(maxsize=10))
+@error_checked
+def character_get_core(api_key: str, character_name: str) -> CharacterCore:
+    api = _create_client(api_key=api_key)
+    return api.characterscore.get(quote(character_name))
+
+
+@cached(cache=LRUCache(maxsize=10), lock=_cache_lock)
 @error_checked
 def worlds_get_ids() -> List[int]:
     return _anonymousClient.worlds.get(ids=None)
@@ -145,8 +229,7 @@ def worlds_get_by_ids(ids: List[int]) -> List[World]:
     return _anonymousClient.worlds.get(ids=ids)
 
 
-@cached(cache=LRUCache(maxsize=10))
-@error_checked
+@cached(cache=LRUCache(maxsize=10), lock=_cache_lock)  # not error_checked itself, worlds_get_by_ids already is
 def worlds_get_one(world_id: int = None) -> Optional[World]:
     worlds = worlds_get_by_ids([world_id])
     if len(worlds) == 1:
@@ -0,0 +1,40 @@
+import threading
+
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the requests sent to the gw2 api.
+    Up to `burst` requests can be sent at once, afterwards `rate` requests per second are allowed.
+    A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate: float = 5, burst: int = 10):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+
+    def configure(self, rate: float, burst: int = None):
+        with self._lock:
+            self._rate = rate
+            if burst is not None:
+                self._burst = burst
+            self._tokens = min(self._tokens, float(self._burst))
+
+    def acquire(self):
+        """Blocks until a request may be sent"""
+        while True:
+            with self._lock:
+                if self._rate <= 0:
+                    return
+                now = time.monotonic()
+                self._tokens = min(float(self._burst), self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
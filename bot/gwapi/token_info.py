@@ -0,0 +1,8 @@
+from typing import List, TypedDict
+
+
+# example https://api.guildwars2.com/v2/tokeninfo?access_token=564F181A-F0FC-114A-A55D-3C1DCD45F3767AF3848F-AB29-4EBF-9594-F91E6A75E015
+class TokenInfo(TypedDict):
+    id: str
+    name: str
+    permissions: List[str]
@@ -8,12 +8,13 @@ import configargparse
 import schedule
 import ts3
 
+import bot.gwapi as gw2api
 from bot import Bot
 from bot.config import Config
 from bot.connection_pool import ConnectionInitializationException, ConnectionPool
 from bot.db import get_or_create_database
 from bot.rest import create_http_server
-from bot.ts import TS3Facade, create_connection
+from bot.ts import ServerGroupRegistry, TS3Facade, create_connection
 from bot.util import RepeatTimer
 
 LOG = logging.getLogger(__name__)
@@ -23,6 +24,7 @@ def main(args: Namespace):  #
     LOG.info("Initializing script....")
 
     config = Config(args.config_path)
+    gw2api.rate_limiter.configure(config.gw2_api_rate_limit)
 
     # setup resources
     database = get_or_create_database(config.db_file_name, config.current_version)
@@ -65,6 +67,7 @@ def _continuous_loop(config, database, ts_connection_pool):
 
             bot_instance = None
             audit_trigger_job = None
+            reconcile_job = None
             http_server = None
             try:
                 bot_instance = Bot(database, ts_connection_pool, config)
@@ -78,9 +81,10 @@ def _continuous_loop(config, database, ts_connection_pool):
                 # bot_instance.trigger_user_audit()
                 # bot_instance.trigger_guild_audit()
 
-                # Set audit schedule job to run in X days
-                audit_trigger_job = schedule.every(config.audit_interval).days.at("06:00").do(bot_instance.trigger_user_audit)
+                # Users are audited continuously by the audit scheduler, guilds once a week
                 audit_trigger_job = schedule.every(7).days.at("05:00").do(bot_instance.trigger_guild_audit)
+                # nightly check of all server groups against the registered users
+                reconcile_job = schedule.every().day.at("04:00").do(bot_instance.trigger_group_reconcile)
                 bot_instance.listen_for_events()
             finally:
                 if bot_instance is not None:
@@ -89,6 +93,9 @@ def _continuous_loop(config, database, ts_connection_pool):
                 if audit_trigger_job is not None:
                     schedule.cancel_job(audit_trigger_job)
 
+                if reconcile_job is not None:
+                    schedule.cancel_job(reconcile_job)
+
                 if http_server is not None:
                     LOG.info("Stopping Http Server")
                     http_server.stop()
@@ -110,7 +117,8 @@ def create_connection_pool(config):
         whoami_response = obj.whoami()
         return whoami_response['virtualserver_id'] == config.server_id
 
-    return ConnectionPool(create=lambda: TS3Facade(create_connection(config, config.bot_nickname)),
+    servergroup_registry = ServerGroupRegistry(config.servergroup_cache_ttl)  # shared by all connections
+    return ConnectionPool(create=lambda: TS3Facade(create_connection(config, config.bot_nickname), servergroup_registry),
                           destroy_function=lambda obj: obj.close(),
                           test_function=_test_connection,
                           max_size=config.pool_size,
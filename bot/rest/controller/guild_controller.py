@@ -1,11 +1,11 @@
 import logging
 
-from flask import jsonify, request
+from flask import Response, current_app, jsonify, request
 from werkzeug.exceptions import BadRequest, HTTPException
 
 from bot import GuildAuditService, GuildService
 from bot.rest.controller.abstract_controller import AbstractController
-from bot.rest.utils import try_get
+from bot.rest.utils import audit_progress_response, audit_queue_response, try_get
 
 LOG = logging.getLogger(__name__)
 
@@ -47,14 +47,23 @@ class GuildController(AbstractController):
         def _guild_channels():
             LOG.info("Received request list guild channels")
 
-            res = list(self._service.list_channels())
-            if res is not None and len(res) > 0:
-                return jsonify(res)
-            else:
+            channels = iter(self._service.list_channels())
+            first = next(channels, None)
+            if first is None:
                 http_exception = HTTPException()
                 http_exception.code = 204
                 raise http_exception
 
+            dumps = current_app.json.dumps
+
+            def _stream():
+                yield "[" + dumps(first)
+                for channel in channels:
+                    yield "," + dumps(channel)
+                yield "]"
+
+            return Response(_stream(), mimetype="application/json")
+
         @self.api.route("/guild", methods=["DELETE"])
         def _delete_guild():
             name = try_get(request.json, "name", default=None)
@@ -71,5 +80,13 @@ class GuildController(AbstractController):
         @self.api.route("/guild/_audit", methods=["POST"])
         def _trigger_audit():
             LOG.info("Received request to audit guilds")
-            self._audit_service.trigger_guild_audit()
-            return jsonify("Triggered")
+            _, started = self._audit_service.trigger_guild_audit()
+            return jsonify("Triggered" if started else "Already running")
+
+        @self.api.route("/guild/_audit", methods=["GET"])
+        def _audit_progress():
+            return audit_progress_response(self._audit_service)
+
+        @self.api.route("/guild/_audit/queue", methods=["GET"])
+        def _audit_queue():
+            return audit_queue_response(self._audit_service)
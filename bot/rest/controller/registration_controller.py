@@ -4,7 +4,7 @@ from flask import jsonify, request
 
 from bot import AuditService, UserService
 from bot.rest.controller.abstract_controller import AbstractController
-from bot.rest.utils import try_get
+from bot.rest.utils import audit_progress_response, audit_queue_response, try_get
 
 LOG = logging.getLogger(__name__)
 
@@ -27,5 +27,13 @@ class RegistrationController(AbstractController):
         @self.api.route("/registration/_audit", methods=["POST"])
         def _trigger_audit():
             LOG.info("Received request to audit")
-            self._audit_service.trigger_user_audit()
-            return jsonify("Triggered")
+            _, started = self._audit_service.trigger_user_audit()
+            return jsonify("Triggered" if started else "Already running")
+
+        @self.api.route("/registration/_audit", methods=["GET"])
+        def _audit_progress():
+            return audit_progress_response(self._audit_service)
+
+        @self.api.route("/registration/_audit/queue", methods=["GET"])
+        def _audit_queue():
+            return audit_queue_response(self._audit_service)
@@ -1,4 +1,5 @@
+from .audit_utils import audit_progress_response, audit_queue_response
 from .error_utils import error_response
 from .utils import try_get
 
-__all__ = ['try_get', 'error_response']
+__all__ = ['try_get', 'error_response', 'audit_progress_response', 'audit_queue_response']
@@ -0,0 +1,25 @@
+import dataclasses
+
+from flask import Response, jsonify
+from werkzeug.exceptions import HTTPException
+
+from bot.audit_queue_service import AuditQueueService
+
+
+def audit_progress_response(audit_service: AuditQueueService) -> Response:
+    """Progress of the running or last full audit, 204 if there was none yet"""
+    audit_run = audit_service.audit_run()
+    if audit_run is None:
+        http_exception = HTTPException()
+        http_exception.code = 204
+        raise http_exception
+    return jsonify(audit_run.progress())
+
+
+def audit_queue_response(audit_service: AuditQueueService) -> Response:
+    return jsonify({
+        "pending": audit_service.pending_audits(),
+        "oldest_pending_seconds": round(audit_service.oldest_pending_audit_age()),
+        "lateness": {str(priority): dataclasses.asdict(lateness) for priority, lateness in audit_service.audit_lateness().items()},
+        "workers": [dataclasses.asdict(metrics) for metrics in audit_service.worker_metrics()],
+    })
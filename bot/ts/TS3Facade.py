@@ -1,6 +1,6 @@
 import logging
 import os
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import ts3
 from ts3 import TS3Error
@@ -9,6 +9,7 @@ from ts3.query import TS3TimeoutError
 
 from bot.ts.ThreadSafeTSConnection import ThreadSafeTSConnection, ignore_exception_handler, signal_exception_handler
 from bot.ts.model import Channel
+from bot.ts.servergroup_registry import ServerGroupRegistry
 from bot.ts.types.channel_list_detail import ChannelListDetail
 from bot.ts.types.whoami import WhoamiResponse
 
@@ -16,8 +17,9 @@ LOG = logging.getLogger(__name__)
 
 
 class TS3Facade:
-    def __init__(self, ts3_connection: ThreadSafeTSConnection):
+    def __init__(self, ts3_connection: ThreadSafeTSConnection, servergroup_registry: Optional[ServerGroupRegistry] = None):
         self._ts3_connection = ts3_connection
+        self._servergroup_registry = servergroup_registry if servergroup_registry is not None else ServerGroupRegistry()
 
     def __str__(self):
         return f"TS3Facade[{self._ts3_connection}]"
@@ -73,8 +75,14 @@ class TS3Facade:
     def channel_delete(self, channel_id: int, force: bool = False):
         self._ts3_connection.ts3exec(lambda tsc: tsc.exec_("channeldelete", cid=channel_id, force=1 if force else 0))
 
-    # FIXME: tests
     def servergroup_list(self):
+        """All server groups, served from the shared registry"""
+        return self._servergroup_registry.groups(self._servergroup_list_uncached)
+
+    def servergroup_id(self, servergroup_name: str) -> Optional[str]:
+        return self._servergroup_registry.sgid(servergroup_name, self._servergroup_list_uncached)
+
+    def _servergroup_list_uncached(self):
         resp, _ = self._ts3_connection.ts3exec(lambda tsc: tsc.query("servergrouplist").all())
         return resp
 
@@ -84,6 +92,7 @@ class TS3Facade:
     # FIXME: tests
     def servergroup_delete(self, servergroup_id: int, force: bool = False):
         self._ts3_connection.ts3exec(lambda tsc: tsc.exec_("servergroupdel", sgid=servergroup_id, force=1 if force else 0))
+        self._servergroup_registry.invalidate()
 
     # FIXME: tests
     def channel_create(self,
@@ -107,11 +116,39 @@ class TS3Facade:
                                                                         permskip=1 if skip else 0))
 
     def channel_add_permissions(self, channel_id: int, permissions: List[Tuple[str, int]]):
-        for permission_id, permission_value in permissions:
-            self.channel_add_permission(channel_id, permission_id=permission_id, permission_value=permission_value)
+        """Sets all permissions of the channel with a single piped command"""
+        if len(permissions) == 0:
+            return None, None
+
+        def _add(tsc):
+            (permission_id, permission_value), *others = permissions
+            query = tsc.query("channeladdperm", cid=channel_id, permsid=permission_id, permvalue=permission_value, permnegated=0, permskip=0)
+            for permission_id, permission_value in others:
+                query = query.pipe(permsid=permission_id, permvalue=permission_value, permnegated=0, permskip=0)
+            return query.fetch()
+
+        return self._ts3_connection.ts3exec(_add, signal_exception_handler)
+
+    def channel_permission_list(self, channel_id: int) -> Dict[str, int]:
+        """Permissions set on the channel itself, by permission name"""
+        return self._permission_list(lambda tsc: tsc.query("channelpermlist", "permsid", cid=channel_id).all())
 
-    def channel_list(self) -> List[ChannelListDetail]:
-        return self._ts3_connection.ts3exec_raise(lambda tc: tc.query("channellist").all())
+    def servergroup_permission_list(self, servergroup_id: int) -> Dict[str, int]:
+        """Permissions set on the server group, by permission name"""
+        return self._permission_list(lambda tsc: tsc.query("servergrouppermlist", "permsid", sgid=servergroup_id).all())
+
+    def _permission_list(self, query) -> Dict[str, int]:
+        response, ex = self._ts3_connection.ts3exec(query, signal_exception_handler)
+        if ex is None:
+            return {permission.get("permsid"): int(permission.get("permvalue")) for permission in response}
+        if hasattr(ex, "resp") and ex.resp is not None and ex.resp.error["id"] == "1281":  # database empty result set
+            return {}
+        raise ex
+
+    def channel_list(self, seconds_empty: bool = False) -> List[ChannelListDetail]:
+        """All channels, with seconds_empty the time each channel has been empty is included as well"""
+        options = ["secondsempty"] if seconds_empty else []
+        return self._ts3_connection.ts3exec_raise(lambda tc: tc.query("channellist", *options).all())
 
     def use(self, server_id: int, timeout=5):
         self._ts3_connection.ts3exec_raise(lambda tc: tc.query("use", sid=server_id).timeout(timeout=timeout).fetch())
@@ -153,7 +190,9 @@ class TS3Facade:
         self._ts3_connection.ts3exec(_upload)
 
     def servergroup_add(self, servergroup_name: str):
-        return self._ts3_connection.ts3exec(lambda tsc: tsc.query("servergroupadd", name=servergroup_name).first(), signal_exception_handler)
+        result = self._ts3_connection.ts3exec(lambda tsc: tsc.query("servergroupadd", name=servergroup_name).first(), signal_exception_handler)
+        self._servergroup_registry.invalidate()
+        return result
 
     def servergroup_add_permission(self, servergroup_id: str, permission_id: str, permission_value: int, negated: bool = False, skip: bool = False):
         return self._ts3_connection.ts3exec(lambda tsc: tsc.exec_("servergroupaddperm",
@@ -164,8 +203,18 @@ class TS3Facade:
                                             signal_exception_handler)
 
     def servergroup_add_permissions(self, servergroup_id: str, permissions: List[Tuple[str, int]]):
-        for permission_id, permission_value in permissions:
-            self.servergroup_add_permission(servergroup_id, permission_id=permission_id, permission_value=permission_value)
+        """Sets all permissions of the server group with a single piped command"""
+        if len(permissions) == 0:
+            return None, None
+
+        def _add(tsc):
+            (permission_id, permission_value), *others = permissions
+            query = tsc.query("servergroupaddperm", sgid=servergroup_id, permsid=permission_id, permvalue=permission_value, permnegated=0, permskip=0)
+            for permission_id, permission_value in others:
+                query = query.pipe(permsid=permission_id, permvalue=permission_value, permnegated=0, permskip=0)
+            return query.fetch()
+
+        return self._ts3_connection.ts3exec(_add, signal_exception_handler)
 
     def channelgroup_list(self):
         return self._ts3_connection.ts3exec(lambda tsc: tsc.query("channelgrouplist").all(), signal_exception_handler)
@@ -196,6 +245,40 @@ class TS3Facade:
         _, ex = self._ts3_connection.ts3exec(lambda tsc: tsc.exec_("servergroupdelclient", sgid=servergroup_id, cldbid=client_db_id), signal_exception_handler)
         return ex
 
+    def servergroup_client_list(self, servergroup_id: str) -> List[str]:
+        """Database ids of all members of the server group"""
+        response, ex = self._ts3_connection.ts3exec(lambda t: t.query("servergroupclientlist", sgid=servergroup_id).all(), exception_handler=signal_exception_handler)
+        if ex is None:
+            return [member.get("cldbid") for member in response]
+        if hasattr(ex, "resp") and ex.resp is not None and ex.resp.error["id"] == "1281":  # database empty result set
+            return []
+        raise ex
+
+    def servergroup_clients_add(self, servergroup_id: str, client_db_ids: List[str], chunk_size: int = 100):
+        """Adds several clients to the server group, with one piped command per chunk_size clients"""
+        return self._servergroup_clients_modify("servergroupaddclient", servergroup_id, client_db_ids, chunk_size)
+
+    def servergroup_clients_del(self, servergroup_id: str, client_db_ids: List[str], chunk_size: int = 100):
+        """Removes several clients from the server group, with one piped command per chunk_size clients"""
+        return self._servergroup_clients_modify("servergroupdelclient", servergroup_id, client_db_ids, chunk_size)
+
+    def _servergroup_clients_modify(self, command: str, servergroup_id: str, client_db_ids: List[str], chunk_size: int) -> List[Tuple[List[str], Exception]]:
+        """returns: the chunks that failed, each with its error"""
+        errors = []
+        for start in range(0, len(client_db_ids), chunk_size):
+            chunk = client_db_ids[start:start + chunk_size]
+
+            def _modify(tsc, chunk=chunk):
+                query = tsc.query(command, sgid=servergroup_id, cldbid=chunk[0])
+                for client_db_id in chunk[1:]:
+                    query = query.pipe(cldbid=client_db_id)
+                return query.fetch()
+
+            _, ex = self._ts3_connection.ts3exec(_modify, signal_exception_handler)
+            if ex is not None:
+                errors.append((chunk, ex))
+        return errors
+
     def server_notify_register(self, events: List[str]):
         for event in events:
             self._ts3_connection.ts3exec(lambda tc: tc.exec_("servernotifyregister", event=event))  # alert channel chat
@@ -225,6 +308,27 @@ class TS3Facade:
 
         raise ex
 
+    def client_db_ids_by_uid(self, page_size: int = 200) -> Dict[str, str]:
+        """
+        Database ids of all clients known to the server, by unique id.
+        Reads the client database in pages, one query per page_size clients instead of one clientgetdbidfromuid per client.
+        """
+        client_db_ids = {}
+        start = 0
+        while True:
+            page, ex = self._ts3_connection.ts3exec(lambda t: t.query("clientdblist", start=start, duration=page_size).all(), exception_handler=signal_exception_handler)
+            if ex is not None:
+                if hasattr(ex, "resp") and ex.resp is not None and ex.resp.error["id"] == "1281":  # database empty result set
+                    break
+                raise ex
+
+            for client in page:
+                client_db_ids[client.get("client_unique_identifier")] = client.get("cldbid")
+            if len(page) < page_size:
+                break
+            start += page_size
+        return client_db_ids
+
     def client_ids_from_uid(self, client_uid) -> List[str]:
         response, ex = self._ts3_connection.ts3exec(lambda t: t.query("clientgetids", cluid=client_uid).all(), exception_handler=signal_exception_handler)
         if ex is None:
@@ -260,6 +364,8 @@ class TS3Facade:
         return self._ts3_connection.ts3exec_raise(lambda t: t.query("serverinfo").first())
 
     def servergroup_rename(self, group_id: int, desired_name: str):
-        return self._ts3_connection.ts3exec(lambda tsc: tsc.exec_("servergrouprename", sgid=group_id, name=desired_name), signal_exception_handler)
+        result = self._ts3_connection.ts3exec(lambda tsc: tsc.exec_("servergrouprename", sgid=group_id, name=desired_name), signal_exception_handler)
+        self._servergroup_registry.invalidate()
+        return result
 
     pass
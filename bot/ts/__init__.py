@@ -2,11 +2,12 @@ from .TS3Facade import TS3Facade
 from .ThreadSafeTSConnection import ThreadSafeTSConnection, create_connection, default_exception_handler, \
     ignore_exception_handler, signal_exception_handler
 from .model import Channel, User
+from .servergroup_registry import ServerGroupRegistry
 from .ts3_extensions import ExtendedTS3QueryBuilder, ExtendedTS3ServerConnection
 
 __all__ = [
     'ExtendedTS3ServerConnection', 'ExtendedTS3QueryBuilder',
-    'Channel', 'TS3Facade',
+    'Channel', 'TS3Facade', 'ServerGroupRegistry',
     'ThreadSafeTSConnection', 'create_connection',
     'ignore_exception_handler', 'signal_exception_handler', 'default_exception_handler',
     'User',
@@ -0,0 +1,54 @@
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class ServerGroupRegistry:
+    """
+    Server group list of the teamspeak server, shared by all facades of the connection pool.
+    The list is reloaded after ttl seconds, to pick up groups changed by someone else, and right away after the bot itself
+    added, deleted or renamed a group.
+    """
+
+    def __init__(self, ttl: float = 300):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._groups: Optional[List[dict]] = None
+        self._sgid_by_name: Dict[str, str] = {}
+        self._loaded_at = 0.0
+        self._generation = 0  # bumped by invalidate(), so a load racing with a change is not kept
+
+    def invalidate(self):
+        with self._lock:
+            self._groups = None
+            self._generation += 1
+
+    def groups(self, load: Callable[[], List[dict]]) -> List[dict]:
+        groups, _ = self._get(load)
+        return list(groups)
+
+    def sgid(self, name: str, load: Callable[[], List[dict]]) -> Optional[str]:
+        _, sgid_by_name = self._get(load)
+        return sgid_by_name.get(name)
+
+    def _get(self, load: Callable[[], List[dict]]):
+        with self._lock:
+            if self._groups is not None and self._loaded_at + self._ttl > time.monotonic():
+                return self._groups, self._sgid_by_name
+            generation = self._generation
+
+        # loaded without holding the lock, other facades must not wait on this connection
+        groups = load()
+        if groups is None:  # e.g. the query failed, try again on the next lookup
+            LOG.warning("Server groups could not be loaded")
+            return [], {}
+        sgid_by_name = {group.get("name"): group.get("sgid") for group in groups}
+        LOG.debug("Loaded %s server groups", len(groups))
+        with self._lock:
+            if generation == self._generation:
+                self._groups, self._sgid_by_name, self._loaded_at = groups, sgid_by_name, time.monotonic()
+        return groups, sgid_by_name
@@ -1,10 +1,14 @@
 from typing import TypedDict
 
 
-class ChannelListDetail(TypedDict):
+class _ChannelListDetail(TypedDict):
     cid: str
     pid: str
     channel_order: str
     channel_name: str
     total_clients: str
     channel_needed_subscribe_power: str
+
+
+class ChannelListDetail(_ChannelListDetail, total=False):
+    seconds_empty: str  # only with -secondsempty
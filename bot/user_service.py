@@ -1,28 +1,109 @@
+import json
 import logging
+import random
+import threading
+from datetime import date
+from typing import Set
 
+import time
 import ts3
+from cachetools import LRUCache
 from ts3.query import TS3QueryError
 
 from bot.config import Config
 from bot.connection_pool import ConnectionPool
-from bot.db import ThreadSafeDBConnection
+from bot.db import ThreadSafeDBConnection, WriteBuffer
 from bot.ts import TS3Facade
+from .guild_registry import GuildRegistry
 
 LOG = logging.getLogger(__name__)
 
+AUDIT_JITTER = 0.1  # share of the audit period by which the next audit is moved at random, so audits do not cluster
+HIDDEN_GUILDS_CACHE_SIZE = 4096  # users whose hidden guilds are kept in memory
+
+
+def next_audit_at(audit_period: int) -> float:
+    """Unix timestamp for the next audit of a user, about audit_period days from now"""
+    period = audit_period * 24 * 60 * 60
+    return time.time() + period * random.uniform(1 - AUDIT_JITTER, 1 + AUDIT_JITTER)
+
 
 class UserService:
-    def __init__(self, database: ThreadSafeDBConnection, ts_connection_pool: ConnectionPool[TS3Facade], config: Config):
+    def __init__(self, database: ThreadSafeDBConnection, ts_connection_pool: ConnectionPool[TS3Facade], config: Config, guild_registry: GuildRegistry):
         self._database_connection = database
         self._ts_connection_pool = ts_connection_pool
         self._config = config
+        self._guild_registry = guild_registry
+
+        # ts unique id -> guild ids the user hides, filled on first use and dropped by invalidate_hidden_groups
+        self._hidden_guild_ids = LRUCache(maxsize=HIDDEN_GUILDS_CACHE_SIZE)
+        self._hidden_guild_ids_lock = threading.Lock()
+        self._hidden_guild_ids_generation = 0
+
+        # results of successful audits are written in batches, by ts unique id. Direct writes to a user drop their pending result.
+        self._audit_results = WriteBuffer(database, "UPDATE users SET last_audit_date = ?, account_name = ?, next_audit_at = ? WHERE ts_db_id= ?",
+                                          key=lambda row: row[-1])
 
         self.verified_group = config.verified_group
-        self.vgrp_id = self._find_group_by_name(self.verified_group)
+
+    def record_audit(self, client_unique_id, account_name: str, audit_date: date, next_audit: float):
+        """Stores the result of a successful audit, written with the next batch"""
+        self._audit_results.add((audit_date, account_name, next_audit, client_unique_id))
+
+    def close(self):
+        self._audit_results.close()
 
     def remove_user_from_db(self, client_db_id):
         with self._database_connection.lock:
+            self._audit_results.discard(client_db_id)
             self._database_connection.cursor.execute("DELETE FROM users WHERE ts_db_id=?", (client_db_id,))
+            self._database_connection.cursor.execute("DELETE FROM user_guilds WHERE ts_db_id=?", (client_db_id,))
+            self._database_connection.conn.commit()
+
+    def guild_tags_up_to_date(self, unique_client_id, auth) -> bool:
+        """
+        Whether neither the guilds of the user nor the guild groups they should wear changed since the bot last updated their groups.
+        In that case update_guild_tags would not change anything and teamspeak does not need to be asked.
+        """
+        if auth.guilds_error:
+            return False
+        with self._database_connection.lock:
+            snapshot = self._database_connection.cursor.execute("SELECT guild_ids, ts_groups FROM user_guilds WHERE ts_db_id = ?", (unique_client_id,)).fetchone()
+        if snapshot is None:
+            return False
+        guild_ids, ts_groups = snapshot
+        return json.loads(guild_ids) == sorted(auth.guilds or []) and json.loads(ts_groups) == sorted(self._desired_guild_groups(unique_client_id, auth))
+
+    def _desired_guild_groups(self, unique_client_id, auth) -> Set[str]:
+        ts_groups = set(self._guild_registry.ts_groups_of(auth.guild_names).values())
+        return ts_groups - self.hidden_groups(unique_client_id)
+
+    def hidden_groups(self, unique_client_id) -> Set[str]:
+        """Guild groups the user chose not to wear"""
+        with self._hidden_guild_ids_lock:
+            guild_ids = self._hidden_guild_ids.get(unique_client_id)
+            generation = self._hidden_guild_ids_generation
+        if guild_ids is None:
+            with self._database_connection.lock:
+                guild_ids = frozenset(row[0] for row in self._database_connection.cursor.execute(
+                    "SELECT guild_id FROM guild_ignores WHERE ts_db_id = ?", (unique_client_id,)).fetchall())
+            with self._hidden_guild_ids_lock:
+                if generation == self._hidden_guild_ids_generation:  # not invalidated while loading
+                    self._hidden_guild_ids[unique_client_id] = guild_ids
+        guilds = [self._guild_registry.by_id(guild_id) for guild_id in guild_ids]
+        return {guild.ts_group for guild in guilds if guild is not None and guild.ts_group is not None}
+
+    def invalidate_hidden_groups(self, unique_client_id):
+        """Has to be called after guild_ignores of the user changed"""
+        with self._hidden_guild_ids_lock:
+            self._hidden_guild_ids.pop(unique_client_id, None)
+            self._hidden_guild_ids_generation += 1
+
+    def _save_guild_snapshot(self, unique_client_id, auth):
+        with self._database_connection.lock:
+            self._database_connection.cursor.execute("INSERT OR REPLACE INTO user_guilds(ts_db_id, guild_ids, ts_groups, updated_at) VALUES(?,?,?,?)",
+                                                     (unique_client_id, json.dumps(sorted(auth.guilds or [])),
+                                                      json.dumps(sorted(self._desired_guild_groups(unique_client_id, auth))), time.time()))
             self._database_connection.conn.commit()
 
     def update_guild_tags(self, ts_facade, user, auth):
@@ -43,21 +124,16 @@ class UserService:
             pass
 
         # data of all guild groups the user is in
-        param = ",".join(["'%s'" % (cgn.replace('"', '\\"').replace("'", "\\'"),) for cgn in current_group_names])
-        # sanitisation is restricted to replacing single and double quotes. This should not be that much of a problem, since
-        # the input for the parameters here are the names of our own server groups on our TS server.
-        current_guild_groups = []
-        hidden_groups = {}
-        with self._database_connection.lock:
-            current_guild_groups = self._database_connection.cursor.execute("SELECT ts_group, guild_name FROM guilds WHERE ts_group IN (%s)" % (param,)).fetchall()
-            # groups the user doesn't want to wear
-            hidden_groups = set(
-                [g[0] for g in self._database_connection.cursor.execute("SELECT g.ts_group FROM guild_ignores AS gi JOIN guilds AS g ON gi.guild_id = g.guild_id  WHERE ts_db_id = ?", (uid,))])
+        current_guild_groups = [(guild.ts_group, guild.guild_name) for guild in map(self._guild_registry.by_ts_group, current_group_names) if guild is not None]
+        # groups the user doesn't want to wear
+        hidden_groups = self.hidden_groups(uid)
+        # whether the user got exactly the groups they should, only then the next audit may skip them
+        complete = True
         # REMOVE STALE GROUPS
         for ggroup, gname in current_guild_groups:
             if ggroup in hidden_groups:
                 LOG.info("Player %s chose to hide group '%s', which is now removed.", auth.name, ggroup)
-                ts_facade.servergroup_client_del(servergroup_id=ts_groups[ggroup], client_db_id=client_db_id)
+                complete &= ts_facade.servergroup_client_del(servergroup_id=ts_groups[ggroup], client_db_id=client_db_id) is None
             elif gname not in ingame_member_of:
                 if ggroup not in ts_groups:
                     LOG.warning(
@@ -65,39 +141,32 @@ class UserService:
                         " But no matching group exists."
                         " You should remove the entry for this guild from the db or check the spelling of the TS group in the DB. Skipping.",
                         ggroup, auth.name, gname)
+                    complete = False
                 else:
                     LOG.info("Player %s is no longer part of the guild '%s'. Removing attached group '%s'.", auth.name, gname, ggroup)
-                    ts_facade.servergroup_client_del(servergroup_id=ts_groups[ggroup], client_db_id=client_db_id)
+                    complete &= ts_facade.servergroup_client_del(servergroup_id=ts_groups[ggroup], client_db_id=client_db_id) is None
 
         # ADD DUE GROUPS
-        for g in ingame_member_of:
-            ts_group = None
-            with self._database_connection.lock:
-                ts_group = self._database_connection.cursor.execute("SELECT ts_group FROM guilds WHERE guild_name = ?", (g,)).fetchone()
-            if ts_group:
-                ts_group = ts_group[0]  # first and only column, if a row exists
-                if ts_group not in current_group_names:
-                    if ts_group in hidden_groups:
-                        LOG.info("Player %s is entitled to TS group '%s', but chose to hide it. Skipping.", auth.name, ts_group)
+        for g, ts_group in self._guild_registry.ts_groups_of(ingame_member_of).items():
+            if ts_group not in current_group_names:
+                if ts_group in hidden_groups:
+                    LOG.info("Player %s is entitled to TS group '%s', but chose to hide it. Skipping.", auth.name, ts_group)
+                else:
+                    if ts_group not in ts_groups:
+                        LOG.warning(
+                            "Player %s should be assigned the TS group '%s' because they are member of guild '%s'."
+                            " But the group does not exist. You should remove the entry for this guild from the db or create the group."
+                            " Skipping.",
+                            auth.name, ts_group, g)
+                        complete = False
                     else:
-                        if ts_group not in ts_groups:
-                            LOG.warning(
-                                "Player %s should be assigned the TS group '%s' because they are member of guild '%s'."
-                                " But the group does not exist. You should remove the entry for this guild from the db or create the group."
-                                " Skipping.",
-                                auth.name, ts_group, g)
-                        else:
-                            LOG.info("Player %s is member of guild '%s' and will be assigned the TS group '%s'.", auth.name, g, ts_group)
-                            ts_facade.servergroup_client_add(servergroup_id=ts_groups[ts_group], client_db_id=client_db_id)
-
-    # Helps find the group ID for a group name
-    def _find_group_by_name(self, group_to_find):
-        with self._ts_connection_pool.item() as ts_facade:
-            self.groups_list = ts_facade.servergroup_list()
-        for group in self.groups_list:
-            if group.get('name') == group_to_find:
-                return group.get('sgid')
-        return -1
+                        LOG.info("Player %s is member of guild '%s' and will be assigned the TS group '%s'.", auth.name, g, ts_group)
+                        complete &= ts_facade.servergroup_client_add(servergroup_id=ts_groups[ts_group], client_db_id=client_db_id) is None
+
+        if complete:
+            self._save_guild_snapshot(uid, auth)
+        else:
+            LOG.info("Guild groups of %s could not all be updated, they are checked again on the next audit.", auth.name)
 
     def check_client_needs_verify(self, unique_client_id):
         with self._ts_connection_pool.item() as ts_facade:
@@ -126,8 +195,9 @@ class UserService:
                 if client_db_id is None:
                     LOG.warning("User not found in Database.")
                 else:
-                    LOG.debug("Adding Permissions: CLUID [%s] SGID: %s   CLDBID: %s", unique_client_id, self.vgrp_id, client_db_id)
-                    ex = facade.servergroup_client_add(servergroup_id=self.vgrp_id, client_db_id=client_db_id)
+                    vgrp_id = facade.servergroup_id(self.verified_group)
+                    LOG.debug("Adding Permissions: CLUID [%s] SGID: %s   CLDBID: %s", unique_client_id, vgrp_id, client_db_id)
+                    ex = facade.servergroup_client_add(servergroup_id=vgrp_id, client_db_id=client_db_id)
                     if ex:
                         LOG.error("Unable to add client to '%s' group. Does the group exist?", self.verified_group)
         except ts3.query.TS3QueryError as err:
@@ -140,10 +210,11 @@ class UserService:
                 if client_db_id is None:
                     LOG.warning("User not found in Database.")
                 else:
-                    LOG.debug("Removing Permissions: CLUID [%s] SGID: %s   CLDBID: %s", unique_client_id, self.vgrp_id, client_db_id)
+                    vgrp_id = ts_facade.servergroup_id(self.verified_group)
+                    LOG.debug("Removing Permissions: CLUID [%s] SGID: %s   CLDBID: %s", unique_client_id, vgrp_id, client_db_id)
 
                     # Remove user from group
-                    ex = ts_facade.servergroup_client_del(servergroup_id=self.vgrp_id, client_db_id=client_db_id)
+                    ex = ts_facade.servergroup_client_del(servergroup_id=vgrp_id, client_db_id=client_db_id)
                     if ex:
                         LOG.error("Unable to remove client from '%s' group. Does the group exist and are they member of the group?", self.verified_group)
                     # Remove users from all groups, except the whitelisted ones
@@ -163,6 +234,8 @@ class UserService:
             for tdi, in ts_db_ids:
                 self.remove_permissions(tdi)
                 LOG.debug("Removed permissions from %s", tdi)
+                self._audit_results.discard(tdi)
+            self._database_connection.cursor.execute("DELETE FROM user_guilds WHERE ts_db_id IN (SELECT ts_db_id FROM users WHERE account_name = ?)", (gw2account,))
             self._database_connection.cursor.execute("DELETE FROM users WHERE account_name = ?", (gw2account,))
             changes = self._database_connection.cursor.execute("SELECT changes()").fetchone()[0]
             self._database_connection.conn.commit()
@@ -194,11 +267,13 @@ class UserService:
             client_exists = self._database_connection.cursor.execute("SELECT * FROM users WHERE ts_db_id=?", (client_unique_id,)).fetchall()
             if len(client_exists) > 1:
                 LOG.warning("Found multiple database entries for single unique teamspeakid %s.", client_unique_id)
+            self._audit_results.discard(client_unique_id)  # a pending audit result must not overwrite the new account
             if len(client_exists) != 0:  # If client TS database id is in BOT's database.
-                self._database_connection.cursor.execute("""UPDATE users SET ts_db_id=?, account_name=?, api_key=?, created_date=?, last_audit_date=? WHERE ts_db_id=?""",
-                                                         (client_unique_id, account_name, api_key, created_date, last_audit_date, client_unique_id))
+                self._database_connection.cursor.execute("""UPDATE users SET ts_db_id=?, account_name=?, api_key=?, created_date=?, last_audit_date=?, next_audit_at=? WHERE ts_db_id=?""",
+                                                         (client_unique_id, account_name, api_key, created_date, last_audit_date, next_audit_at(self._config.audit_period),
+                                                          client_unique_id))
                 LOG.info("Teamspeak ID %s already in Database updating with new Account Name '%s'. (likely permissions changed by a Teamspeak Admin)", client_unique_id, account_name)
             else:
-                self._database_connection.cursor.execute("INSERT INTO users ( ts_db_id, account_name, api_key, created_date, last_audit_date) VALUES(?,?,?,?,?)",
-                                                         (client_unique_id, account_name, api_key, created_date, last_audit_date))
+                self._database_connection.cursor.execute("INSERT INTO users ( ts_db_id, account_name, api_key, created_date, last_audit_date, next_audit_at) VALUES(?,?,?,?,?,?)",
+                                                         (client_unique_id, account_name, api_key, created_date, last_audit_date, next_audit_at(self._config.audit_period)))
             self._database_connection.conn.commit()
@@ -5,6 +5,7 @@ from .repeat_timer import RepeatTimer
 from .thread_names import enhance_thread_names
 from .thread_utils import thread_dump
 from .utils import strip_ts_channel_name_tags
+from .worker_pool import WorkerMetrics, WorkerPool
 
 __all__ = [
     'strip_ts_channel_name_tags',
@@ -13,5 +14,7 @@ __all__ = [
     'RepeatTimer',
     'enhance_thread_names',
     'thread_dump',
-    'ClosableLoopingThread'
+    'ClosableLoopingThread',
+    'WorkerPool',
+    'WorkerMetrics'
 ]
@@ -0,0 +1,97 @@
+import logging
+import threading
+from dataclasses import dataclass
+from queue import Empty, Queue
+from typing import Any, Callable, List, Optional
+
+import time
+
+from .ClosableLoopingThread import ClosableLoopingThread
+
+LOG = logging.getLogger(__name__)
+
+
+@dataclass
+class WorkerMetrics:
+    name: str
+    processed: int = 0
+    failed: int = 0
+    requeued: int = 0
+    busy_seconds: float = 0.0
+
+
+class WorkerPool:
+    """
+    Several threads pulling items from the same queue.
+    `work` returns False when the item could not be processed right now, it is requeued in that case.
+    While `paused` returns True, the workers leave the queue untouched.
+    Closing only signals the workers, join() waits until they finished their current item.
+    """
+
+    def __init__(self, name: str, queue: Queue, work: Callable[[Any], bool], size: int = 1,
+                 paused: Callable[[], bool] = lambda: False):
+        self._name = name
+        self._queue = queue
+        self._work = work
+        self._paused = paused
+
+        self._metrics = [WorkerMetrics(name=f"{name}-{i}") for i in range(max(size, 1))]
+        self._threads = [ClosableLoopingThread(name=metrics.name, work=lambda metrics=metrics: self._work_once(metrics))
+                         for metrics in self._metrics]
+
+        self._summary_lock = threading.Lock()
+        self._summary_pending = False  # whether items were processed since the last summary
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        LOG.info("%s is started with %s workers and pulling jobs", self._name, len(self._threads))
+
+    def close(self):
+        for thread in self._threads:
+            thread.close()
+
+    def join(self, timeout: Optional[float] = None):
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join(timeout)
+
+    def metrics(self) -> List[WorkerMetrics]:
+        return list(self._metrics)
+
+    def _work_once(self, metrics: WorkerMetrics):
+        if self._paused():
+            time.sleep(5)
+            return
+
+        try:
+            item = self._queue.get(timeout=5)
+        except Empty:
+            self._log_summary()
+            return
+
+        started = time.monotonic()
+        try:
+            if self._work(item):
+                metrics.processed += 1
+            else:
+                metrics.requeued += 1
+                self._queue.put(item)
+        except BaseException as ex:  # any error that occurs
+            metrics.failed += 1
+            LOG.error("Exception during %s processing of item: %s.", self._name, item, exc_info=ex)
+        finally:
+            metrics.busy_seconds += time.monotonic() - started
+            self._queue.task_done()  # finish job anyways
+            with self._summary_lock:
+                self._summary_pending = True
+            LOG.info("Remaining Queue Size: %s", self._queue.qsize())
+
+    def _log_summary(self):
+        with self._summary_lock:
+            if not self._summary_pending:
+                return
+            self._summary_pending = False
+        for metrics in self._metrics:
+            LOG.info("%s: processed %s, failed %s, requeued %s, busy for %.1fs",
+                     metrics.name, metrics.processed, metrics.failed, metrics.requeued, metrics.busy_seconds)
@@ -0,0 +1,160 @@
+import time
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from cachetools import TTLCache
+
+import bot.gwapi as gw2api
+from bot.TS3Auth import AuthRequest, AuthorizationNotPossibleError
+
+ANY_KEY = "564F181A-F0FC-114A-A55D-3C1DCD45F3767AF3848F-AB29-4EBF-9594-F91E6A75E015"
+ANY_ACCOUNT = {"id": "0B595DDF-5DA2-E711-80C3-ECB1D78A5C75", "name": "efficiencytesting.3518", "world": 2202, "guilds": []}
+ANY_TOKEN_INFO = {"id": "564F181A-F0FC-114A-A55D-3C1DCD45F376", "name": "verify", "permissions": ["account", "characters"]}
+ANY_WORLD = {"id": 2202, "name": "Riverside [DE]", "population": "Full"}
+
+
+class TestAuthRequest(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._levels = {}
+
+        for name, mock in {
+            "tokeninfo_get": MagicMock(return_value=ANY_TOKEN_INFO),
+            "account_get": MagicMock(return_value=ANY_ACCOUNT),
+            "worlds_get_one": MagicMock(return_value=ANY_WORLD),
+            "characters_get_names": MagicMock(side_effect=lambda key: list(self._levels.keys())),
+            "character_get_core": MagicMock(side_effect=lambda key, name: {"name": name, "level": self._levels[name]}),
+        }.items():
+            patcher = patch(f"bot.gwapi.{name}", mock)
+            setattr(self, f"_{name}_mock", patcher.start())
+            self.addCleanup(patcher.stop)
+
+        patcher = patch("bot.gwapi.facade._invalid_api_keys", TTLCache(maxsize=16, ttl=60))  # isolate the negative cache
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_auth_succeeds_with_one_character_on_required_level(self):
+        self._levels = {"Low": 13, "High": 80}
+
+        auth = AuthRequest(ANY_KEY, ["Riverside [DE]"], 80)
+
+        self.assertTrue(auth.char_check)
+        self.assertTrue(auth.success)
+
+    def test_auth_fails_without_character_on_required_level(self):
+        self._levels = {"Low": 13, "Other": 79}
+
+        auth = AuthRequest(ANY_KEY, ["Riverside [DE]"], 80)
+
+        self.assertFalse(auth.char_check)
+        self.assertFalse(auth.success)
+        self.assertEqual(self._character_get_core_mock.call_count, 2)
+
+    def test_auth_succeeds_when_another_character_fails_to_load(self):
+        self._levels = {"Broken": None, "Main": 80}
+
+        def character_get_core(key, name):
+            if name == "Broken":
+                raise gw2api.ApiError("404:no such character")
+            return {"name": name, "level": self._levels[name]}
+
+        self._character_get_core_mock.side_effect = character_get_core
+
+        auth = AuthRequest(ANY_KEY, ["Riverside [DE]"], 80)
+
+        self.assertTrue(auth.char_check)
+        self.assertTrue(auth.success)
+
+    def test_auth_fails_when_every_character_fails_to_load(self):
+        self._levels = {"Broken": None, "Other": None}
+        self._character_get_core_mock.side_effect = gw2api.ApiError("404:no such character")
+
+        auth = AuthRequest(ANY_KEY, ["Riverside [DE]"], 80)
+
+        self.assertFalse(auth.char_check)
+        self.assertFalse(auth.success)
+
+    def test_character_check_is_skipped_for_level_zero(self):
+        auth = AuthRequest(ANY_KEY, ["Riverside [DE]"], 0)
+
+        self.assertTrue(auth.success)
+        self._characters_get_names_mock.assert_not_called()
+
+    def test_auth_fails_on_wrong_world_without_waiting_for_characters(self):
+        self._levels = {"High": 80}
+        self._characters_get_names_mock.side_effect = lambda key: time.sleep(5) or list(self._levels.keys())
+
+        started = time.monotonic()
+        auth = AuthRequest(ANY_KEY, ["Kodash [DE]"], 80)
+
+        self.assertFalse(auth.success)
+        self.assertLess(time.monotonic() - started, 1)
+        self._characters_get_names_mock.assert_not_called()
+
+    def test_invalid_key_is_rejected_before_loading_account(self):
+        self._tokeninfo_get_mock.side_effect = gw2api.ApiKeyInvalidError("Invalid access token")
+
+        auth = AuthRequest("garbage-garbage-garbage-garbage-garbage", ["Riverside [DE]"], 80)
+
+        self.assertFalse(auth.success)
+        self._account_get_mock.assert_not_called()
+        self._characters_get_names_mock.assert_not_called()
+
+    def test_invalid_key_is_remembered(self):
+        self._tokeninfo_get_mock.side_effect = gw2api.ApiKeyInvalidError("Invalid access token")
+        AuthRequest(ANY_KEY, ["Riverside [DE]"], 80)
+
+        auth = AuthRequest(ANY_KEY, ["Riverside [DE]"], 80)
+
+        self.assertFalse(auth.success)
+        self._tokeninfo_get_mock.assert_called_once()
+
+    def test_key_without_characters_permission_is_rejected(self):
+        self._tokeninfo_get_mock.return_value = {**ANY_TOKEN_INFO, "permissions": ["account"]}
+
+        auth = AuthRequest(ANY_KEY, ["Riverside [DE]"], 80)
+
+        self.assertFalse(auth.success)
+        self._account_get_mock.assert_not_called()
+
+    def test_unavailable_api_is_not_possible(self):
+        self._tokeninfo_get_mock.side_effect = gw2api.ApiUnavailableError("ErrTimeout")
+
+        with self.assertRaises(AuthorizationNotPossibleError) as context:
+            AuthRequest(ANY_KEY, ["Riverside [DE]"], 80)
+        self.assertFalse(context.exception.circuit_open)
+
+    def test_request_rejected_by_the_open_circuit_is_not_possible(self):
+        self._levels = {"High": 80}
+        self._character_get_core_mock.side_effect = gw2api.CircuitOpenError("Circuit open")
+
+        with self.assertRaises(AuthorizationNotPossibleError) as context:
+            AuthRequest(ANY_KEY, ["Riverside [DE]"], 80)
+        self.assertTrue(context.exception.circuit_open)
+
+    def test_slow_api_exceeding_the_deadline_is_not_possible(self):
+        self._levels = {"High": 80}
+        self._account_get_mock.side_effect = lambda key: time.sleep(0.5) or ANY_ACCOUNT
+
+        with self.assertRaises(AuthorizationNotPossibleError):
+            AuthRequest(ANY_KEY, ["Riverside [DE]"], 80, deadline=0.1)
+
+    def test_slow_account_lookup_exceeding_the_deadline_is_not_possible(self):
+        self._account_get_mock.side_effect = lambda key: time.sleep(0.5) or ANY_ACCOUNT
+
+        started = time.monotonic()
+        with self.assertRaises(AuthorizationNotPossibleError):
+            AuthRequest(ANY_KEY, ["Riverside [DE]"], 0, deadline=0.1)
+        self.assertLess(time.monotonic() - started, 0.4)
+
+    def test_guild_details_are_collected_in_account_order(self):
+        self._levels = {"High": 80}
+        self._account_get_mock.return_value = {**ANY_ACCOUNT, "guilds": ["A", "B"]}
+        guild_cache = MagicMock()
+        guild_cache.guild_get = MagicMock(side_effect=lambda guild_id: {"id": guild_id, "name": f"Guild {guild_id}", "tag": guild_id})
+
+        auth = AuthRequest(ANY_KEY, ["Riverside [DE]"], 80, guild_cache=guild_cache)
+
+        self.assertTrue(auth.success)
+        self.assertEqual(auth.guild_names, ["Guild A", "Guild B"])
+        self.assertEqual(auth.guild_tags, ["A", "B"])
@@ -3,7 +3,7 @@ from unittest.mock import MagicMock, PropertyMock
 
 from ts3.query import TS3QueryError
 
-from bot.ts import TS3Facade
+from bot.ts import ServerGroupRegistry, TS3Facade
 
 
 # pylint: disable=no-self-use
@@ -86,3 +86,113 @@ class TS3FacadeTest(TestCase):
             repo.channel_find_first("test123")
 
         ts3_connection_mock.ts3exec.assert_called_once()  # TODO: we can not check for the parameters because it is a lambda
+
+    def test_client_db_ids_by_uid_reads_all_pages(self):
+        ts3_connection_mock = MagicMock()
+        ts3_connection_mock.ts3exec = MagicMock(side_effect=[
+            [[{"cldbid": "1", "client_unique_identifier": "a"}, {"cldbid": "2", "client_unique_identifier": "b"}], None],
+            [[{"cldbid": "3", "client_unique_identifier": "c"}], None],
+        ])
+
+        repo = TS3Facade(ts3_connection_mock)
+
+        result = repo.client_db_ids_by_uid(page_size=2)
+
+        self.assertEqual(result, {"a": "1", "b": "2", "c": "3"})
+        self.assertEqual(ts3_connection_mock.ts3exec.call_count, 2)
+
+    def test_client_db_ids_by_uid_stops_on_empty_page(self):
+        query_error = TS3QueryError(PropertyMock())
+        query_error.resp.error = {"id": '1281'}
+
+        ts3_connection_mock = MagicMock()
+        ts3_connection_mock.ts3exec = MagicMock(side_effect=[
+            [[{"cldbid": "1", "client_unique_identifier": "a"}, {"cldbid": "2", "client_unique_identifier": "b"}], None],
+            [None, query_error],
+        ])
+
+        repo = TS3Facade(ts3_connection_mock)
+
+        self.assertEqual(repo.client_db_ids_by_uid(page_size=2), {"a": "1", "b": "2"})
+
+    def test_servergroup_list_is_shared_between_facades(self):
+        registry = ServerGroupRegistry()
+        first_connection_mock = MagicMock()
+        first_connection_mock.ts3exec = MagicMock(return_value=[[{"name": "Verified", "sgid": "7"}], None])
+        second_connection_mock = MagicMock()
+
+        self.assertEqual(TS3Facade(first_connection_mock, registry).servergroup_id("Verified"), "7")
+        self.assertEqual(TS3Facade(second_connection_mock, registry).servergroup_list(), [{"name": "Verified", "sgid": "7"}])
+
+        first_connection_mock.ts3exec.assert_called_once()
+        second_connection_mock.ts3exec.assert_not_called()
+
+    def test_servergroup_changes_reload_servergroup_list(self):
+        ts3_connection_mock = MagicMock()
+        ts3_connection_mock.ts3exec = MagicMock(return_value=[[{"name": "Verified", "sgid": "7"}], None])
+        repo = TS3Facade(ts3_connection_mock, ServerGroupRegistry())
+        repo.servergroup_list()
+
+        ts3_connection_mock.ts3exec.return_value = [[{"name": "Verified", "sgid": "7"}, {"name": "DUMM", "sgid": "8"}], None]
+        repo.servergroup_add("DUMM")
+
+        self.assertEqual(repo.servergroup_id("DUMM"), "8")
+
+    def test_servergroup_list_expires(self):
+        ts3_connection_mock = MagicMock()
+        ts3_connection_mock.ts3exec = MagicMock(return_value=[[{"name": "Verified", "sgid": "7"}], None])
+        repo = TS3Facade(ts3_connection_mock, ServerGroupRegistry(ttl=0))
+
+        repo.servergroup_list()
+        repo.servergroup_list()
+
+        self.assertEqual(ts3_connection_mock.ts3exec.call_count, 2)
+
+    def test_failed_servergroup_list_is_not_cached(self):
+        ts3_connection_mock = MagicMock()
+        ts3_connection_mock.ts3exec = MagicMock(return_value=[None, Exception("connection lost")])
+        repo = TS3Facade(ts3_connection_mock, ServerGroupRegistry())
+
+        self.assertIsNone(repo.servergroup_id("Verified"))
+
+        ts3_connection_mock.ts3exec.return_value = [[{"name": "Verified", "sgid": "7"}], None]
+        self.assertEqual(repo.servergroup_id("Verified"), "7")
+
+    def test_permission_list_by_permission_name(self):
+        ts3_connection_mock = MagicMock()
+        ts3_connection_mock.ts3exec = MagicMock(return_value=[[{"permsid": "i_icon_id", "permvalue": "-5"}, {"permsid": "i_group_sort_id", "permvalue": "1100"}], None])
+
+        repo = TS3Facade(ts3_connection_mock)
+
+        self.assertEqual(repo.channel_permission_list(10), {"i_icon_id": -5, "i_group_sort_id": 1100})
+
+    def test_permission_list_without_permissions_is_empty(self):
+        query_error = TS3QueryError(PropertyMock())
+        query_error.resp.error = {"id": '1281'}  # database empty result set
+        ts3_connection_mock = MagicMock()
+        ts3_connection_mock.ts3exec = MagicMock(return_value=[None, query_error])
+
+        repo = TS3Facade(ts3_connection_mock)
+
+        self.assertEqual(repo.servergroup_permission_list(20), {})
+
+    def test_permission_list_other_error_reraised(self):
+        query_error = TS3QueryError(PropertyMock())
+        query_error.resp.error = {"id": '2568'}  # insufficient client permissions
+        ts3_connection_mock = MagicMock()
+        ts3_connection_mock.ts3exec = MagicMock(return_value=[None, query_error])
+
+        repo = TS3Facade(ts3_connection_mock)
+
+        with self.assertRaises(TS3QueryError):
+            repo.channel_permission_list(10)
+
+    def test_failed_channel_permissions_are_signaled(self):
+        ts3_connection_mock = MagicMock()
+        any_exception = RuntimeError("Something went wrong")
+        ts3_connection_mock.ts3exec = MagicMock(return_value=[None, any_exception])
+
+        repo = TS3Facade(ts3_connection_mock)
+
+        self.assertEqual(repo.channel_add_permissions(10, [("i_icon_id", 123)]), [None, any_exception])
+        self.assertEqual(repo.channel_add_permissions(10, []), (None, None))
@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+from bot.audit_run import AuditRun
+
+
+class TestAuditRun(TestCase):
+    def test_run_finishes_when_all_queued_keys_are_processed(self):
+        run = AuditRun("user")
+        run.add("a")
+        run.add("b")
+        run.add("a")  # counted once
+        run.queueing_finished()
+
+        run.record("a", True)
+        self.assertTrue(run.running)
+        run.record("other", True)  # not part of the run
+        run.record("b", False)
+
+        progress = run.progress()
+        self.assertFalse(run.running)
+        self.assertEqual((progress["queued"], progress["done"], progress["failed"]), (2, 1, 1))
+        self.assertEqual(progress["eta_seconds"], 0)
+
+    def test_eta_is_unknown_while_queueing(self):
+        run = AuditRun("user")
+        run.add("a")
+        run.add("b")
+        run.record("a", True)
+
+        self.assertIsNone(run.progress()["eta_seconds"])
+
+        run.queueing_finished()
+        self.assertIsNotNone(run.progress()["eta_seconds"])
@@ -0,0 +1,233 @@
+import datetime
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import time
+
+import bot.gwapi as gw2api
+from bot.TS3Auth import AuthorizationNotPossibleError
+from bot.audit_run import AuditRun
+from bot.audit_service import AUDIT_MAX_ATTEMPTS, AuditQueueEntry, AuditService, QUEUE_PRIORITY_AUDIT, QUEUE_PRIORITY_JOIN
+from bot.db import get_or_create_database
+from bot.event_looper import EventLooper
+
+DAY = 24 * 60 * 60
+
+
+class TestAuditScheduler(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._database = get_or_create_database(":memory:", "test")
+        self._ts_facade = MagicMock()
+        self._ts_facade.client_db_id_from_uid = MagicMock(return_value=1)
+        self._ts_connection_pool = MagicMock()
+        self._ts_connection_pool.item.return_value.__enter__.return_value = self._ts_facade
+        self._config = MagicMock(audit_period=7, enable_verification=True, join_audit_cooldown=12)
+
+        self._service = self._create_service()
+
+    def _create_service(self):
+        with patch.object(AuditService, "_start_audit_queue_worker"), patch.object(AuditService, "_start_audit_scheduler"):
+            return AuditService(self._database, self._ts_connection_pool, self._config, MagicMock(), MagicMock(), threading.Semaphore(1))
+
+    def tearDown(self) -> None:
+        self._database.close()
+        super().tearDown()
+
+    def _add_users(self, count, next_audit_at):
+        self._add_identities([(f"uid{i}", f"account.{i}", "key") for i in range(count)], next_audit_at)
+
+    def _add_identities(self, identities, next_audit_at):
+        with self._database.lock:
+            self._database.cursor.executemany("INSERT INTO users(ts_db_id, account_name, api_key, next_audit_at) VALUES(?,?,?,?)",
+                                              [(uid, account_name, api_key, next_audit_at) for uid, account_name, api_key in identities])
+            self._database.conn.commit()
+
+    def _next_audit_dates(self):
+        with self._database.lock:
+            return [row[0] for row in self._database.cursor.execute("SELECT next_audit_at FROM users").fetchall()]
+
+    def test_unscheduled_users_are_spread_over_the_audit_period(self):
+        self._add_users(100, None)
+
+        self._service._schedule_unscheduled_users()
+
+        dates = self._next_audit_dates()
+        now = time.time()
+        self.assertTrue(all(now - 1 <= d <= now + 7 * DAY for d in dates))
+        self.assertGreater(max(dates) - min(dates), 3 * DAY)  # not all at once
+
+    def test_only_a_steady_share_of_due_users_is_queued(self):
+        self._add_users(7 * DAY // 60, time.time() - 1)  # one user per scheduler tick would be steady
+
+        self._service._queue_due_users()
+
+        self.assertEqual(self._service._audit_queue.qsize(), 2)  # steady rate plus catch up
+
+    def test_queued_joins_do_not_hold_back_periodic_audits(self):
+        self._add_users(7 * DAY // 60, time.time() - 1)
+        for i in range(5):
+            self._service.queue_account_audit(QUEUE_PRIORITY_JOIN, f"joined.{i}")
+
+        self._service._queue_due_users()
+
+        self.assertEqual(self._service._audit_queue.qsize(priority=QUEUE_PRIORITY_AUDIT), 2)
+        self.assertEqual(self._service._audit_queue.qsize(), 7)
+
+    def test_queued_users_are_not_due_again_right_away(self):
+        self._add_users(1, time.time() - 1)
+
+        self._service._queue_due_users()
+        self._service._audit_queue.get_nowait()
+        self._service._queue_due_users()
+
+        self.assertEqual(self._service._audit_queue.qsize(), 0)
+        self.assertGreater(self._next_audit_dates()[0], time.time())
+
+    def test_identities_of_an_account_are_queued_once(self):
+        self._add_identities([("uid1", "account.1", "key"), ("uid2", "account.1", "key")], time.time() - 1)
+
+        self._service._queue_due_users()
+
+        self.assertEqual(self._service._audit_queue.qsize(), 1)
+
+    @patch("bot.audit_service.AuthRequest")
+    def test_identities_sharing_an_api_key_share_one_request(self, auth_request_mock):
+        auth_request_mock.return_value = MagicMock(success=True, world={"name": "Riverside [DE]"})
+        auth_request_mock.return_value.name = "account.1"
+        self._add_identities([("uid1", "account.1", "key"), ("uid2", "account.1", "key"), ("uid3", "account.1", "other key")], None)
+        self._service._user_service.guild_tags_up_to_date = MagicMock(return_value=False)
+
+        self.assertTrue(self._service.audit_account("account.1"))
+
+        self.assertEqual(auth_request_mock.call_count, 2)
+        self.assertEqual(self._service._user_service.update_guild_tags.call_count, 3)
+        self.assertEqual(self._service._user_service.record_audit.call_count, 3)
+        next_audits = {call.args[3] for call in self._service._user_service.record_audit.call_args_list}
+        self.assertEqual(len(next_audits), 1)  # audited together, due together
+
+    def test_full_audit_resolves_identities_at_once_and_marks_missing_ones(self):
+        self._ts_facade.client_db_ids_by_uid = MagicMock(return_value={"uid1": "1", "uid2": "2"})
+        self._add_identities([("uid1", "account.1", "key"), ("uid2", "account.1", "key"), ("uid3", "account.3", "key")], None)
+
+        self._service._queue_overdue_accounts()
+
+        self._ts_facade.client_db_id_from_uid.assert_not_called()
+        self.assertEqual(self._service._audit_queue.qsize(), 1)  # account.1 only
+        with self._database.lock:
+            last_audit_date = self._database.cursor.execute("SELECT last_audit_date FROM users WHERE ts_db_id = 'uid3'").fetchone()[0]
+        self.assertIsNotNone(last_audit_date)
+
+    def test_join_is_not_audited_within_cooldown_of_last_audit(self):
+        self._add_identities([("uid1", "account.1", "key"), ("uid2", "account.2", "key")], None)
+        with self._database.lock:
+            self._database.cursor.execute("UPDATE users SET last_audit_date = ? WHERE ts_db_id = 'uid1'", (datetime.date.today(),))
+            self._database.cursor.execute("UPDATE users SET last_audit_date = ? WHERE ts_db_id = 'uid2'", (datetime.date.today() - datetime.timedelta(days=2),))
+            self._database.conn.commit()
+        self._service = self._create_service()  # loads the last audits
+        self._service._user_service.get_user_database_entry = MagicMock(side_effect=lambda uid: {"uid1": {"account_name": "account.1"},
+                                                                                                 "uid2": {"account_name": "account.2"}}[uid])
+        self._config.join_audit_cooldown = 36  # covers the start of today, but not two days ago
+
+        self._service.audit_user_on_join("uid1")
+        self._service.audit_user_on_join("uid2")
+
+        self.assertEqual(self._service._audit_queue.get_nowait().account_name, "account.2")
+        self.assertEqual(self._service._audit_queue.qsize(), 0)
+
+    @patch("bot.event_looper.AuthRequest")
+    def test_join_right_after_verification_is_not_audited(self, auth_request_mock):
+        auth_request_mock.return_value = MagicMock(success=True)
+        auth_request_mock.return_value.name = "account.1"
+        user_service = self._service._user_service
+        user_service.check_client_needs_verify = MagicMock(return_value=True)
+        user_service.is_ts_registration_limit_reached = MagicMock(return_value=False)
+        user_service.get_user_database_entry = MagicMock(return_value={"account_name": "account.1"})
+        looper = EventLooper(self._database, self._ts_connection_pool, self._config, user_service, self._service, MagicMock(), MagicMock())
+        looper._ts_facade = self._ts_facade
+
+        looper.handle_private_message("564F181A-F0FC-114A-A55D-3C1DCD45F3767AF3848F-AB29-4EBF-9594-F91E6A75E015", "1", "User", "uid1")
+        self._service.audit_user_on_join("uid1")
+
+        self.assertEqual(self._service._audit_queue.qsize(), 0)
+
+    @patch("bot.audit_service.AuthRequest")
+    def test_unchanged_guilds_do_not_touch_teamspeak(self, auth_request_mock):
+        auth_request_mock.return_value = MagicMock(success=True, world={"name": "Riverside [DE]"})
+        auth_request_mock.return_value.name = "account.1"
+        self._add_identities([("uid1", "account.1", "key")], None)
+        self._service._user_service.guild_tags_up_to_date = MagicMock(return_value=True)
+
+        self.assertTrue(self._service.audit_account("account.1"))
+
+        self._ts_connection_pool.item.assert_not_called()
+        self._service._user_service.update_guild_tags.assert_not_called()
+
+    @patch("bot.audit_service.AuthRequest", side_effect=AuthorizationNotPossibleError("timeout"))
+    def test_audit_that_is_not_possible_is_retried_and_postponed_after_the_last_attempt(self, _):
+        self._add_identities([("uid1", "account.1", "key")], None)
+        self._service.queue_account_audit(QUEUE_PRIORITY_JOIN, "account.1")
+
+        item = self._service._audit_queue.get_nowait()
+        self.assertFalse(self._service._audit_queue_entry(item))  # requeued by the worker
+
+        with patch.object(self._service._audit_queue, "attempts", return_value=AUDIT_MAX_ATTEMPTS):
+            self.assertTrue(self._service._audit_queue_entry(item))
+        self.assertGreater(self._next_audit_dates()[0], time.time() + DAY / 2)
+
+    @patch("bot.audit_service.AuthRequest")
+    def test_audit_rejected_by_the_open_circuit_is_requeued_without_an_attempt(self, auth_request_mock):
+        def rejected(*_, **__):
+            raise AuthorizationNotPossibleError from gw2api.CircuitOpenError("Circuit open")
+
+        auth_request_mock.side_effect = rejected
+        self._add_identities([("uid1", "account.1", "key")], None)
+        self._service.queue_account_audit(QUEUE_PRIORITY_JOIN, "account.1")
+
+        for _ in range(AUDIT_MAX_ATTEMPTS + 1):  # like a worker, while the circuit stays open
+            item = self._service._audit_queue.get_nowait()
+            self.assertEqual(self._service._audit_queue.attempts(), 1)
+            self.assertFalse(self._service._audit_queue_entry(item))
+            self._service._audit_queue.put(item)
+            self._service._audit_queue.task_done()
+
+        self.assertEqual(self._service._audit_queue.get_nowait(), AuditQueueEntry(QUEUE_PRIORITY_JOIN, "account.1"))
+        self.assertIsNone(self._next_audit_dates()[0])  # not postponed
+
+    @patch("bot.audit_service.AuthRequest")
+    def test_audit_run_counts_an_account_once_its_follow_up_audit_is_done(self, auth_request_mock):
+        auth_request_mock.return_value = MagicMock(success=True, world={"name": "Riverside [DE]"})
+        self._add_identities([("uid1", "account.1", "key")], None)
+        audit_run = AuditRun("user")
+        audit_run.add("account.1")
+        audit_run.queueing_finished()
+        self._service._audit_run = audit_run
+        self._service.queue_account_audit(QUEUE_PRIORITY_AUDIT, "account.1")
+
+        item = self._service._audit_queue.get_nowait()
+        other = threading.Thread(target=lambda: self._service.queue_account_audit(QUEUE_PRIORITY_JOIN, "account.1"))
+        other.start()
+        other.join()
+        self.assertTrue(self._service._audit_queue_entry(item))
+        self._service._audit_queue.task_done()
+        self.assertTrue(audit_run.running)  # the follow up is still queued
+
+        self.assertTrue(self._service._audit_queue_entry(self._service._audit_queue.get_nowait()))
+        self._service._audit_queue.task_done()
+        self.assertFalse(audit_run.running)
+        self.assertEqual(audit_run.progress()["done"], 1)
+
+    def test_periodic_audit_is_due_at_the_due_date_of_the_account(self):
+        due = time.time() - 2 * DAY
+        self._add_identities([("uid1", "account.1", "key"), ("uid2", "account.1", "key")], due)
+        with self._database.lock:
+            self._database.cursor.execute("UPDATE users SET next_audit_at = ? WHERE ts_db_id = 'uid2'", (due + DAY,))
+            self._database.conn.commit()
+
+        self._service._queue_due_users()
+        self._service._audit_queue.get_nowait()
+
+        lateness = self._service._audit_queue.lateness()[QUEUE_PRIORITY_AUDIT]
+        self.assertEqual(lateness.late, 1)
+        self.assertGreaterEqual(lateness.max_seconds, 2 * DAY)
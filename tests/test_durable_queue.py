@@ -0,0 +1,300 @@
+import threading
+from dataclasses import dataclass, field
+from queue import Empty
+from unittest import TestCase
+
+import time
+
+from bot.db import DurableQueue, get_or_create_database
+
+
+@dataclass(order=True)
+class Entry:
+    priority: int
+    key: str = field(compare=False)
+
+
+@dataclass(order=True)
+class FlaggedEntry:
+    priority: int
+    key: str = field(compare=False)
+    flag: bool = field(default=False, compare=False)
+
+    @staticmethod
+    def merge(queued, new):
+        return FlaggedEntry(min(queued.priority, new.priority), new.key, queued.flag or new.flag)
+
+
+class TestDurableQueue(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._database = get_or_create_database(":memory:", "test")
+        self._queue = self._create_queue()
+
+    def tearDown(self) -> None:
+        self._database.close()
+        super().tearDown()
+
+    def _create_queue(self, **kwargs):
+        return DurableQueue(self._database, "test", Entry, key=lambda entry: entry.key, **kwargs)
+
+    def test_items_are_taken_by_priority(self):
+        for entry in [Entry(100, "a"), Entry(20, "b"), Entry(15, "c")]:
+            self._queue.put(entry)
+
+        self.assertEqual([self._queue.get_nowait().key for _ in range(3)], ["c", "b", "a"])
+
+    def test_same_key_is_queued_once_with_the_more_urgent_priority(self):
+        self._queue.put(Entry(100, "a"))
+        self.assertTrue(self._queue.put(Entry(20, "a")))
+        self.assertFalse(self._queue.put(Entry(50, "a")))
+
+        self.assertEqual(self._queue.qsize(), 1)
+        self.assertEqual(self._queue.get_nowait(), Entry(20, "a"))
+
+    def test_oldest_age_is_kept_when_the_same_key_is_queued_again(self):
+        self.assertEqual(self._queue.oldest_age(), 0.0)
+        self._queue.put(Entry(100, "a"))
+        with self._database.lock:
+            self._database.cursor.execute("UPDATE audit_queue SET enqueued_at = enqueued_at - 60 WHERE key = 'a'")
+            self._database.conn.commit()
+
+        self._queue.put(Entry(20, "a"))
+        self._queue.put(Entry(100, "b"))
+
+        self.assertEqual(self._queue.qsize(), 2)
+        self.assertAlmostEqual(self._queue.oldest_age(), 60, delta=5)
+
+    def test_pending_items_survive_a_new_queue(self):
+        queue = self._create_queue(lease=0)  # the lease of "a" will be expired
+        queue.put(Entry(100, "a"))
+        queue.put(Entry(100, "b"))
+        queue.get_nowait()  # claims both, starts "a"
+        queue.close()
+
+        queue = self._create_queue()  # e.g. after a reconnect
+
+        self.assertEqual(sorted([queue.get_nowait().key, queue.get_nowait().key]), ["a", "b"])
+
+    def test_finished_item_is_removed(self):
+        self._queue.put(Entry(100, "a"))
+        self._queue.get_nowait()
+        self._queue.task_done()
+
+        with self.assertRaises(Empty):
+            self._create_queue().get_nowait()
+
+    def _put_from_other_thread(self, entry, queue=None):
+        other = threading.Thread(target=lambda: (queue or self._queue).put(entry))
+        other.start()
+        other.join()
+
+    def test_item_in_progress_is_only_requeued_by_its_worker(self):
+        self._queue.put(Entry(100, "a"))
+        self._queue.get_nowait()
+
+        self._put_from_other_thread(Entry(20, "a"))
+        with self.assertRaises(Empty):
+            self._create_queue().get_nowait()  # not handed out while in progress
+
+        self.assertTrue(self._queue.put(Entry(100, "a")))
+        self._queue.task_done()
+        self.assertEqual(self._queue.get_nowait(), Entry(20, "a"))  # the follow up is merged in
+
+    def test_put_while_in_progress_is_queued_once_the_item_is_done(self):
+        self._queue.put(Entry(100, "a"))
+        self._queue.get_nowait()
+
+        self._put_from_other_thread(Entry(15, "a"))
+        self.assertEqual(self._queue.qsize(), 1)
+        self._queue.task_done()
+
+        self.assertEqual(self._queue.get_nowait(), Entry(15, "a"))
+        self._queue.task_done()
+        with self.assertRaises(Empty):
+            self._queue.get_nowait()
+
+    def test_put_between_claim_and_take_changes_the_pending_item(self):
+        queue = self._create_queue(batch_size=3)
+        for key in ["a", "b", "c"]:
+            queue.put(Entry(100, key))
+        self.assertEqual(queue.get_nowait().key, "a")  # claims all three, starts "a"
+
+        self._put_from_other_thread(Entry(20, "c"), queue)
+
+        self.assertEqual(queue.get_nowait(), Entry(20, "c"))  # before "b"
+        self.assertEqual(queue.attempts(), 1)
+        queue.task_done()
+        self.assertEqual(queue.get_nowait().key, "b")
+        queue.task_done()
+        with self.assertRaises(Empty):
+            queue.get_nowait()  # no follow up of "c"
+
+    def test_urgent_put_is_handed_out_before_claimed_items(self):
+        queue = self._create_queue(batch_size=3)
+        for key in ["a", "b", "c"]:
+            queue.put(Entry(100, key))
+        queue.get_nowait()
+
+        self._put_from_other_thread(Entry(20, "urgent"), queue)
+
+        self.assertEqual(queue.get_nowait().key, "urgent")
+
+    def test_pending_item_is_merged_with_a_put_of_the_same_priority(self):
+        queue = DurableQueue(self._database, "test", FlaggedEntry, key=lambda entry: entry.key, merge=FlaggedEntry.merge)
+        queue.put(FlaggedEntry(100, "a"))
+
+        self.assertTrue(queue.put(FlaggedEntry(100, "a", flag=True)))
+        self.assertFalse(queue.put(FlaggedEntry(200, "a")))  # nothing left to change
+
+        self.assertEqual(queue.get_nowait(), FlaggedEntry(100, "a", flag=True))
+
+    def test_put_while_in_progress_is_merged_into_the_follow_up(self):
+        queue = DurableQueue(self._database, "test", FlaggedEntry, key=lambda entry: entry.key, merge=FlaggedEntry.merge)
+        queue.put(FlaggedEntry(100, "a"))
+        queue.get_nowait()
+
+        self._put_from_other_thread(FlaggedEntry(100, "a", flag=True), queue)
+        self._put_from_other_thread(FlaggedEntry(100, "a"), queue)
+        queue.task_done()
+
+        self.assertEqual(queue.get_nowait(), FlaggedEntry(100, "a", flag=True))
+
+    def test_closed_queue_wakes_waiting_workers_and_hands_out_nothing(self):
+        result = []
+
+        def wait_for_item():
+            try:
+                result.append(self._queue.get(timeout=10))
+            except Empty:
+                result.append(None)
+
+        worker = threading.Thread(target=wait_for_item)
+        worker.start()
+        time.sleep(0.1)  # blocked in get
+        self._queue.close()
+        worker.join(timeout=5)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(result, [None])
+
+        self._queue.put(Entry(100, "a"))
+        with self.assertRaises(Empty):
+            self._queue.get_nowait()
+        self.assertEqual(self._create_queue().get_nowait(), Entry(100, "a"))  # not leased by the closed queue
+
+    def test_put_under_the_database_lock_while_a_worker_waits(self):
+        result = []
+        worker = threading.Thread(target=lambda: result.append(self._queue.get(timeout=10)), daemon=True)
+        worker.start()
+        time.sleep(0.1)  # blocked in get
+
+        def put_under_lock():
+            with self._database.lock:
+                self._queue.put(Entry(100, "a"))
+                time.sleep(0.1)  # the woken worker tries to claim meanwhile
+                self._queue.put(Entry(100, "b"))
+
+        producer = threading.Thread(target=put_under_lock, daemon=True)
+        producer.start()
+        producer.join(timeout=5)
+        worker.join(timeout=5)
+        self.assertFalse(producer.is_alive())
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(result, [Entry(100, "a")])
+
+    def test_workers_claim_batches(self):
+        for i in range(5):
+            self._queue.put(Entry(100, str(i)))
+        queue = self._create_queue(batch_size=3)
+
+        queue.get_nowait()
+
+        with self._database.lock:
+            leased = self._database.cursor.execute("SELECT count(*) FROM audit_queue WHERE lease_until IS NOT NULL").fetchone()[0]
+        self.assertEqual(leased, 3)
+
+    def test_claimed_item_with_expired_lease_is_counted_once_and_handed_out_once(self):
+        queue = self._create_queue(batch_size=2, lease=0.2)
+        queue.put(Entry(100, "a"))
+        queue.put(Entry(100, "b"))
+        self.assertEqual(queue.get_nowait().key, "a")  # claims both, starts "a"
+        time.sleep(0.3)
+
+        self.assertEqual(queue.qsize(), 2)  # "a" is due again as well
+        other = self._create_queue()
+        self.assertEqual(sorted([other.get_nowait().key, other.get_nowait().key]), ["a", "b"])
+        with self.assertRaises(Empty):
+            queue.get_nowait()  # "b" is dropped, the other queue works on it
+
+    def test_lease_is_renewed_when_a_worker_starts(self):
+        queue = self._create_queue(batch_size=2, lease=0.5)
+        queue.put(Entry(100, "a"))
+        queue.put(Entry(100, "b"))
+        queue.get_nowait()
+        time.sleep(0.3)
+
+        self.assertEqual(queue.get_nowait().key, "b")
+
+        with self._database.lock:
+            lease_until = self._database.cursor.execute("SELECT lease_until FROM audit_queue WHERE key = 'b'").fetchone()[0]
+        self.assertGreater(lease_until - time.time(), 0.3)
+
+    def test_waiting_items_age_past_more_urgent_ones(self):
+        queue = self._create_queue(aging=1.0)
+        queue.put(Entry(100, "old"))
+        with self._database.lock:
+            self._database.cursor.execute("UPDATE audit_queue SET enqueued_at = enqueued_at - 120 WHERE key = 'old'")
+            self._database.conn.commit()
+        queue.put(Entry(20, "new"))
+
+        self.assertEqual(queue.get_nowait().key, "old")
+
+    def test_each_priority_gets_its_minimum_share_of_a_batch(self):
+        queue = self._create_queue(batch_size=4, min_shares={100: 0.25})
+        for i in range(10):
+            queue.put(Entry(20, f"join{i}"))
+        queue.put(Entry(100, "audit"))
+
+        keys = [queue.get_nowait().key for _ in range(4)]
+
+        self.assertIn("audit", keys)
+        self.assertEqual(keys[-1], "audit")  # still handled after the more urgent ones of its batch
+
+    def test_lateness_against_deadline_is_recorded(self):
+        self._queue.put(Entry(20, "late"), deadline=time.time() - 60)
+        self._queue.put(Entry(100, "in time"), deadline=time.time() + 60)
+        self._queue.put(Entry(100, "no deadline"))
+
+        for _ in range(3):
+            self._queue.get_nowait()
+
+        lateness = self._queue.lateness()
+        self.assertEqual(lateness[20].late, 1)
+        self.assertGreaterEqual(lateness[20].max_seconds, 60)
+        self.assertEqual(lateness[100].started, 2)
+        self.assertEqual(lateness[100].late, 0)
+
+    def test_requeued_item_waits_longer_with_every_attempt(self):
+        queue = self._create_queue(retry_delay=60)
+        queue.put(Entry(100, "a"))
+        self.assertEqual(queue.get_nowait().key, "a")
+        self.assertEqual(queue.attempts(), 1)
+
+        queue.put(Entry(100, "a"))  # the worker gives it back
+        queue.task_done()
+        with self.assertRaises(Empty):
+            queue.get_nowait()
+
+        with self._database.lock:
+            not_before = self._database.cursor.execute("SELECT not_before FROM audit_queue WHERE key = 'a'").fetchone()[0]
+            self._database.cursor.execute("UPDATE audit_queue SET not_before = NULL WHERE key = 'a'")
+            self._database.conn.commit()
+        self.assertAlmostEqual(not_before - time.time(), 60, delta=5)
+
+        self.assertEqual(queue.get_nowait().key, "a")
+        self.assertEqual(queue.attempts(), 2)
+        queue.put(Entry(100, "a"))
+        queue.task_done()
+        with self._database.lock:
+            not_before = self._database.cursor.execute("SELECT not_before FROM audit_queue WHERE key = 'a'").fetchone()[0]
+        self.assertAlmostEqual(not_before - time.time(), 120, delta=5)
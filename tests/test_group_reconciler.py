@@ -0,0 +1,114 @@
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import bot.gwapi as gw2api
+from bot.db import get_or_create_database
+from bot.group_reconciler import GroupReconciler
+
+GROUPS = [{"name": "Verified", "sgid": "1"}, {"name": "DUMM", "sgid": "10"}, {"name": "OTHR", "sgid": "11"}]
+
+
+class TestGroupReconciler(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._database = get_or_create_database(":memory:", "test")
+        with self._database.lock:
+            self._database.cursor.executemany("INSERT INTO users(ts_db_id, account_name, api_key) VALUES(?,?,?)", [
+                ("uid1", "account.1", "key1"), ("uid2", "account.1", "key1"), ("uid3", "account.3", "key3"), ("uid4", "account.4", "key4")])
+            self._database.cursor.executemany("INSERT INTO guilds(guild_name, ts_group) VALUES(?,?)", [("Die Dummies", "DUMM"), ("Others", "OTHR")])
+            self._database.conn.commit()
+
+        self._members = {"1": ["101"], "10": ["103", "999"], "11": []}
+        self._ts_facade = MagicMock()
+        self._ts_facade.client_db_ids_by_uid = MagicMock(return_value={"uid1": "101", "uid2": "102", "uid3": "103", "uid4": "104"})
+        self._ts_facade.servergroup_list = MagicMock(return_value=GROUPS)
+        self._ts_facade.servergroup_client_list = MagicMock(side_effect=lambda sgid: self._members[sgid])
+        self._ts_facade.servergroup_clients_add = MagicMock(return_value=[])
+        self._ts_facade.servergroup_clients_del = MagicMock(return_value=[])
+        self._ts_connection_pool = MagicMock()
+        self._ts_connection_pool.item.return_value.__enter__.return_value = self._ts_facade
+        self._ts_budget = threading.BoundedSemaphore(1)
+
+        guild_cache = MagicMock()
+        guild_cache.guild_get = MagicMock(side_effect=lambda guild_id: {"id": guild_id, "name": {"D": "Die Dummies", "O": "Others"}[guild_id]})
+        self._reconciler = GroupReconciler(self._database, self._ts_connection_pool, MagicMock(verified_group="Verified", enable_verification=True), guild_cache,
+                                           self._ts_budget)
+
+        def _account_get(api_key):
+            if api_key == "key4":
+                raise gw2api.ApiUnavailableError("ErrTimeout")
+            return {"key1": {"guilds": ["D"]}, "key3": {"guilds": ["O"]}}[api_key]
+
+        patcher = patch("bot.group_reconciler.gw2api.account_get", MagicMock(side_effect=_account_get))
+        self._account_get_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self) -> None:
+        self._database.close()
+        super().tearDown()
+
+    def test_only_the_difference_is_applied(self):
+        result = self._reconciler.reconcile()
+
+        self._ts_facade.servergroup_clients_add.assert_any_call("1", ["102", "103", "104"])
+        self._ts_facade.servergroup_clients_add.assert_any_call("10", ["101", "102"])
+        self._ts_facade.servergroup_clients_add.assert_any_call("11", ["103"])
+        # 999 is not registered, 104's guilds are unknown, only 103 left the guild
+        self._ts_facade.servergroup_clients_del.assert_called_once_with("10", ["103"])
+        self.assertEqual((result.accounts, result.accounts_skipped, result.added, result.removed), (3, 1, 6, 1))
+
+    def test_failed_changes_are_not_counted_as_applied(self):
+        self._ts_facade.servergroup_clients_add = MagicMock(side_effect=lambda sgid, ids: [(["102"], RuntimeError("boom"))] if sgid == "10" else [])
+
+        with patch("bot.group_reconciler.LOG"):
+            result = self._reconciler.reconcile()
+
+        self.assertEqual((result.added, result.removed, result.failed), (5, 1, 1))
+
+    def test_guild_list_is_fetched_once_per_account(self):
+        self._reconciler.reconcile()
+
+        self.assertEqual(self._account_get_mock.call_count, 3)
+
+    def test_connections_are_taken_from_the_budget_per_step(self):
+        budget_held = []
+
+        def item():
+            budget_held.append(not self._ts_budget.acquire(blocking=False))
+            return self._ts_connection_pool.item.return_value
+
+        self._ts_connection_pool.item.side_effect = item
+
+        self._reconciler.reconcile()
+
+        self.assertEqual(budget_held, [True, True, True])  # the verified group, then each guild group
+        self.assertTrue(self._ts_budget.acquire(blocking=False))  # released again
+
+    def test_hidden_groups_are_not_desired(self):
+        with self._database.lock:
+            self._database.cursor.execute("INSERT INTO guild_ignores(guild_id, ts_db_id) SELECT guild_id, 'uid1' FROM guilds WHERE ts_group = 'DUMM'")
+            self._database.conn.commit()
+
+        self._reconciler.reconcile()
+
+        self._ts_facade.servergroup_clients_add.assert_any_call("10", ["102"])
+
+    def test_guilds_without_group_are_skipped(self):
+        with self._database.lock:
+            self._database.cursor.execute("INSERT INTO guilds(guild_name, ts_group) VALUES('No Group', NULL)")
+            self._database.conn.commit()
+
+        with patch("bot.group_reconciler.LOG") as log:
+            self._reconciler.reconcile()
+
+        log.warning.assert_not_called()
+
+    def test_closed_reconciler_changes_nothing(self):
+        self._reconciler.close()
+
+        self._reconciler.trigger_reconcile()
+        self._reconciler.reconcile()
+
+        self._ts_facade.servergroup_clients_add.assert_not_called()
+        self._ts_facade.servergroup_clients_del.assert_not_called()
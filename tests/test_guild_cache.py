@@ -0,0 +1,70 @@
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from bot.db import get_or_create_database
+from bot.guild_cache import GuildCache
+
+ANY_GUILD = {
+    "id": "14762DCE-C2A4-E711-80D5-441EA14F1E44",
+    "name": "Lqibzzexgvkikpydotxsvijehyhexd",
+    "tag": "LQIb",
+    "emblem": {"background": {"id": 1, "colors": [2]}, "foreground": {"id": 3, "colors": [4]}, "flags": []}
+}
+
+
+class TestGuildCache(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._database = get_or_create_database(":memory:", "test")
+
+        patcher = patch("bot.guild_cache.gw2api")
+        self._gw2api_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self._gw2api_mock.guild_get_uncached = MagicMock(return_value=ANY_GUILD)
+        self._gw2api_mock.guild_search = MagicMock(return_value=ANY_GUILD["id"])
+
+    def tearDown(self) -> None:
+        self._database.close()
+        super().tearDown()
+
+    def test_guild_get_loads_missing_guild_from_api(self):
+        cache = GuildCache(self._database)
+
+        self.assertEqual(cache.guild_get(ANY_GUILD["id"]), ANY_GUILD)
+        self._gw2api_mock.guild_get_uncached.assert_called_once_with(ANY_GUILD["id"])
+
+    def test_guild_get_serves_fresh_entry_from_database(self):
+        GuildCache(self._database).put(ANY_GUILD)
+        cache = GuildCache(self._database)  # new instance, e.g. after a restart
+
+        self.assertEqual(cache.guild_get(ANY_GUILD["id"]), ANY_GUILD)
+        self._gw2api_mock.guild_get_uncached.assert_not_called()
+
+    def test_guild_get_serves_stale_entry_and_refreshes_in_background(self):
+        cache = GuildCache(self._database, ttl=-1)  # everything is stale
+        cache.put(ANY_GUILD)
+
+        released = threading.Event()
+        self._gw2api_mock.guild_get_uncached.side_effect = lambda guild_id: released.wait(5) and ANY_GUILD
+
+        self.assertEqual(cache.guild_get(ANY_GUILD["id"]), ANY_GUILD)  # refresh did not block the lookup
+        self.assertEqual(cache.guild_get(ANY_GUILD["id"]), ANY_GUILD)
+
+        released.set()
+        cache.close()
+        self._gw2api_mock.guild_get_uncached.assert_called_once_with(ANY_GUILD["id"])  # refreshed once, although looked up twice
+
+    def test_guild_search_uses_cached_name(self):
+        cache = GuildCache(self._database)
+        cache.put(ANY_GUILD)
+
+        self.assertEqual(cache.guild_search(ANY_GUILD["name"].upper()), ANY_GUILD["id"])
+        self._gw2api_mock.guild_search.assert_not_called()
+
+    def test_guild_search_unknown_guild_returns_none(self):
+        self._gw2api_mock.guild_search = MagicMock(return_value=None)
+        cache = GuildCache(self._database)
+
+        self.assertIsNone(cache.guild_search("aadafddfggfadasd"))
+        self._gw2api_mock.guild_get_uncached.assert_not_called()
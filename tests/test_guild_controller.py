@@ -6,7 +6,9 @@ from werkzeug.test import TestResponse
 
 import bot
 import bot.rest.bootstrap
+from bot.db import Lateness
 from bot.rest.controller import GuildController
+from bot.util import WorkerMetrics
 
 
 class TestGuildController(TestCase):
@@ -137,3 +139,59 @@ class TestGuildController(TestCase):
         result_str = result.get_data(as_text=True)
         self.assertIn("Bad Request", result_str)
         self.assertIn("-1", result_str)
+
+    def test_guild_audit_trigger_reports_running_audit(self):
+        self._audit_service_mock.trigger_guild_audit = MagicMock(return_value=(MagicMock(), False))
+
+        result: TestResponse = self._app.post("/guild/_audit")
+
+        self.assertEqual(200, result.status_code)
+        self.assertEqual('"Already running"\n', result.get_data(as_text=True))
+
+    def test_guild_audit_progress_returns_204_without_audit(self):
+        self._audit_service_mock.audit_run = MagicMock(return_value=None)
+
+        result: TestResponse = self._app.get("/guild/_audit")
+
+        self.assertEqual(204, result.status_code)
+
+    def test_guild_audit_progress_returns_progress(self):
+        self._audit_service_mock.audit_run.return_value.progress = MagicMock(return_value={"kind": "guild", "queued": 3, "done": 1})
+
+        result: TestResponse = self._app.get("/guild/_audit")
+
+        self.assertEqual(200, result.status_code)
+        self.assertEqual({"kind": "guild", "queued": 3, "done": 1}, json.loads(result.get_data(as_text=True)))
+
+    def test_guild_audit_queue_returns_queue_and_workers(self):
+        self._audit_service_mock.pending_audits = MagicMock(return_value=2)
+        self._audit_service_mock.oldest_pending_audit_age = MagicMock(return_value=30.4)
+        self._audit_service_mock.audit_lateness = MagicMock(return_value={100: Lateness(started=5)})
+        self._audit_service_mock.worker_metrics = MagicMock(return_value=[WorkerMetrics(name="GuildAuditQueueWorker-0", processed=5)])
+
+        result: TestResponse = self._app.get("/guild/_audit/queue")
+
+        self.assertEqual(200, result.status_code)
+        body = json.loads(result.get_data(as_text=True))
+        self.assertEqual(2, body["pending"])
+        self.assertEqual(30, body["oldest_pending_seconds"])
+        self.assertEqual(5, body["lateness"]["100"]["started"])
+        self.assertEqual([{"name": "GuildAuditQueueWorker-0", "processed": 5, "failed": 0, "requeued": 0, "busy_seconds": 0.0}], body["workers"])
+
+    def test_guild_channels_are_streamed(self):
+        channels = [{"name": "Guild B [B]", "empty_since": "a day", "subChannels": None},
+                    {"name": "Guild A [A]", "empty_since": "a moment", "subChannels": [{"name": "Lobby", "empty_since": "a moment", "subChannels": None}]}]
+        self._service_mock.list_channels = MagicMock(return_value=iter(channels))
+
+        result: TestResponse = self._app.get("/guild/channels")
+
+        self.assertEqual(200, result.status_code)
+        self.assertEqual("application/json", result.mimetype)
+        self.assertEqual(channels, json.loads(result.get_data(as_text=True)))
+
+    def test_guild_channels_returns_204_without_channels(self):
+        self._service_mock.list_channels = MagicMock(return_value=iter([]))
+
+        result: TestResponse = self._app.get("/guild/channels")
+
+        self.assertEqual(204, result.status_code)
@@ -0,0 +1,51 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from bot.db import get_or_create_database
+from bot.guild_registry import GuildRegistry
+
+
+class TestGuildRegistry(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._database = get_or_create_database(":memory:", "test")
+        self._insert("Die Dummies", "DUMM", "D-1", 10)
+        self._registry = GuildRegistry(self._database)
+
+    def tearDown(self) -> None:
+        self._database.close()
+        super().tearDown()
+
+    def _insert(self, guild_name, ts_group, gw2_guild_id, group_id):
+        with self._database.lock:
+            self._database.cursor.execute("INSERT INTO guilds(guild_name, ts_group, gw2_guild_id, group_id) VALUES(?,?,?,?)",
+                                          (guild_name, ts_group, gw2_guild_id, group_id))
+            self._database.conn.commit()
+
+    def test_lookups_use_every_key(self):
+        guild = self._registry.by_name("Die Dummies")
+
+        self.assertEqual(guild.ts_group, "DUMM")
+        self.assertIs(self._registry.by_name("die dummies", ignore_case=True), guild)
+        self.assertIsNone(self._registry.by_name("die dummies"))
+        self.assertIs(self._registry.by_ts_group("DUMM"), guild)
+        self.assertIs(self._registry.by_gw2_id("D-1"), guild)
+        self.assertIs(self._registry.by_group_id("10"), guild)
+        self.assertIs(self._registry.by_id(guild.guild_id), guild)
+        self.assertEqual(self._registry.ts_groups_of(["Die Dummies", "Unknown"]), {"Die Dummies": "DUMM"})
+
+    def test_table_is_loaded_once(self):
+        with patch.object(self._registry, "_load", wraps=self._registry._load) as load_mock:
+            self._registry.by_name("Die Dummies")
+            self._registry.by_ts_group("DUMM")
+
+        load_mock.assert_called_once()
+
+    def test_invalidate_picks_up_new_guilds(self):
+        self._registry.by_name("Die Dummies")
+        self._insert("Others", "OTHR", "O-1", 11)
+        self.assertIsNone(self._registry.by_ts_group("OTHR"))
+
+        self._registry.invalidate()
+
+        self.assertEqual(self._registry.by_ts_group("OTHR").guild_name, "Others")
@@ -0,0 +1,224 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from bot.db import get_or_create_database
+from bot.guild_registry import GuildRegistry
+from bot.guild_service import GuildService, SORT_KEY_SPACE
+
+
+class TestGuildGroupOrder(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._database = get_or_create_database(":memory:", "test")
+        self._registry = GuildRegistry(self._database)
+        config = MagicMock(guilds_minimum_talk_power=50, guilds_maximum_talk_power=90, guilds_sort_id=1100, guilds_sort_id_range=100)
+        self._service = GuildService(self._database, MagicMock(), config, MagicMock(), self._registry)
+        self._ts_facade = MagicMock()
+
+    def tearDown(self) -> None:
+        self._database.close()
+        super().tearDown()
+
+    def _insert(self, ts_group, group_id, sort_key=None):
+        with self._database.lock:
+            self._database.cursor.execute("INSERT INTO guilds(guild_name, ts_group, group_id, sort_key) VALUES(?,?,?,?)", (f"Guild {ts_group}", ts_group, group_id, sort_key))
+            self._database.conn.commit()
+        self._registry.invalidate()
+
+    def test_new_guild_fits_between_its_neighbours(self):
+        self._insert("AAA", 1, 1000)
+        self._insert("CCC", 3, 3000)
+
+        self.assertEqual(self._service._free_sort_key("BBB"), 2000)
+        self.assertEqual(self._service._free_sort_key("ZZZ"), (3000 + SORT_KEY_SPACE) // 2)
+
+    def test_no_gap_or_legacy_guilds_need_a_rebalance(self):
+        self._insert("AAA", 1, 1000)
+        self._insert("CCC", 3, 1001)
+        self.assertIsNone(self._service._free_sort_key("BBB"))
+
+        self._insert("DDD", 4)
+        self.assertIsNone(self._service._free_sort_key("EEE"))
+
+    def test_no_gap_rebalances_the_other_groups_to_make_room(self):
+        self._insert("AAA", 1, 1000)
+        self._insert("CCC", 3, 1001)
+
+        sort_key = self._service._free_sort_key("BBB", self._ts_facade)
+
+        self.assertEqual(sorted(call.args[0] for call in self._ts_facade.servergroup_add_permissions.call_args_list), [1, 3])
+        lower, upper = (g.sort_key for g in sorted(self._registry.all(), key=lambda g: g.ts_group))
+        self.assertTrue(lower < sort_key < upper)
+
+    def test_rebalance_spreads_keys_and_keeps_talk_power_in_window(self):
+        for group_id, ts_group in enumerate(["CCC", "AAA", "BBB"], start=1):
+            self._insert(ts_group, group_id)
+
+        self._service._rebalance_guild_groups(self._ts_facade)
+
+        sort_keys = [g.sort_key for g in sorted(self._registry.all(), key=lambda g: g.ts_group)]
+        self.assertEqual(sort_keys, [2500, 5000, 7500])
+        self._ts_facade.servergroup_id.assert_not_called()
+        self.assertEqual(sorted(call.args[0] for call in self._ts_facade.servergroup_add_permissions.call_args_list), [1, 2, 3])
+        for call in self._ts_facade.servergroup_add_permissions.call_args_list:
+            permissions = dict(call.args[1])
+            self.assertTrue(50 <= permissions["i_client_talk_power"] <= 90)
+            self.assertTrue(1100 <= permissions["i_group_sort_id"] < 1200)
+
+    def test_sort_ids_stay_in_the_configured_range(self):
+        self.assertEqual(dict(self._service._create_guild_sort_permissions(0))["i_group_sort_id"], 1100)
+        self.assertEqual(dict(self._service._create_guild_sort_permissions(SORT_KEY_SPACE - 1))["i_group_sort_id"], 1199)
+
+
+class TestGuildChannels(TestCase):
+    def test_channels_are_listed_with_one_channellist(self):
+        ts_facade = MagicMock()
+        ts_facade.channel_list = MagicMock(return_value=[
+            {"cid": "1", "pid": "0", "channel_name": "Guilds", "seconds_empty": "0"},
+            {"cid": "2", "pid": "1", "channel_name": "Guild A [A]", "seconds_empty": "60"},
+            {"cid": "3", "pid": "1", "channel_name": "Guild B [B]", "seconds_empty": "0"},
+            {"cid": "4", "pid": "2", "channel_name": "Lobby", "seconds_empty": "120"},
+            {"cid": "5", "pid": "0", "channel_name": "Other", "seconds_empty": "0"},
+        ])
+        ts_connection_pool = MagicMock()
+        ts_connection_pool.item.return_value.__enter__.return_value = ts_facade
+        service = GuildService(MagicMock(), ts_connection_pool, MagicMock(guilds_parent_channel="Guilds"), MagicMock(), MagicMock())
+
+        channels = list(service.list_channels())
+
+        ts_facade.channel_list.assert_called_once_with(seconds_empty=True)
+        ts_facade.channel_info.assert_not_called()
+        self.assertEqual([c["name"] for c in channels], ["Guild B [B]", "Guild A [A]"])
+        self.assertIsNone(channels[0]["subChannels"])
+        self.assertEqual([c["name"] for c in channels[1]["subChannels"]], ["Lobby"])
+
+
+class TestGuildAuditDiff(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        config = MagicMock(guilds_minimum_talk_power=50, guilds_maximum_talk_power=90, guilds_sort_id=1100, guilds_sort_id_range=100, guild_sub_channels=("Lobby",))
+        self._service = GuildService(MagicMock(), MagicMock(), config, MagicMock(), MagicMock())
+        self._ts_facade = MagicMock()
+        self._ts_facade.channel_info = MagicMock(return_value=({"channel_name": "Die Dummies [DUMM]"}, None))
+        self._ts_facade.channel_list = MagicMock(return_value=[{"cid": "11", "pid": "10", "channel_name": "Lobby"},
+                                                               {"cid": "12", "pid": "10", "channel_name": "Private"}])
+        self._ts_facade.servergroup_list = MagicMock(return_value=[{"sgid": "20", "name": "DUMM"}])
+        self._ts_facade.channel_add_permissions = MagicMock(return_value=(None, None))
+
+    def test_unchanged_guild_writes_nothing(self):
+        sub_channel_permissions, permissions = self._service._create_guild_channel_permissions(123)
+        self._ts_facade.channel_permission_list = MagicMock(side_effect=lambda cid: dict(permissions if cid == 10 else sub_channel_permissions))
+        self._ts_facade.servergroup_permission_list = MagicMock(return_value=dict(self._service._create_guild_servergroup_permissions(123, 5000)))
+
+        self._service._audit_channel(self._ts_facade, 10, "Die Dummies", "DUMM", 123)
+        self._service._audit_group(self._ts_facade, 20, "DUMM", 123, 5000)
+
+        self._ts_facade.channel_edit.assert_not_called()
+        self._ts_facade.channel_add_permissions.assert_not_called()
+        self._ts_facade.servergroup_rename.assert_not_called()
+        self._ts_facade.servergroup_add_permissions.assert_not_called()
+
+    def test_only_changed_permissions_are_written(self):
+        sub_channel_permissions, permissions = self._service._create_guild_channel_permissions(123)
+        self._ts_facade.channel_permission_list = MagicMock(side_effect=lambda cid: {**dict(permissions), "i_icon_id": 99} if cid == 10 else {})
+        self._ts_facade.servergroup_permission_list = MagicMock(return_value={})
+
+        self._service._audit_channel(self._ts_facade, 10, "Die Dummies", "DUMM", 123)
+        self._service._audit_group(self._ts_facade, 20, "OTHR", 123, 5000)
+
+        self._ts_facade.channel_add_permissions.assert_any_call(10, [("i_icon_id", 123)])
+        self._ts_facade.channel_add_permissions.assert_any_call("11", sub_channel_permissions)  # sub channel "Private" is not managed
+        self.assertEqual(self._ts_facade.channel_add_permissions.call_count, 2)
+        self._ts_facade.servergroup_rename.assert_called_once_with(20, "OTHR")
+        self._ts_facade.servergroup_add_permissions.assert_called_once()
+
+    def test_icon_ids_reported_as_signed_are_unchanged(self):
+        icon_id = 3000000000  # crc32 above 2^31, teamspeak reports it as a negative signed 32 bit value
+        sub_channel_permissions, permissions = self._service._create_guild_channel_permissions(icon_id)
+        current = {**dict(permissions), "i_icon_id": icon_id - 2 ** 32}
+
+        self.assertEqual(self._service._permission_changes(permissions, current), [])
+        self.assertEqual(self._service._permission_changes(permissions, {**current, "i_icon_id": 99}), [("i_icon_id", icon_id)])
+
+
+class TestGuildAuditFingerprint(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._database = get_or_create_database(":memory:", "test")
+        self._registry = GuildRegistry(self._database)
+        guild_info = {"id": "D-1", "name": "Die Dummies", "tag": "DUMM", "emblem": None}
+        guild_cache = MagicMock()
+        guild_cache.guild_get = MagicMock(return_value=guild_info)
+        self._ts_facade = MagicMock()
+        self._ts_facade.channel_info = MagicMock(return_value=({"channel_name": "Die Dummies [DUMM]"}, None))
+        self._ts_facade.channel_add_permissions = MagicMock(return_value=(None, None))
+        self._ts_connection_pool = MagicMock()
+        self._ts_connection_pool.item.return_value.__enter__.return_value = self._ts_facade
+        config = MagicMock(guilds_minimum_talk_power=50, guilds_maximum_talk_power=90, guilds_sort_id=1100, guilds_sort_id_range=100, guild_sub_channels=("Lobby",))
+        self._service = GuildService(self._database, self._ts_connection_pool, config, guild_cache, self._registry)
+
+        with self._database.lock:
+            self._database.cursor.execute("INSERT INTO guilds(gw2_guild_id, guild_name, ts_group, icon_id, channel_id, group_id, sort_key) VALUES(?,?,?,?,?,?,?)",
+                                          ("D-1", "Die Dummies", "DUMM", GuildService.generate_guild_icon_id("Die Dummies", None), 10, 20, 5000))
+            self._database.conn.commit()
+        self._db_id = self._registry.all()[0].guild_id
+
+    def tearDown(self) -> None:
+        self._database.close()
+        super().tearDown()
+
+    def test_unchanged_guild_is_skipped_until_full_audit(self):
+        self._service.audit_guild(self._db_id)
+        self._ts_connection_pool.item.reset_mock()
+
+        self._service.audit_guild(self._db_id)
+        self._ts_connection_pool.item.assert_not_called()
+
+        self._service.audit_guild(self._db_id, full=True)
+        self._ts_connection_pool.item.assert_called()
+
+    def test_audit_does_not_reload_the_registry(self):
+        self._service.audit_guild(self._db_id)
+        generation = self._registry._generation
+
+        self._service.audit_guild(self._db_id, full=True)
+
+        self.assertEqual(self._registry._generation, generation)
+
+    def test_guild_without_group_is_audited_again(self):
+        with self._database.lock:
+            self._database.cursor.execute("UPDATE guilds SET group_id = NULL WHERE guild_id = ?", (self._db_id,))
+            self._database.conn.commit()
+        self._registry.invalidate()
+        self._ts_facade.servergroup_id = MagicMock(return_value=None)  # the group was deleted on the server
+
+        self._service.audit_guild(self._db_id)
+        self._ts_connection_pool.item.reset_mock()
+        self._service.audit_guild(self._db_id)
+
+        self._ts_connection_pool.item.assert_called()
+
+    def test_changed_guild_is_audited_again(self):
+        self._service.audit_guild(self._db_id)
+        with self._database.lock:
+            self._database.cursor.execute("UPDATE guilds SET ts_group = 'DUMX' WHERE guild_id = ?", (self._db_id,))
+            self._database.conn.commit()
+        self._registry.invalidate()
+        self._ts_connection_pool.item.reset_mock()
+
+        self._service.audit_guild(self._db_id)
+
+        self._ts_connection_pool.item.assert_called()
+
+    def test_legacy_guild_gets_a_sort_key_on_its_first_audit(self):
+        with self._database.lock:
+            self._database.cursor.execute("UPDATE guilds SET sort_key = NULL WHERE guild_id = ?", (self._db_id,))
+            self._database.conn.commit()
+        self._registry.invalidate()
+        self._ts_facade.servergroup_permission_list = MagicMock(return_value={})
+
+        self._service.audit_guild(self._db_id)
+
+        self.assertEqual(self._registry.by_id(self._db_id).sort_key, SORT_KEY_SPACE // 2)
+        permissions = dict(self._ts_facade.servergroup_add_permissions.call_args.args[1])
+        self.assertEqual(permissions["i_group_sort_id"], 1150)
@@ -48,7 +48,8 @@ class Gw2ApiFacadeTest(TestCase):
         self.assertEqual(ae.exception.message, "Invalid access token")
 
     def test_get_characters(self):
-        characters = gw2api.characters_get(self.TEST_TOKEN)
+        names = gw2api.characters_get_names(self.TEST_TOKEN)
+        characters = [gw2api.character_get_core(self.TEST_TOKEN, name) for name in names]
         self.assertEqual(len(characters), 2)
         self.assertSetEqual(set(map(lambda x: x.get("level"), characters)), {24, 13})
         self.assertSetEqual(set(map(lambda x: x.get("name"), characters)), {"Eff Testing Warr", "Eff Testing Ele"})
@@ -0,0 +1,36 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+import time
+
+from bot.gwapi import RateLimiter
+
+
+class TestRateLimiter(TestCase):
+    def test_burst_is_not_delayed(self):
+        limiter = RateLimiter(rate=1, burst=3)
+
+        with patch("bot.gwapi.rate_limiter.time.sleep") as sleep_mock:
+            for _ in range(3):
+                limiter.acquire()
+
+        sleep_mock.assert_not_called()
+
+    def test_requests_beyond_burst_wait_for_refill(self):
+        limiter = RateLimiter(rate=20, burst=1)
+
+        started = time.monotonic()
+        for _ in range(3):
+            limiter.acquire()
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)  # two refills of 1/20s each
+
+    def test_zero_rate_disables_limit(self):
+        limiter = RateLimiter(rate=1, burst=1)
+        limiter.configure(0)
+
+        with patch("bot.gwapi.rate_limiter.time.sleep") as sleep_mock:
+            for _ in range(10):
+                limiter.acquire()
+
+        sleep_mock.assert_not_called()
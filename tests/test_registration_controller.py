@@ -0,0 +1,66 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from flask import Flask, json
+from werkzeug.test import TestResponse
+
+import bot.rest.bootstrap
+from bot.db import Lateness
+from bot.rest.controller import RegistrationController
+from bot.util import WorkerMetrics
+
+
+class TestRegistrationController(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        flask = Flask(__name__)
+
+        self._user_service_mock = MagicMock()
+        self._audit_service_mock = MagicMock()
+
+        controller = RegistrationController(self._user_service_mock, self._audit_service_mock)
+
+        flask.register_blueprint(controller.api)
+        bot.rest.bootstrap.register_error_handlers(flask)
+
+        self._app = flask.test_client()
+
+    def test_audit_queue_returns_queue_lateness_and_workers(self):
+        self._audit_service_mock.pending_audits = MagicMock(return_value=12)
+        self._audit_service_mock.oldest_pending_audit_age = MagicMock(return_value=120.6)
+        self._audit_service_mock.audit_lateness = MagicMock(return_value={20: Lateness(started=4, late=1, total_seconds=30.0, max_seconds=30.0)})
+        self._audit_service_mock.worker_metrics = MagicMock(return_value=[WorkerMetrics(name="AuditQueueWorker-0", processed=3, requeued=1)])
+
+        result: TestResponse = self._app.get("/registration/_audit/queue")
+
+        self.assertEqual(200, result.status_code)
+        self.assertEqual({
+            "pending": 12,
+            "oldest_pending_seconds": 121,
+            "lateness": {"20": {"started": 4, "late": 1, "total_seconds": 30.0, "max_seconds": 30.0}},
+            "workers": [{"name": "AuditQueueWorker-0", "processed": 3, "failed": 0, "requeued": 1, "busy_seconds": 0.0}],
+        }, json.loads(result.get_data(as_text=True)))
+
+    def test_audit_trigger_reports_running_audit(self):
+        self._audit_service_mock.trigger_user_audit = MagicMock(return_value=(MagicMock(), False))
+
+        result: TestResponse = self._app.post("/registration/_audit")
+
+        self.assertEqual(200, result.status_code)
+        self.assertEqual('"Already running"\n', result.get_data(as_text=True))
+
+    def test_audit_progress_returns_204_without_audit(self):
+        self._audit_service_mock.audit_run = MagicMock(return_value=None)
+
+        result: TestResponse = self._app.get("/registration/_audit")
+
+        self.assertEqual(204, result.status_code)
+
+    def test_audit_progress_returns_progress(self):
+        self._audit_service_mock.audit_run.return_value.progress = MagicMock(return_value={"kind": "user", "queued": 6000, "done": 1500, "eta_seconds": 900})
+
+        result: TestResponse = self._app.get("/registration/_audit")
+
+        self.assertEqual(200, result.status_code)
+        self.assertEqual({"kind": "user", "queued": 6000, "done": 1500, "eta_seconds": 900}, json.loads(result.get_data(as_text=True)))
@@ -0,0 +1,88 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from bot.db import get_or_create_database
+from bot.guild_registry import GuildRegistry
+from bot.user_service import UserService
+
+
+class TestGuildSnapshot(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._database = get_or_create_database(":memory:", "test")
+        with self._database.lock:
+            self._database.cursor.executemany("INSERT INTO guilds(guild_name, ts_group) VALUES(?,?)", [("Die Dummies", "DUMM"), ("Others", "OTHR")])
+            self._database.conn.commit()
+
+        self._ts_facade = MagicMock()
+        self._ts_facade.servergroup_list = MagicMock(return_value=[{"name": "DUMM", "sgid": "10"}, {"name": "OTHR", "sgid": "11"}])
+        self._ts_facade.servergroup_list_by_client = MagicMock(return_value=[])
+        self._ts_facade.servergroup_client_add = MagicMock(return_value=None)
+        self._ts_facade.servergroup_client_del = MagicMock(return_value=None)
+        ts_connection_pool = MagicMock()
+        ts_connection_pool.item.return_value.__enter__.return_value = self._ts_facade
+        self._service = UserService(self._database, ts_connection_pool, MagicMock(audit_period=7), GuildRegistry(self._database))
+
+    def tearDown(self) -> None:
+        self._service.close()
+        self._database.close()
+        super().tearDown()
+
+    @staticmethod
+    def _auth(guilds, guild_names):
+        auth = MagicMock(guilds_error=False, guilds=guilds, guild_names=guild_names)
+        auth.name = "account.1"
+        return auth
+
+    def test_unknown_user_is_not_up_to_date(self):
+        self.assertFalse(self._service.guild_tags_up_to_date("uid1", self._auth(["D"], ["Die Dummies"])))
+
+    def test_user_is_up_to_date_after_update(self):
+        self._service.update_guild_tags(self._ts_facade, MagicMock(unique_id="uid1", ts_db_id="101"), self._auth(["D"], ["Die Dummies"]))
+
+        self.assertTrue(self._service.guild_tags_up_to_date("uid1", self._auth(["D"], ["Die Dummies"])))
+        self.assertFalse(self._service.guild_tags_up_to_date("uid1", self._auth(["D", "O"], ["Die Dummies", "Others"])))
+
+    def test_user_is_not_up_to_date_after_a_failed_update(self):
+        self._ts_facade.servergroup_client_add = MagicMock(return_value=Exception("insufficient client permissions"))
+
+        self._service.update_guild_tags(self._ts_facade, MagicMock(unique_id="uid1", ts_db_id="101"), self._auth(["D"], ["Die Dummies"]))
+
+        self.assertFalse(self._service.guild_tags_up_to_date("uid1", self._auth(["D"], ["Die Dummies"])))
+
+    def test_user_is_not_up_to_date_while_a_guild_group_is_missing(self):
+        self._ts_facade.servergroup_list = MagicMock(return_value=[{"name": "OTHR", "sgid": "11"}])
+
+        self._service.update_guild_tags(self._ts_facade, MagicMock(unique_id="uid1", ts_db_id="101"), self._auth(["D"], ["Die Dummies"]))
+
+        self.assertFalse(self._service.guild_tags_up_to_date("uid1", self._auth(["D"], ["Die Dummies"])))
+
+    def test_hiding_a_guild_changes_the_wanted_groups(self):
+        self._service.update_guild_tags(self._ts_facade, MagicMock(unique_id="uid1", ts_db_id="101"), self._auth(["D"], ["Die Dummies"]))
+        with self._database.lock:
+            self._database.cursor.execute("INSERT INTO guild_ignores(guild_id, ts_db_id) SELECT guild_id, 'uid1' FROM guilds WHERE ts_group = 'DUMM'")
+            self._database.conn.commit()
+        self._service.invalidate_hidden_groups("uid1")
+
+        self.assertFalse(self._service.guild_tags_up_to_date("uid1", self._auth(["D"], ["Die Dummies"])))
+
+    def test_hidden_groups_are_cached_until_invalidated(self):
+        self.assertEqual(self._service.hidden_groups("uid1"), set())
+        with self._database.lock:
+            self._database.cursor.execute("INSERT INTO guild_ignores(guild_id, ts_db_id) SELECT guild_id, 'uid1' FROM guilds WHERE ts_group = 'OTHR'")
+            self._database.conn.commit()
+
+        self.assertEqual(self._service.hidden_groups("uid1"), set())
+
+        self._service.invalidate_hidden_groups("uid1")
+
+        self.assertEqual(self._service.hidden_groups("uid1"), {"OTHR"})
+
+    def test_registration_drops_a_pending_audit_result(self):
+        self._service.add_user_to_database("uid1", "old.1234", "key", None, None)
+        self._service.record_audit("uid1", "old.1234", None, 0)
+
+        self._service.add_user_to_database("uid1", "new.5678", "other key", None, None)
+        self._service.close()
+
+        self.assertEqual(self._service.get_user_database_entry("uid1")["account_name"], "new.5678")
@@ -0,0 +1,107 @@
+import threading
+from dataclasses import dataclass, field
+from queue import Queue
+from unittest import TestCase
+
+import time
+
+from bot.db import DurableQueue, get_or_create_database
+from bot.util import WorkerPool
+
+
+@dataclass(order=True)
+class Entry:
+    priority: int
+    key: str = field(compare=False)
+
+
+class TestWorkerPool(TestCase):
+    def test_items_are_processed_in_parallel(self):
+        queue = Queue()
+        for i in range(4):
+            queue.put(i)
+        barrier = threading.Barrier(4, timeout=5)  # only passes when all four items are worked on at the same time
+
+        def work(item):
+            barrier.wait()
+            return True
+
+        pool = WorkerPool("Test", queue, work, size=4)
+        pool.start()
+        self.addCleanup(pool.close)
+        queue.join()
+
+        self.assertEqual(sum(metrics.processed for metrics in pool.metrics()), 4)
+        self.assertEqual(sum(metrics.failed for metrics in pool.metrics()), 0)
+
+    def test_item_is_requeued_when_not_processed(self):
+        queue = Queue()
+        queue.put("item")
+        attempts = []
+
+        def work(item):
+            attempts.append(item)
+            return len(attempts) > 1
+
+        pool = WorkerPool("Test", queue, work, size=1)
+        pool.start()
+        self.addCleanup(pool.close)
+        queue.join()
+
+        self.assertEqual(attempts, ["item", "item"])
+        self.assertEqual(pool.metrics()[0].requeued, 1)
+        self.assertEqual(pool.metrics()[0].processed, 1)
+
+    def test_failing_item_is_counted_and_dropped(self):
+        queue = Queue()
+        queue.put("item")
+
+        def work(item):
+            raise ValueError("broken")
+
+        pool = WorkerPool("Test", queue, work, size=1)
+        pool.start()
+        self.addCleanup(pool.close)
+        queue.join()
+
+        self.assertEqual(pool.metrics()[0].failed, 1)
+        self.assertTrue(queue.empty())
+
+    def test_paused_workers_leave_the_queue_untouched(self):
+        queue = Queue()
+        queue.put("item")
+        paused = threading.Event()
+        paused.set()
+        worked = threading.Event()
+
+        def work(item):
+            worked.set()
+            return True
+
+        pool = WorkerPool("Test", queue, work, size=1, paused=paused.is_set)
+        pool.start()
+        self.addCleanup(pool.close)
+
+        self.assertFalse(worked.wait(0.5))
+        self.assertEqual(queue.qsize(), 1)
+
+        paused.clear()
+        queue.join()
+        self.assertTrue(worked.is_set())
+
+    def test_closing_waits_for_workers_blocked_on_the_queue(self):
+        database = get_or_create_database(":memory:", "test")
+        self.addCleanup(database.close)
+        queue = DurableQueue(database, "test", Entry, key=lambda entry: entry.key)
+        pool = WorkerPool("Test", queue, lambda item: True, size=2)
+        pool.start()
+        time.sleep(0.1)  # workers wait for items
+
+        started = time.monotonic()
+        pool.close()
+        queue.close()
+        pool.join()
+
+        self.assertLess(time.monotonic() - started, 2)
+        queue.put(Entry(100, "a"))
+        self.assertEqual(DurableQueue(database, "test", Entry, key=lambda entry: entry.key).get_nowait(), Entry(100, "a"))
@@ -0,0 +1,87 @@
+from unittest import TestCase
+
+from bot.db import WriteBuffer, get_or_create_database
+from bot.db.write_buffer import MAX_WRITE_ATTEMPTS
+
+
+class TestWriteBuffer(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._database = get_or_create_database(":memory:", "test")
+        with self._database.lock:
+            self._database.cursor.executemany("INSERT INTO users(ts_db_id, account_name) VALUES(?,?)", [("uid1", "old"), ("uid2", "old")])
+            self._database.conn.commit()
+
+    def tearDown(self) -> None:
+        self._database.close()
+        super().tearDown()
+
+    def _account_names(self):
+        with self._database.lock:
+            return [row[0] for row in self._database.cursor.execute("SELECT account_name FROM users ORDER BY ts_db_id").fetchall()]
+
+    def test_rows_are_written_when_batch_is_full(self):
+        buffer = WriteBuffer(self._database, "UPDATE users SET account_name = ? WHERE ts_db_id = ?", batch_size=2, flush_interval=60)
+        self.addCleanup(buffer.close)
+
+        buffer.add(("new", "uid1"))
+        self.assertEqual(self._account_names(), ["old", "old"])
+
+        buffer.add(("new", "uid2"))
+        self.assertEqual(self._account_names(), ["new", "new"])
+
+    def test_close_writes_remaining_rows(self):
+        buffer = WriteBuffer(self._database, "UPDATE users SET account_name = ? WHERE ts_db_id = ?", batch_size=50, flush_interval=60)
+
+        buffer.add(("new", "uid1"))
+        buffer.close()
+
+        self.assertEqual(self._account_names(), ["new", "old"])
+
+    def test_failed_rows_are_kept_for_the_next_flush(self):
+        buffer = WriteBuffer(self._database, "UPDATE missing_table SET account_name = ? WHERE ts_db_id = ?", batch_size=50, flush_interval=60)
+        self.addCleanup(buffer._timer.cancel)
+
+        buffer.add(("new", "uid1"))
+        buffer.flush()
+
+        self.assertEqual(buffer._rows, [(("new", "uid1"), 1)])
+
+    def test_broken_row_is_dropped_without_holding_back_the_others(self):
+        with self._database.lock:
+            self._database.cursor.execute("CREATE TRIGGER reject_broken BEFORE UPDATE ON users WHEN NEW.account_name = 'broken' "
+                                          "BEGIN SELECT RAISE(ABORT, 'broken row'); END")
+            self._database.conn.commit()
+        buffer = WriteBuffer(self._database, "UPDATE users SET account_name = ? WHERE ts_db_id = ?", batch_size=50, flush_interval=60)
+        self.addCleanup(buffer._timer.cancel)
+
+        buffer.add(("broken", "uid1"))
+        buffer.add(("new", "uid2"))
+        buffer.flush()
+        self.assertEqual(self._account_names(), ["old", "new"])
+
+        for _ in range(MAX_WRITE_ATTEMPTS - 1):
+            buffer.flush()
+        self.assertEqual(buffer._rows, [])
+
+    def test_discarded_rows_are_not_written(self):
+        buffer = WriteBuffer(self._database, "UPDATE users SET account_name = ? WHERE ts_db_id = ?", batch_size=50, flush_interval=60, key=lambda row: row[-1])
+
+        buffer.add(("new", "uid1"))
+        buffer.add(("new", "uid2"))
+        buffer.discard("uid1")
+        buffer.close()
+
+        self.assertEqual(self._account_names(), ["old", "new"])
+
+    def test_failed_rows_do_not_roll_back_other_statements(self):
+        buffer = WriteBuffer(self._database, "UPDATE missing_table SET account_name = ? WHERE ts_db_id = ?", batch_size=50, flush_interval=60)
+        self.addCleanup(buffer._timer.cancel)
+
+        with self._database.lock:
+            self._database.cursor.execute("UPDATE users SET account_name = 'direct' WHERE ts_db_id = 'uid1'")  # not committed yet
+            buffer.add(("new", "uid1"))
+            buffer.flush()
+            self._database.conn.commit()
+
+        self.assertEqual(self._account_names(), ["direct", "old"])